@@ -8,14 +8,11 @@ Noms et numéros étudiants:
 
 import argparse
 import getpass
-import json
-import socket
 import sys
 
-import glosocket
+import gloclient
 import gloutils
 from gloutils import *
-from glosocket import *
 
 
 class Client:
@@ -23,13 +20,14 @@ class Client:
 
     def __init__(self, destination: str) -> None:
         """
-        Prépare et connecte le socket du client `_socket`.
+        Prépare et connecte la connexion du client `_connection`
+        (gloclient.GloConnection), qui négocie l'encodage et la compression
+        des messages et se reconnecte au besoin.
 
         Prépare un attribut `_username` pour stocker le nom d'utilisateur
         courant. Laissé vide quand l'utilisateur n'est pas connecté.
         """
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((destination, gloutils.APP_PORT))
+        self._connection = gloclient.GloConnection(destination, gloutils.APP_PORT)
         self._username = ""
 
     def _register(self) -> None:
@@ -43,18 +41,12 @@ class Client:
         username = input("Nom d'utilisateur : ")
         password = getpass.getpass("Mot de passe : ")
 
-        # Envoi de la requête d'inscription
-        auth_payload: AuthPayload = AuthPayload(username=username, password=password)
-        message: GloMessage = GloMessage(header=Headers.AUTH_REGISTER, payload=auth_payload)
-        send_mesg(self._socket, json.dumps(message))
-
-        # Réception de la réponse
-        response = recv_mesg(self._socket)
-        match json.loads(response):
-            case {"header": Headers.OK}:
-                self._username = username
-            case {"header": Headers.ERROR, "payload": payload}:
-                print(payload["error_message"])
+        try:
+            self._connection.register(username, password)
+        except gloclient.GloClientError as ex:
+            print(ex)
+        else:
+            self._username = username
 
     def _login(self) -> None:
         """
@@ -68,74 +60,101 @@ class Client:
         username = input("Nom d'utilisateur : ")
         password = getpass.getpass("Mot de passe : ")
 
-        # Preparation et envoi de la requête de connexion
-        auth_payload: AuthPayload = AuthPayload(username=username, password=password)
-        message: GloMessage = GloMessage(header=Headers.AUTH_LOGIN, payload=auth_payload)
-        send_mesg(self._socket, json.dumps(message))
-
-        # Réception de la réponse
-        response = glosocket.recv_mesg(self._socket)
-        match json.loads(response):
-            case {"header": Headers.OK}:
-                self._username = username
-            case {"header": Headers.ERROR, "payload": payload}:
-                print(payload["error_message"])
+        try:
+            self._connection.login(username, password)
+        except gloclient.GloClientError as ex:
+            print(ex)
+        else:
+            self._username = username
 
     def _quit(self) -> None:
         """
         Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme le
         socket du client.
         """
-        self._socket.send(gloutils.BYE, {"username": self._username})
-        self._socket.close()
+        self._connection.close()
 
     def _read_email(self) -> None:
         """
         Demande au serveur la liste de ses courriels avec l'entête
-        `INBOX_READING_REQUEST`.
+        `INBOX_READING_REQUEST`, une page de `INBOX_PAGE_SIZE` courriels
+        à la fois.
 
-        Affiche la liste des courriels puis transmet le choix de l'utilisateur
-        avec l'entête `INBOX_READING_CHOICE`.
+        Affiche la page courante puis transmet le choix de l'utilisateur
+        avec l'entête `INBOX_READING_CHOICE`. L'utilisateur peut aussi
+        passer à la page suivante (`s`) ou précédente (`p`).
 
-        Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`.
+        Le courriel est reçu en continu (`INBOX_READING_STREAM`) et affiché
+        à l'aide du gabarit `EMAIL_DISPLAY` au fur et à mesure.
 
         S'il n'y a pas de courriel à lire, l'utilisateur est averti avant de
         retourner au menu principal.
         """
-        # Preparation et envoi de la requête de demande de liste de courriel
-        message: GloMessage = GloMessage(header=Headers.INBOX_READING_REQUEST)
-        send_mesg(self._socket, json.dumps(message))
-
-        # Réception de la liste des courriels
-        response = recv_mesg(self._socket)
-        match json.loads(response):
-            case {"header": Headers.INBOX_READING_REQUEST, "payload": payload}:
-                email_list = payload["email_list"]
-                if not email_list:
-                    print("Aucun courriel à lire.")
-                else:
-                    for email in email_list:
-                        print(email)
-                    choice = int(input(f"Entrez votre choix [1-{len(email_list)}]: "))
-
-                    # Preparation et envoi de la requête de demande de lecture de courriel
-                    choice_payload = EmailChoicePayload(choice=choice)
-                    message: GloMessage = GloMessage(header=Headers.INBOX_READING_CHOICE, payload=choice_payload)
-                    send_mesg(self._socket, json.dumps(message))
+        offset = 0
+        while True:
+            # Demande d'une page de courriels
+            try:
+                page = self._connection.list_emails(offset, INBOX_PAGE_SIZE)
+            except gloclient.GloClientError as ex:
+                print(ex)
+                return
+            email_list = page["email_list"]
+            total = page["total"]
+
+            if not total:
+                print("Aucun courriel à lire.")
+                return
+
+            for email in email_list:
+                print(email)
+            print(f"Courriels {offset + 1}-{offset + len(email_list)} sur {total}")
+            answer = input(f"Entrez votre choix [1-{total}], "
+                           f"'s' page suivante, 'p' page précédente: ").strip()
+            if answer == "s":
+                if offset + INBOX_PAGE_SIZE < total:
+                    offset += INBOX_PAGE_SIZE
+                continue
+            if answer == "p":
+                offset = max(0, offset - INBOX_PAGE_SIZE)
+                continue
+            choice = int(answer)
+            if not 1 <= choice <= total:
+                raise ValueError()
+            break
+
+        # Lecture du courriel en continu
+        try:
+            header, chunks = self._connection.iter_email(choice)
+            display = EMAIL_DISPLAY.format(sender=header["sender"], to=header["destination"],
+                                           subject=header["subject"], date=header["date"],
+                                           body="")
+            print(display[:-1], end="")
+            for chunk in chunks:
+                print(chunk, end="")
+            print()
+        except gloclient.GloClientError as ex:
+            print(ex)
 
     def _send_email(self) -> None:
         """
         Demande à l'utilisateur respectivement:
-        - l'adresse email du destinataire,
+        - l'adresse email du destinataire, ou plusieurs adresses séparées
+          par des virgules,
         - le sujet du message,
         - le corps du message.
 
         La saisie du corps se termine par un point seul sur une ligne.
 
-        Transmet ces informations avec l'entête `EMAIL_SENDING`.
+        Transmet ces informations avec l'entête `EMAIL_SENDING`, ou en
+        continu par morceaux de STREAM_CHUNK_SIZE caractères si le corps
+        dépasse cette taille.
         """
         # Récupération des données pour les champs du courriel
-        mail_to: str = input("Entrez l'adresse du destinataire: ")
+        addresses: list[str] = []
+        while not addresses:
+            addresses = [address.strip() for address in
+                         input("Entrez l'adresse du destinataire: ").split(",") if address.strip()]
+        mail_to: str | list[str] = addresses[0] if len(addresses) == 1 else addresses
         subject: str = input("Entrez le sujet: ")
         print("Entrez le contenu du courriel, terminez la saisie avec un '.' seul sur une ligne:")
         content = ""
@@ -147,15 +166,15 @@ class Client:
         email_payload: EmailContentPayload = EmailContentPayload(sender=f"{self._username}@{SERVER_DOMAIN}",
                                                                  destination=mail_to, subject=subject,
                                                                  date=get_current_utc_time(), content=content)
-        message: GloMessage = GloMessage(header=Headers.EMAIL_SENDING, payload=email_payload)
-        send_mesg(self._socket, json.dumps(message))
-
-        response = recv_mesg(self._socket)
-        match json.loads(response):
-            case {"header": Headers.OK}:
-                pass
-            case {"header": Headers.ERROR, "payload": payload}:
-                print(payload["error_message"])
+        try:
+            statuses = self._connection.send_email(email_payload)
+        except gloclient.GloClientError as ex:
+            print(ex)
+            return
+        if isinstance(mail_to, list):
+            for status in statuses:
+                if not status["delivered"]:
+                    print(f"Échec de l'envoi à {status['destination']}")
 
     def _check_stats(self) -> None:
         """
@@ -163,6 +182,12 @@ class Client:
 
         Affiche les statistiques à l'aide du gabarit `STATS_DISPLAY`.
         """
+        try:
+            stats = self._connection.stats()
+        except gloclient.GloClientError as ex:
+            print(ex)
+            return
+        print(STATS_DISPLAY.format(count=stats["count"], size=stats["size"]))
 
     def _logout(self) -> None:
         """
@@ -170,6 +195,11 @@ class Client:
 
         Met à jour l'attribut `_username`.
         """
+        try:
+            self._connection.logout()
+        except gloclient.GloClientError as ex:
+            print(ex)
+        self._username = ""
 
     def run(self) -> None:
         """Point d'entrée du client."""
@@ -217,7 +247,11 @@ def _main() -> int:
                         dest="dest", required=True,
                         help="Adresse IP/URL du serveur.")
     args = parser.parse_args(sys.argv[1:])
-    client = Client(args.dest)
+    try:
+        client = Client(args.dest)
+    except gloclient.GloClientError as ex:
+        print(ex)
+        return 1
     client.run()
     return 0
 
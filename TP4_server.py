@@ -6,61 +6,363 @@ Noms et numéros étudiants:
 -
 """
 
-import hashlib
-import hmac
+import argparse
+import asyncio
+import codecs
+import collections
+import concurrent.futures
+import cProfile
+import functools
 import json
+import multiprocessing
+import multiprocessing.connection
 import os
 import re
 
-import select
+import selectors
+import signal
 import socket
 import sys
+import threading
+import time
+from typing import Iterable, Iterator
 
+import gloauth
+import glocodec
+import glolimit
+import glometrics
+import glorelay
 import glosocket
+import glostorage
 import gloutils
 from gloutils import *
 from glosocket import *
 
 
+class _Connection:
+    """
+    État d'une connexion cliente.
+
+    `soc` est le socket client pour le moteur `selectors` et le flux
+    d'écriture pour le moteur asyncio; il sert de clé aux traitements.
+
+
+    Les requêtes d'une même connexion sont traitées dans l'ordre:
+    `requests` contient les trames en attente et `pending` la prochaine
+    requête, déjà décodée, qui attend de pouvoir être lancée. `inflight`
+    compte les traitements en cours dans le bassin de travailleurs;
+    plusieurs requêtes avec un `request_id` peuvent être en cours à la
+    fois, tandis qu'un traitement `exclusive` est seul en cours. `stream`
+    est la réponse en continu en cours de transmission. `bytes_in` et
+    `bytes_out` comptent les octets reçus et transmis sur la connexion.
+    `notify` indique si le client a demandé les avis de nouveaux courriels.
+    `address` est l'adresse IP du client, clé de sa limite de débit.
+    """
+
+    __slots__ = ("soc", "address", "inbound", "outbound", "codec", "compression", "requests",
+                 "pending", "inflight", "exclusive", "stream", "upload", "bytes_in",
+                 "bytes_out", "notify")
+
+    def __init__(self, soc: socket.socket, address: str = "",
+                 max_frame_size: int | None = None) -> None:
+        self.soc = soc
+        self.address = address
+        self.inbound = glosocket.FrameBuffer(max_frame_size)
+        self.outbound = bytearray()
+        self.codec = glocodec.JSON_CODEC
+        self.compression: str | None = None
+        self.requests: collections.deque[bytes] = collections.deque()
+        self.pending: gloutils.GloMessage | None = None
+        self.inflight = 0
+        self.exclusive = False
+        self.stream: Iterator[bytes] | None = None
+        self.upload: _Upload | None = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.notify = False
+
+
+class _Upload:
+    """
+    Courriel en cours de réception en continu (`EMAIL_STREAM_START`).
+
+    `size` compte les octets du corps reçus. Un envoi refusé (`error`) n'a
+    pas de fichier: ses morceaux sont ignorés et l'erreur est retournée à
+    `EMAIL_STREAM_END`, la seule requête de l'envoi à recevoir une réponse.
+    """
+
+    __slots__ = ("email", "recipient", "relayed", "target_dir", "temp_path", "file",
+                 "size", "error")
+
+    def __init__(self, email: gloutils.EmailContentPayload,
+                 recipient: str | None = None, target_dir: str | None = None,
+                 temp_path: str | None = None, relayed: bool = False) -> None:
+        self.email = email
+        self.recipient = recipient
+        self.relayed = relayed
+        self.target_dir = target_dir
+        self.temp_path = temp_path
+        self.file = open(temp_path, 'wb') if temp_path is not None else None
+        self.size = 0
+        self.error: str | None = None
+
+    def abort(self) -> None:
+        """Abandonne le transfert et supprime le fichier partiel."""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+    def refuse(self, error_message: str) -> None:
+        """Abandonne le transfert; `error_message` sera retourné à sa fin."""
+        self.abort()
+        if self.error is None:
+            self.error = error_message
+
+
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self,
+                 selector_factory: type[selectors.BaseSelector] = selectors.DefaultSelector,
+                 io_workers: int = 4, reuse_port: bool = False,
+                 store: glostorage.MailStore | None = None,
+                 hasher: gloauth.PasswordHasher | None = None,
+                 session_capacity: int = 4096,
+                 frame_cache_size: int = 64 * 1024 * 1024,
+                 user_refresh: float | None = None,
+                 compression: bool = True,
+                 port: int = gloutils.APP_PORT,
+                 domain: str = gloutils.SERVER_DOMAIN,
+                 relay: glorelay.RelayQueue | None = None,
+                 metrics: glometrics.Metrics | None = None,
+                 admins: Iterable[str] = (),
+                 idle_timeout: float | None = None,
+                 max_connections: int | None = None,
+                 max_frame_size: int | None = DEFAULT_MAX_FRAME_SIZE,
+                 max_upload_size: int | None = gloutils.MAX_UPLOAD_SIZE,
+                 user_limits: glolimit.TokenBuckets | None = None,
+                 ip_limits: glolimit.TokenBuckets | None = None) -> None:
         """
-        Prépare le socket du serveur `_server_socket`
-        et le met en mode écoute.
+        Prépare le socket du serveur `_server_socket` sur le port `port`
+        et le met en mode écoute. Avec `reuse_port`, plusieurs processus
+        peuvent écouter sur le même port (SO_REUSEPORT) et le noyau
+        répartit les connexions entre eux.
 
         Prépare les attributs suivants:
-        - `_client_socs` une liste des sockets clients.
+        - `_selector` le sélecteur de la boucle d'événements (epoll sous
+            Linux par défaut), remplaçable via `selector_factory`.
+        - `_client_socs` un dictionnaire associant chaque socket client
+            à l'état de sa connexion.
         - `_logged_users` un dictionnaire associant chaque
             socket client à un nom d'utilisateur.
+        - `_session_tokens` le jeton de session détenu par chaque socket
+            client connecté, révoqué à la déconnexion de l'utilisateur.
+        - `_session_lock` protège l'association d'un socket à une session
+            (`_logged_users`, `_session_tokens` et avis) contre la fermeture
+            de sa connexion par la boucle pendant une authentification.
+        - `_store` le stockage des courriels (`store`, par défaut un
+            glostorage.FileStore; voir aussi glostorage.SegmentStore),
+            dont les accès sont mesurés.
+        - `_users` le registre des comptes (dossier, empreinte du mot de
+            passe et index de la boîte), chargé au démarrage et rafraîchi
+            toutes les `user_refresh` secondes si demandé.
+        - `_hasher` la dérivation des mots de passe (`hasher`, par défaut
+            scrypt au coût de gloauth.DEFAULT_COSTS).
+        - `_sessions` le cache LRU d'au plus `session_capacity` jetons de
+            session et identifiants vérifiés, propre au processus.
+        - `_frames` le cache LRU des courriels déjà encodés pour
+            `INBOX_READING_CHOICE`, d'au plus `frame_cache_size` octets
+            (glocodec.FrameCache), ou None si la taille est nulle.
+        - `_executor` le bassin de `io_workers` fils qui exécutent les
+            traitements (accès disque, dérivation des mots de passe), ou
+            None pour les exécuter directement dans la boucle.
+        - `_completions` les traitements terminés, signalés à la boucle
+            par le socket `_waker`.
+        - `_compression` indique si la compression des trames peut être
+            négociée avec les clients.
+        - `_domain` le domaine des adresses livrées dans les boîtes locales.
+        - `_relay` la file des courriels à relayer vers les autres domaines,
+            ou None pour considérer ces envois comme des échecs.
+        - `_metrics` les mesures du serveur (`metrics`, par défaut de
+            nouvelles glometrics.Metrics).
+        - `_admins` les utilisateurs autorisés à consulter les mesures
+            (`METRICS_REQUEST`).
+        - `_async_clients` l'état des connexions du moteur asyncio, par
+            flux d'écriture.
+        - `_subscribers` les connexions qui ont demandé les avis de
+            nouveaux courriels (`EMAIL_NOTIFICATION`), par utilisateur
+            connecté, protégé par `_subscribers_lock`.
+        - `_notices` les avis à transmettre par la boucle `selectors`,
+            signalés comme les traitements terminés; le moteur asyncio les
+            reçoit par sa boucle `_loop`.
+        - `_idle` les échéances d'inactivité des connexions `selectors`:
+            une connexion inactive plus de `idle_timeout` secondes est
+            fermée (None pour les garder ouvertes).
+        - `_max_connections` le nombre de connexions simultanées au-delà
+            duquel les nouvelles sont fermées dès leur acceptation.
+        - `_max_frame_size` la taille maximale d'une trame reçue, refusée
+            sur son entête avant d'être lue (voir glosocket).
+        - `_max_upload_size` la taille maximale du corps d'un courriel
+            reçu en continu.
+        - `_user_limits` et `_ip_limits` les limites de débit des requêtes
+            par utilisateur connecté et par adresse IP (voir `_admit`).
 
         S'assure que les dossiers de données du serveur existent.
         """
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._server_socket.bind(("127.0.0.1", gloutils.APP_PORT))
         self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._server_socket.listen()
-        self._client_socs = []
+        if reuse_port:
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._server_socket.bind(("127.0.0.1", port))
+        self._server_socket.listen(socket.SOMAXCONN)
+        self._server_socket.setblocking(False)
+        self._selector = selector_factory()
+        self._selector.register(self._server_socket, selectors.EVENT_READ)
+        self._client_socs: dict[socket.socket, _Connection] = {}
         self._logged_users = {}
+        self._session_tokens: dict = {}
+        self._session_lock = threading.Lock()
+        self._metrics = metrics if metrics is not None else glometrics.Metrics()
+        self._admins = frozenset(admins)
+        self._store = glometrics.TimedStore(store if store is not None
+                                            else glostorage.FileStore(), self._metrics)
+        self._users = glostorage.UserRegistry(gloutils.SERVER_DATA_DIR, self._store.scan)
+        self._users.load()
+        if user_refresh:
+            self._users.start_polling(user_refresh)
+        self._hasher = hasher if hasher is not None else gloauth.PasswordHasher()
+        self._sessions = gloauth.SessionCache(session_capacity)
+        self._frames = (glocodec.FrameCache(frame_cache_size)
+                        if frame_cache_size > 0 else None)
+
+        self._executor = (concurrent.futures.ThreadPoolExecutor(io_workers)
+                          if io_workers > 0 else None)
+        self._completions: collections.deque = collections.deque()
+        self._compression = compression
+        self._domain = domain.lower()
+        self._relay = relay
+        self._async_clients: dict[asyncio.StreamWriter, _Connection] = {}
+        self._subscribers: dict[str, set[_Connection]] = {}
+        self._subscribers_lock = threading.Lock()
+        self._notices: collections.deque = collections.deque()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._idle_timeout = idle_timeout
+        self._idle = glolimit.IdleTimer(idle_timeout) if idle_timeout else None
+        self._max_connections = max_connections
+        self._max_frame_size = max_frame_size
+        self._max_upload_size = max_upload_size
+        self._user_limits = user_limits
+        self._ip_limits = ip_limits
+        self._waker, self._waker_signal = socket.socketpair()
+        self._waker.setblocking(False)
+        self._waker_signal.setblocking(False)
+        self._selector.register(self._waker, selectors.EVENT_READ)
 
     def cleanup(self) -> None:
-        """Ferme toutes les connexions résiduelles."""
-        for client_soc in self._client_socs:
+        """Ferme toutes les connexions résiduelles, puis le stockage."""
+        for client_soc in list(self._client_socs):
             self._remove_client(client_soc)
+        self._users.stop_polling()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._store.close()
+        self._selector.close()
+        self._waker.close()
+        self._waker_signal.close()
         self._server_socket.close()
 
     def _accept_client(self) -> None:
-        """Accepte un nouveau client."""
-        client_soc, _ = self._server_socket.accept()
-        self._client_socs.append(client_soc)
-        print("new Connection! now,", len(self._client_socs), "clients connected")
+        """
+        Accepte les nouveaux clients en attente. Au-delà de
+        `_max_connections` connexions, un client est fermé aussitôt.
+        """
+        while True:
+            try:
+                client_soc, address = self._server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            if (self._max_connections is not None
+                    and len(self._client_socs) >= self._max_connections):
+                client_soc.close()
+                self._metrics.rejected("connections")
+                continue
+            client_soc.setblocking(False)
+            connection = _Connection(client_soc, address[0], self._max_frame_size)
+            self._client_socs[client_soc] = connection
+            self._selector.register(client_soc, selectors.EVENT_READ, connection)
+            if self._idle is not None:
+                self._idle.add(connection)
+            self._metrics.connection_opened()
 
     def _remove_client(self, client_soc: socket.socket) -> None:
         """Retire le client des structures de données et ferme sa connexion."""
+        with self._session_lock:
+            connection = self._client_socs.pop(client_soc, None)
+            username = self._logged_users.pop(client_soc, None)
+            # Le jeton survit à la connexion: il sert justement à la reprendre.
+            self._session_tokens.pop(client_soc, None)
+            if connection is not None:
+                self._unsubscribe(connection, username)
+        if connection is not None:
+            if client_soc in self._selector.get_map():
+                self._selector.unregister(client_soc)
+            if connection.upload is not None and not connection.inflight:
+                connection.upload.abort()
+            if self._idle is not None:
+                self._idle.remove(connection)
         client_soc.close()
-        self._client_socs.remove(client_soc)
-        self._logged_users.pop(client_soc, None)
+
+    def _get_mailbox(self, username: str) -> glostorage.MailboxIndex:
+        """Retourne l'index de la boîte de l'utilisateur."""
+        return self._users.get(username).mailbox
+
+    def _usernames(self) -> list[str]:
+        """Retourne les noms des utilisateurs ayant une boîte."""
+        return self._users.usernames()
+
+    def rebuild_indexes(self) -> None:
+        """
+        Reconstruit l'index de chaque boîte à partir de ses fichiers, ainsi
+        que son index de recherche s'il a déjà été construit.
+        """
+        for username in self._usernames():
+            self._get_mailbox(username).rebuild()
+            user = self._users.get(username)
+            if user is not None and user.search.exists():
+                user.search.rebuild(self._search_documents(user))
+
+    def verify_stats(self) -> list[str]:
+        """
+        Vérifie les compteurs et l'index de chaque boîte par rapport au
+        disque, corrige ceux qui divergent et retourne leurs utilisateurs.
+        """
+        return [username for username in self._usernames()
+                if not self._get_mailbox(username).verify()]
+
+    def compact_mailboxes(self) -> int:
+        """
+        Récupère l'espace des courriels supprimés de chaque boîte et
+        retourne le nombre d'octets récupérés. L'index de recherche suit
+        les identifiants des courriels déplacés, tels que retournés par le
+        stockage.
+        """
+        reclaimed = 0
+        for username in self._usernames():
+            user_dir = os.path.join(gloutils.SERVER_DATA_DIR, username)
+            mailbox = self._get_mailbox(username)
+            freed, moved = self._store.compact(user_dir, mailbox)
+            reclaimed += freed
+            user = self._users.get(username)
+            if user is not None:
+                user.search.rename(moved)
+        if self._frames is not None:
+            self._frames.clear()
+        return reclaimed
 
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
@@ -74,191 +376,1405 @@ class Server:
         """
         username = payload['username']
         password = payload['password']
-        user_dir = os.path.join(gloutils.SERVER_DATA_DIR, username)
 
-        if os.path.exists(user_dir):
-            print("oops")
-            error_message = "La création a échouée:\n\t- Le nom d'utilisateur est invalide.\n\t- Le mot de passe n'est pas assez sûr."
-            error_payload: ErrorPayload = ErrorPayload(error_message=error_message)
-            return GloMessage(header=Headers.ERROR, payload=error_payload)
-        else:
-            os.makedirs(user_dir)
+        # Stockage sécurisé du mot de passe, dérivé seulement si le nom est libre
+        if (self._users.get(username) is None
+                and self._users.create(username, self._hasher.hash(password)) is not None):
+            return self._open_session(client_soc, username)
 
-            # Stockage sécurisé du mot de passe
-            hashed_password = hashlib.sha256(password.encode()).hexdigest()
-            with open(os.path.join(user_dir, PASSWORD_FILENAME), 'w') as f:
-                f.write(hashed_password)
-
-            self._logged_users[client_soc] = username
-            return GloMessage(header=Headers.OK)
+        error_message = "La création a échouée:\n\t- Le nom d'utilisateur est invalide.\n\t- Le mot de passe n'est pas assez sûr."
+        error_payload: ErrorPayload = ErrorPayload(error_message=error_message)
+        return GloMessage(header=Headers.ERROR, payload=error_payload)
 
     def _login(self, client_soc: socket.socket, payload: gloutils.AuthPayload) -> gloutils.GloMessage:
         """
         Vérifie que les données fournies correspondent à un compte existant.
 
         Si les identifiants sont valides, associe le socket à l'utilisateur et
-        retourne un succès, sinon retourne un message d'erreur.
+        retourne un succès avec un jeton de session, sinon retourne un
+        message d'erreur.
+
+        Les identifiants déjà vérifiés contre la même empreinte sont acceptés
+        sans nouvelle dérivation; une empreinte d'un format ou d'un coût
+        périmé est recalculée au coût courant.
         """
         username = payload['username']
         password = payload['password']
-        user_dir = os.path.join(gloutils.SERVER_DATA_DIR, username)
 
-        authenticated = False
-        if os.path.exists(user_dir):
-            with open(os.path.join(user_dir, PASSWORD_FILENAME), 'r') as f:
-                stored_password_hash = f.read()
-            hashed_password = hashlib.sha256(password.encode()).hexdigest()
-            resultat = hmac.compare_digest(hashed_password, stored_password_hash)
-
-            if resultat:
-                authenticated = True
-                self._logged_users[client_soc] = username
-                return GloMessage(header=Headers.OK)
-
-        if not authenticated:
-            error_message = "Nom d'utilisateur ou mot de passe invalide."
-            error_payload: ErrorPayload = ErrorPayload(error_message=error_message)
+        user = self._users.get(username)
+        if user is not None:
+            stored_password_hash = user.password_hash
+            if self._sessions.check(username, password, stored_password_hash):
+                return self._open_session(client_soc, username)
+            if self._hasher.verify(password, stored_password_hash):
+                if self._hasher.needs_upgrade(stored_password_hash):
+                    stored_password_hash = self._hasher.hash(password)
+                    self._users.set_password(username, stored_password_hash)
+                self._sessions.remember(username, password, stored_password_hash)
+                return self._open_session(client_soc, username)
+
+        error_message = "Nom d'utilisateur ou mot de passe invalide."
+        error_payload: ErrorPayload = ErrorPayload(error_message=error_message)
+        return GloMessage(header=Headers.ERROR, payload=error_payload)
+
+    def _resume(self, client_soc: socket.socket,
+                payload: gloutils.SessionPayload) -> gloutils.GloMessage:
+        """
+        Reprend une session à partir d'un jeton émis par ce processus, sans
+        dériver le mot de passe.
+        """
+        username = self._sessions.resume(payload['token'])
+        if username is None:
+            error_payload = ErrorPayload(error_message="Session expirée.")
             return GloMessage(header=Headers.ERROR, payload=error_payload)
+        self._set_user(client_soc, username, payload['token'])
+        return GloMessage(header=Headers.OK)
+
+    def _open_session(self, client_soc: socket.socket, username: str) -> gloutils.GloMessage:
+        """Associe le socket à l'utilisateur et lui émet un jeton de session."""
+        token = self._sessions.issue(username)
+        if not self._set_user(client_soc, username, token):
+            self._sessions.revoke(token)
+        return GloMessage(header=Headers.OK, payload=SessionPayload(token=token))
+
+    def _set_user(self, client_soc: socket.socket, username: str, token: str) -> bool:
+        """
+        Associe le socket à l'utilisateur et au jeton de session, et révoque
+        le jeton qu'il détenait auparavant: une nouvelle connexion sur le
+        même socket remplace l'ancienne session. Si la connexion a demandé
+        les avis de nouveaux courriels, l'inscrit à ceux de l'utilisateur.
+
+        Exécuté dans le bassin de travailleurs: si la boucle a déjà fermé
+        la connexion, rien n'est associé et False est retourné.
+        """
+        with self._session_lock:
+            connection = self._client_socs.get(client_soc) or self._async_clients.get(client_soc)
+            if connection is None:
+                return False
+            previous = self._logged_users.get(client_soc)
+            self._logged_users[client_soc] = username
+            previous_token = self._session_tokens.get(client_soc)
+            self._session_tokens[client_soc] = token
+            if connection.notify:
+                self._unsubscribe(connection, previous)
+                with self._subscribers_lock:
+                    self._subscribers.setdefault(username, set()).add(connection)
+        if previous_token is not None and previous_token != token:
+            self._sessions.revoke(previous_token)
+        return True
+
+    def _unsubscribe(self, connection: _Connection, username: str | None) -> None:
+        """Retire la connexion des avis de nouveaux courriels de l'utilisateur."""
+        if username is None or not connection.notify:
+            return
+        with self._subscribers_lock:
+            subscribers = self._subscribers.get(username)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self._subscribers[username]
+
+    def _notify(self, recipient: glostorage.UserRecord,
+                entries: list[glostorage.IndexEntry]) -> None:
+        """
+        Transmet un avis `EMAIL_NOTIFICATION` des courriels livrés aux
+        connexions de l'utilisateur qui l'ont demandé. L'avis est encodé
+        une fois par encodage et compression, puis confié à la boucle de
+        chaque connexion (voir `_post_notice`).
+        """
+        with self._subscribers_lock:
+            connections = list(self._subscribers.get(recipient.username, ()))
+        if not connections:
+            return
+        payload = NotificationPayload(email_list=_format_subjects(entries[::-1], 1),
+                                      total=recipient.mailbox.count())
+        message = GloMessage(header=Headers.EMAIL_NOTIFICATION, payload=payload)
+        frames: dict[tuple[str, str | None], bytes] = {}
+        for connection in connections:
+            key = (connection.codec, connection.compression)
+            if key not in frames:
+                frames[key] = glosocket.frame_bytes(glocodec.encode(message, connection.codec),
+                                                    connection.compression)
+            self._post_notice(connection, frames[key])
+
+    def _post_notice(self, connection: _Connection, data: bytes) -> None:
+        """Confie une trame d'avis à la boucle qui gère la connexion (tout fil)."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._send_notice_async, connection, data)
+            return
+        self._notices.append((connection, data))
+        self._wake()
+
+    def _send_notice(self, connection: _Connection, data: bytes) -> None:
+        """
+        Ajoute une trame d'avis au tampon de sortie de la connexion, entre
+        deux trames de réponse. L'avis est abandonné si le tampon dépasse
+        déjà _MAX_NOTICE_BACKLOG octets: un client qui ne lit pas ne fait
+        ni grossir la mémoire ni attendre la boucle.
+        """
+        if connection.soc not in self._client_socs:
+            return
+        if len(connection.outbound) >= _MAX_NOTICE_BACKLOG:
+            self._metrics.notification(dropped=True)
+            return
+        connection.outbound += data
+        self._metrics.notification()
+        self._flush_client(connection)
+
+    def _send_notice_async(self, connection: _Connection, data: bytes) -> None:
+        """Équivalent de `_send_notice` pour le moteur asyncio."""
+        writer = connection.soc
+        if writer not in self._async_clients or writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() >= _MAX_NOTICE_BACKLOG:
+            self._metrics.notification(dropped=True)
+            return
+        writer.write(data)
+        connection.bytes_out += len(data)
+        self._metrics.transfer(sent=len(data))
+        self._metrics.notification()
 
     def _logout(self, client_soc: socket.socket) -> None:
-        """Déconnecte un utilisateur."""
+        """
+        Déconnecte un utilisateur: le socket n'est plus associé à
+        l'utilisateur ni à ses avis de nouveaux courriels, et son jeton de
+        session est révoqué pour qu'il ne puisse plus être repris.
+        """
+        with self._session_lock:
+            token = self._session_tokens.pop(client_soc, None)
+            username = self._logged_users.pop(client_soc, None)
+            connection = self._client_socs.get(client_soc) or self._async_clients.get(client_soc)
+            if connection is not None:
+                self._unsubscribe(connection, username)
+        if token is not None:
+            self._sessions.revoke(token)
 
-    def _get_email_list(self, client_soc: socket.socket) -> gloutils.GloMessage:
+    def _get_email_list(self, client_soc: socket.socket,
+                        payload: gloutils.EmailListRequestPayload | None = None
+                        ) -> gloutils.GloMessage:
         """
         Récupère la liste des courriels de l'utilisateur associé au socket.
         Les éléments de la liste sont construits à l'aide du gabarit
         SUBJECT_DISPLAY et sont ordonnés du plus récent au plus ancien.
 
+        La liste est construite à partir de l'index de la boîte, sans
+        ouvrir les fichiers des courriels. Si un payload est fourni, seule
+        la page demandée est lue et retournée dans un `EmailPagePayload`;
+        les numéros affichés restent relatifs au courriel le plus récent.
+
         Une absence de courriel n'est pas une erreur, mais une liste vide.
         """
         username = self._logged_users.get(client_soc)
-        user_dir = os.path.join(gloutils.SERVER_DATA_DIR, username)
-        email_list = []
+        mailbox = self._get_mailbox(username)
 
-        number = 1
-        for email_file in sorted(os.listdir(user_dir), reverse=True):
-            with open(os.path.join(user_dir, email_file), 'r') as file:
-                email_content = file.read()
-                # "#{number} {sender} - {subject} {date}"
-                sender = email_content["sender"]
-                subject = email_content["subject"]
-                date = email_content["date"]
-                print(email_content)
-                email_list.append(SUBJECT_DISPLAY.format(number=number, subject=subject, sender=sender, date=date))
-                number += 1
+        if payload is None:
+            entries = mailbox.entries()
+            entries.reverse()
+            email_list_payload: EmailListPayload = EmailListPayload(
+                email_list=_format_subjects(entries, 1))
+            return GloMessage(header=Headers.OK, payload=email_list_payload)
 
-        email_list_payload: EmailListPayload = EmailListPayload(email_list=email_list)
-        return GloMessage(header=Headers.OK, payload=email_list_payload)
+        offset = max(0, int(payload.get("offset", 0)))
+        limit = min(max(1, int(payload.get("limit", gloutils.INBOX_PAGE_SIZE))),
+                    gloutils.INBOX_MAX_PAGE_SIZE)
+        entries, total = mailbox.page(offset, limit)
+        page_payload = EmailPagePayload(email_list=_format_subjects(entries, offset + 1),
+                                        offset=offset, total=total)
+        return GloMessage(header=Headers.OK, payload=page_payload)
 
-    def _get_email(self, client_soc: socket.socket,
-                   payload: gloutils.EmailChoicePayload) -> gloutils.GloMessage:
+    def _get_email(self, connection: _Connection,
+                   payload: gloutils.EmailChoicePayload
+                   ) -> tuple[gloutils.GloMessage | None, bytes]:
         """
         Récupère le contenu de l'email dans le dossier de l'utilisateur associé
-        au socket.
+        au socket et retourne la réponse et son encodage pour la connexion.
+
+        Le choix correspond au numéro affiché dans la liste des courriels.
+
+        La réponse encodée est conservée dans `_frames`: une relecture du
+        même courriel ne lit ni ne décode le fichier et n'est pas réencodée,
+        et la réponse retournée est alors None.
+        """
+        username = self._logged_users.get(connection.soc)
+        user_dir = os.path.join(gloutils.SERVER_DATA_DIR, username)
+        entries, _ = self._get_mailbox(username).page(payload["choice"] - 1, 1)
+
+        if payload["choice"] < 1 or not entries:
+            error_payload = ErrorPayload(error_message="Courriel inexistant.")
+            answer = GloMessage(header=Headers.ERROR, payload=error_payload)
+            return answer, glocodec.encode(answer, connection.codec)
+
+        key = (username, entries[0]["id"], connection.codec)
+        if self._frames is not None:
+            data = self._frames.get(key)
+            if data is not None:
+                return None, data
+        email_content = self._store.load(user_dir, entries[0]["id"])
+        answer = GloMessage(header=Headers.OK, payload=email_content)
+        data = glocodec.encode(answer, connection.codec)
+        if self._frames is not None:
+            self._frames.put(key, data)
+        return answer, data
+
+    def _get_email_stream(self, client_soc: socket.socket,
+                          payload: gloutils.EmailChoicePayload
+                          ) -> Iterator[gloutils.GloMessage]:
+        """
+        Transmet le courriel choisi en continu: `EMAIL_STREAM_START` avec
+        le courriel sans contenu, puis le corps en `EMAIL_CHUNK` d'au plus
+        STREAM_CHUNK_SIZE octets lus au fur et à mesure, puis
+        `EMAIL_STREAM_END`.
+        """
+        username = self._logged_users.get(client_soc)
+        user_dir = os.path.join(gloutils.SERVER_DATA_DIR, username)
+        entries, _ = self._get_mailbox(username).page(payload["choice"] - 1, 1)
+
+        if payload["choice"] < 1 or not entries:
+            error_payload = ErrorPayload(error_message="Courriel inexistant.")
+            yield GloMessage(header=Headers.ERROR, payload=error_payload)
+            return
+
+        message_id = entries[0]["id"]
+        email_content, _ = self._store.load_header(user_dir, message_id)
+        yield GloMessage(header=Headers.EMAIL_STREAM_START, payload=email_content)
+
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for data in self._store.iter_body(user_dir, message_id, gloutils.STREAM_CHUNK_SIZE):
+            chunk = decoder.decode(data)
+            if chunk:
+                yield GloMessage(header=Headers.EMAIL_CHUNK,
+                                 payload=EmailChunkPayload(data=chunk))
+        yield GloMessage(header=Headers.EMAIL_STREAM_END)
+
+    def _delete_email(self, client_soc: socket.socket,
+                      payload: gloutils.EmailChoicePayload) -> gloutils.GloMessage:
+        """
+        Supprime le courriel choisi de la boîte de l'utilisateur associé
+        au socket. Le choix correspond au numéro affiché dans la liste.
         """
         username = self._logged_users.get(client_soc)
         user_dir = os.path.join(gloutils.SERVER_DATA_DIR, username)
-        email_file = payload["choice"]
+        mailbox = self._get_mailbox(username)
+        entries, _ = mailbox.page(payload["choice"] - 1, 1)
+
+        if payload["choice"] < 1 or not entries:
+            error_payload = ErrorPayload(error_message="Courriel inexistant.")
+            return GloMessage(header=Headers.ERROR, payload=error_payload)
 
-        with open(os.path.join(user_dir, email_file), 'r') as file:
-            email_content = json.load(file)
+        if mailbox.remove(entries[0]["id"]) is not None:
+            self._store.delete(user_dir, entries[0]["id"])
+            self._forget_frames(username, [entries[0]["id"]])
+            self._users.get(username).search.remove(entries[0]["id"])
+        return GloMessage(header=Headers.OK)
+
+    def _forget_frames(self, username: str, message_ids: list[str]) -> None:
+        """
+        Retire du cache les réponses encodées de courriels livrés ou
+        supprimés: un identifiant libéré peut être réattribué par le
+        stockage (voir glostorage.SegmentStore.compact).
+        """
+        if self._frames is not None:
+            self._frames.invalidate(username, message_ids)
+
+    def _search(self, client_soc: socket.socket,
+                payload: gloutils.SearchPayload) -> gloutils.GloMessage:
+        """
+        Cherche dans la boîte de l'utilisateur associé au socket les
+        courriels qui contiennent tous les mots de la requête, et retourne
+        la page demandée des résultats, du plus pertinent au moins
+        pertinent, dans un `EmailPagePayload`.
+
+        Les numéros affichés sont ceux de la liste des courriels, à donner
+        avec `INBOX_READING_CHOICE`. L'index de recherche de la boîte est
+        construit à la première recherche, puis tenu à jour à chaque
+        livraison et suppression.
+        """
+        username = self._logged_users.get(client_soc)
+        user = self._users.get(username)
+        mailbox = user.mailbox
+        offset = max(0, int(payload.get("offset", 0)))
+        limit = min(max(1, int(payload.get("limit", gloutils.INBOX_PAGE_SIZE))),
+                    gloutils.INBOX_MAX_PAGE_SIZE)
+
+        user.search.ensure(lambda: self._search_documents(user))
+        message_ids, total = user.search.search(payload["query"], offset, limit)
+        positions = mailbox.positions(message_ids)
+        count = mailbox.count()
+        email_list = []
+        for message_id in message_ids:
+            position = positions.get(message_id)
+            if position is None:
+                continue
+            entries, _ = mailbox.page(count - 1 - position, 1)
+            if entries and entries[0]["id"] == message_id:
+                email_list.extend(_format_subjects(entries, count - position))
+        page_payload = EmailPagePayload(email_list=email_list, offset=offset, total=total)
+        return GloMessage(header=Headers.OK, payload=page_payload)
+
+    def _search_documents(self, user: glostorage.UserRecord
+                          ) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        """Parcourt les courriels de la boîte pour construire son index de recherche."""
+        for entry in user.mailbox.entries():
+            try:
+                yield entry["id"], self._store.load(user.user_dir, entry["id"])
+            except (OSError, KeyError, ValueError):
+                continue
 
     def _get_stats(self, client_soc: socket.socket) -> gloutils.GloMessage:
         """
         Récupère le nombre de courriels et la taille du dossier et des fichiers
         de l'utilisateur associé au socket.
+
+        Les valeurs proviennent des compteurs tenus à jour par l'index de la
+        boîte; la réponse ne dépend donc pas de la taille de la boîte.
         """
-        return gloutils.GloMessage()
+        username = self._logged_users.get(client_soc)
+        count, size = self._get_mailbox(username).stats()
+        return GloMessage(header=Headers.OK, payload=StatsPayload(count=count, size=size))
 
-    def _send_email(self, payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
+    def _get_metrics(self, client_soc: socket.socket) -> gloutils.GloMessage:
+        """Retourne les mesures du serveur si l'utilisateur est administrateur."""
+        if self._logged_users.get(client_soc) not in self._admins:
+            error_payload = ErrorPayload(error_message="Accès refusé.")
+            return GloMessage(header=Headers.ERROR, payload=error_payload)
+        return GloMessage(header=Headers.OK, payload=MetricsPayload(metrics=self.metrics()))
+
+    def metrics(self) -> dict:
+        """
+        Retourne un instantané des mesures du serveur, complété par l'état
+        courant: connexions ouvertes, utilisateurs connectés, courriels en
+        attente de relais, compteurs du cache des courriels encodés et les
+        _TOP_CONNECTIONS connexions qui ont échangé le plus d'octets.
+        """
+        snapshot = self._metrics.snapshot()
+        connections = [*self._client_socs.values(), *self._async_clients.values()]
+        connections.sort(key=lambda connection: connection.bytes_in + connection.bytes_out,
+                         reverse=True)
+        snapshot["connections_open"] = len(connections)
+        snapshot["users_logged"] = len(self._logged_users)
+        snapshot["relay_pending"] = self._relay.pending() if self._relay is not None else 0
+        snapshot["frame_cache"] = self._frames.stats() if self._frames is not None else None
+        snapshot["top_connections"] = [
+            {"user": self._logged_users.get(connection.soc),
+             "bytes_in": connection.bytes_in, "bytes_out": connection.bytes_out}
+            for connection in connections[:_TOP_CONNECTIONS]]
+        return snapshot
+
+    def _recipient(self, destination: str
+                   ) -> tuple[glostorage.UserRecord | None, str | None]:
+        """
+        Retourne le compte du destinataire s'il existe sur ce serveur, et
+        le domaine de l'adresse, ou None si elle n'a pas pu être analysée.
+        """
+        address_match = _ADDRESS_PATTERN.fullmatch(destination.strip())
+        if address_match is None:
+            return None, None
+        username, domain = address_match.groups()
+        domain = domain.lower()
+        if domain != self._domain:
+            return None, domain
+        return self._users.get(username), domain
+
+    def _send_email(self, client_soc: socket.socket,
+                    payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
         """
         Détermine si l'envoi est interne ou externe et:
         - Si l'envoi est interne, écris le message tel quel dans le dossier
-        du destinataire.
+        du destinataire, sous un identifiant unique.
         - Si le destinataire n'existe pas, place le message dans le dossier
         SERVER_LOST_DIR et considère l'envoi comme un échec.
-        - Si le destinataire est externe, considère l'envoi comme un échec.
+        - Si le destinataire est externe, confie le message à la file de
+        relais lorsque l'expéditeur est connecté, sinon considère l'envoi
+        comme un échec.
 
         Retourne un messange indiquant le succès ou l'échec de l'opération.
+        Si `destination` est une liste d'adresses, la réponse porte plutôt
+        le statut de chaque destinataire (DeliveryPayload).
         """
+        statuses = self._deliver([payload], client_soc in self._logged_users)
+        if not isinstance(payload["destination"], str):
+            return GloMessage(header=Headers.OK, payload=DeliveryPayload(statuses=statuses))
+        if statuses[0]["delivered"]:
+            return GloMessage(header=Headers.OK)
+
+        # Retourne un messange indiquant le succès ou l'échec de l'opération
+        error_message = "Échec de l'envoi du courriel"
+        error_payload: ErrorPayload = ErrorPayload(error_message=error_message)
+        return GloMessage(header=Headers.ERROR, payload=error_payload)
 
-        recipient_pattern = r'([^@]+)@'
-        domain_pattern = r'@([^@]+)$'
-        recipient = re.search(recipient_pattern, payload["destination"]).group(1)
-        domain = re.search(domain_pattern, payload["destination"]).group(1)
-
-        found_recipient = False
-
-        if domain:
-            recipient_dir = os.path.join(gloutils.SERVER_DATA_DIR, recipient)
-            if os.path.exists(recipient_dir):
-                found_recipient = True
-                email_file = os.path.join(recipient_dir, f"{payload['subject']}.json")
-                with open(email_file, 'w') as file:
-                    json.dump(dict(payload), file)
-                return GloMessage(header=Headers.OK)
-
-        if not found_recipient:
-            if domain:
-                lost_dir = os.path.join(gloutils.SERVER_LOST_DIR, f"{payload['subject']}.json")
-                with open(lost_dir, 'w') as file:
-                    json.dump(dict(payload), file, indent=2)
-            # Retourne un messange indiquant le succès ou l'échec de l'opération
-            error_message = "Échec de l'envoi du courriel"
-            error_payload: ErrorPayload = ErrorPayload(error_message=error_message)
+    def _send_batch(self, client_soc: socket.socket,
+                    payload: gloutils.EmailBatchPayload) -> gloutils.GloMessage:
+        """
+        Livre tous les courriels d'un `EMAIL_SENDING_BATCH` et retourne le
+        statut de chaque destinataire.
+        """
+        statuses = self._deliver(payload["emails"], client_soc in self._logged_users)
+        return GloMessage(header=Headers.OK, payload=DeliveryPayload(statuses=statuses))
+
+    def _can_relay(self, domain: str | None, authenticated: bool) -> bool:
+        """
+        Indique si un courriel vers `domain` doit être relayé. Seuls les
+        utilisateurs connectés peuvent faire relayer un courriel, pour que
+        le serveur ne relaie pas pour n'importe qui (les serveurs distants
+        livrent sans connexion).
+        """
+        return (self._relay is not None and authenticated
+                and domain is not None and domain != self._domain)
+
+    def _deliver(self, emails: list[gloutils.EmailContentPayload],
+                 authenticated: bool = False) -> list[gloutils.DeliveryStatus]:
+        """
+        Livre chaque courriel à chacun de ses destinataires, une seule fois
+        par adresse, puis ajoute les livraisons à l'index et à l'index de
+        recherche de chaque boîte en une écriture, et en avise les
+        connexions du destinataire (voir `_notify`). Les courriels vers d'autres domaines sont mis dans
+        la file de relais (voir `_can_relay`) et comptent comme livrés; ceux
+        aux destinataires inconnus sont placés dans SERVER_LOST_DIR.
+        """
+        statuses: list[gloutils.DeliveryStatus] = []
+        deliveries: dict[str, tuple[glostorage.UserRecord, list]] = {}
+        for email_content in emails:
+            destination = email_content["destination"]
+            addresses = [destination] if isinstance(destination, str) else destination
+            stored = EmailContentPayload(email_content, destination=", ".join(addresses))
+            for address in dict.fromkeys(addresses):
+                recipient, domain = self._recipient(address)
+                delivered = recipient is not None
+                if recipient is not None:
+                    message_id, size = self._store.deliver(recipient.user_dir, stored)
+                    _, pending = deliveries.setdefault(recipient.username, (recipient, []))
+                    pending.append((message_id, stored, size))
+                elif self._can_relay(domain, authenticated):
+                    self._relay.enqueue(stored, address.strip())
+                    delivered = True
+                elif domain is not None:
+                    self._store.deliver(gloutils.SERVER_LOST_DIR, stored)
+                statuses.append(DeliveryStatus(destination=address, delivered=delivered))
+        for recipient, pending in deliveries.values():
+            entries = recipient.mailbox.add_many(pending)
+            self._forget_frames(recipient.username,
+                                [message_id for message_id, _, _ in pending])
+            recipient.search.add([(message_id, stored) for message_id, stored, _ in pending])
+            self._notify(recipient, entries)
+        return statuses
+
+    def _start_upload(self, connection: _Connection,
+                      payload: gloutils.EmailContentPayload) -> None:
+        """
+        Commence la réception en continu d'un courriel. Le corps est écrit
+        dans un fichier temporaire du dossier de destination à mesure que
+        les morceaux arrivent (voir `_receive_chunk`).
+
+        Un envoi en continu a un seul destinataire et demande un expéditeur
+        connecté. Il est refusé d'emblée si le destinataire est inconnu de
+        ce serveur et ne peut pas être relayé: son corps n'est pas reçu.
+        """
+        if connection.upload is not None:
+            connection.upload.abort()
+        connection.upload = _Upload(payload)
+        if connection.soc not in self._logged_users:
+            connection.upload.refuse("Vous devez être connecté pour envoyer un courriel.")
+            return
+        destination = payload["destination"]
+        if not isinstance(destination, str):
+            connection.upload.refuse("Échec de l'envoi du courriel")
+            return
+        recipient, domain = self._recipient(destination)
+        if recipient is not None:
+            connection.upload = _Upload(payload, recipient.username, recipient.user_dir,
+                                        self._store.body_temp_path(recipient.user_dir))
+        elif self._can_relay(domain, True):
+            connection.upload = _Upload(
+                payload, None, gloutils.SERVER_LOST_DIR,
+                self._store.body_temp_path(gloutils.SERVER_LOST_DIR), relayed=True)
+        else:
+            connection.upload.refuse("Échec de l'envoi du courriel")
+
+    def _receive_chunk(self, connection: _Connection, data: str) -> None:
+        """
+        Écrit un morceau du corps de l'envoi en continu en cours. L'envoi
+        est refusé si son corps dépasse `_max_upload_size` octets.
+        """
+        upload = connection.upload
+        if upload is None or upload.file is None:
+            return
+        encoded = data.encode('utf-8')
+        upload.size += len(encoded)
+        if self._max_upload_size is not None and upload.size > self._max_upload_size:
+            self._metrics.rejected("upload_size")
+            upload.refuse("Le courriel est trop volumineux.")
+            return
+        upload.file.write(encoded)
+
+    def _finish_upload(self, connection: _Connection) -> gloutils.GloMessage:
+        """
+        Termine la réception en continu: le corps reçu est confié au
+        stockage avec le courriel, qui est indexé comme par `_send_email`,
+        ou à la file de relais avec le courriel complet.
+        """
+        upload = connection.upload
+        connection.upload = None
+        if upload is None or upload.error is not None:
+            error_message = upload.error if upload is not None else "Aucun envoi en cours."
+            error_payload = ErrorPayload(error_message=error_message)
             return GloMessage(header=Headers.ERROR, payload=error_payload)
 
+        upload.file.close()
+        if upload.relayed:
+            with open(upload.temp_path, 'rb') as file:
+                content = file.read().decode('utf-8')
+            self._relay.enqueue(EmailContentPayload(upload.email, content=content),
+                                upload.email["destination"].strip())
+            os.remove(upload.temp_path)
+            return GloMessage(header=Headers.OK)
+
+        message_id, size = self._store.deliver(upload.target_dir, upload.email,
+                                               body_path=upload.temp_path)
+        recipient = self._users.get(upload.recipient)
+        entry = recipient.mailbox.add(message_id, upload.email, size)
+        self._forget_frames(upload.recipient, [message_id])
+        if recipient.search.exists():
+            recipient.search.add([(message_id,
+                                   self._store.load(upload.target_dir, message_id))])
+        self._notify(recipient, [entry])
+        return GloMessage(header=Headers.OK)
+
+    def _dispatch(self, client_soc: socket.socket,
+                  message: dict) -> gloutils.GloMessage | None:
+        """
+        Appelle le traitement correspondant à l'entête du message.
+
+        Retourne la réponse à transmettre au client, ou None si
+        la requête n'appelle pas de réponse.
+        """
+        match message:
+            case {"header": Headers.AUTH_REGISTER, "payload": payload}:
+                return self._create_account(client_soc, payload)
+            case {"header": Headers.AUTH_LOGIN, "payload": payload}:
+                return self._login(client_soc, payload)
+            case {"header": Headers.AUTH_RESUME, "payload": payload}:
+                return self._resume(client_soc, payload)
+            case {"header": Headers.AUTH_LOGOUT}:
+                return self._logout(client_soc)
+            case {"header": Headers.INBOX_READING_REQUEST, "payload": payload}:
+                return self._get_email_list(client_soc, payload)
+            case {"header": Headers.INBOX_READING_REQUEST}:
+                return self._get_email_list(client_soc)
+            case {"header": Headers.EMAIL_SENDING, "payload": payload}:
+                return self._send_email(client_soc, payload)
+            case {"header": Headers.EMAIL_SENDING_BATCH, "payload": payload}:
+                return self._send_batch(client_soc, payload)
+            case {"header": Headers.EMAIL_DELETE, "payload": payload}:
+                return self._delete_email(client_soc, payload)
+            case {"header": Headers.STATS_REQUEST}:
+                return self._get_stats(client_soc)
+            case {"header": Headers.INBOX_SEARCH, "payload": payload}:
+                return self._search(client_soc, payload)
+            case {"header": Headers.METRICS_REQUEST}:
+                return self._get_metrics(client_soc)
+        return None
+
+    def _hello(self, connection: _Connection,
+               payload: gloutils.HelloPayload) -> gloutils.GloMessage:
+        """
+        Négocie l'encodage et la compression de la connexion parmi ceux
+        offerts par le client.
+
+        La réponse est encore encodée en JSON, sans compression; les choix
+        retenus s'appliquent aux messages suivants dans les deux sens.
+
+        Une demande d'avis de nouveaux courriels (`notify`) est acceptée et
+        prend effet à l'authentification.
+        """
+        codec = glocodec.negotiate(payload.get("codecs", []))
+        answer = HelloPayload(codecs=[codec])
+        if payload.get("notify"):
+            connection.notify = True
+            answer["notify"] = True
+        if "compression" in payload:
+            compression = (glosocket.negotiate_compression(payload["compression"])
+                           if self._compression else None)
+            answer["compression"] = [compression] if compression else []
+        return GloMessage(header=Headers.OK, payload=answer)
+
+    def _admit(self, connection: _Connection,
+               message: gloutils.GloMessage) -> tuple[gloutils.GloMessage, ...] | None:
+        """
+        Applique les limites de débit à une requête avant son traitement:
+        elle consomme des jetons de l'adresse IP du client et, s'il est
+        connecté, de l'utilisateur. Retourne None si la requête est admise,
+        sinon les réponses à transmettre à sa place.
+
+        Les requêtes de _UNLIMITED_HEADERS ne sont pas comptées. Un morceau
+        d'envoi en continu coûte selon sa taille, un STREAM_CHUNK_SIZE
+        valant une requête. Le début ou un morceau d'un envoi refusé ne
+        reçoit pas de réponse, pour que le client reste synchronisé:
+        l'envoi est abandonné et l'erreur est retournée à sa fin.
+        """
+        header = message.get("header")
+        if header in _UNLIMITED_HEADERS:
+            return None
+        cost = 1.0
+        match message:
+            case {"header": Headers.EMAIL_CHUNK, "payload": {"data": str() as data}}:
+                cost = max(1, len(data)) / gloutils.STREAM_CHUNK_SIZE
+        username = self._logged_users.get(connection.soc)
+        if (self._ip_limits is not None
+                and not self._ip_limits.allow(connection.address, cost)):
+            self._metrics.rejected("ip_rate")
+        elif (self._user_limits is not None and username is not None
+              and not self._user_limits.allow(username, cost)):
+            self._metrics.rejected("user_rate")
+        else:
+            return None
+        error_message = "Trop de requêtes, réessayez plus tard."
+        if header == Headers.EMAIL_STREAM_START:
+            if connection.upload is not None:
+                connection.upload.abort()
+            connection.upload = _Upload(message.get("payload"))
+            connection.upload.refuse(error_message)
+            return ()
+        if header == Headers.EMAIL_CHUNK:
+            if connection.upload is not None:
+                connection.upload.refuse(error_message)
+            return ()
+        if header == Headers.EMAIL_STREAM_END and connection.upload is not None:
+            connection.upload.abort()
+            connection.upload = None
+        answer = GloMessage(header=Headers.ERROR, payload=ErrorPayload(
+            error_message=error_message))
+        if "request_id" in message:
+            answer["request_id"] = message["request_id"]
+        return (answer,)
+
+    def _handle_message(self, connection: _Connection,
+                        message: gloutils.GloMessage) -> Iterable[bytes]:
+        """
+        Traite une requête et retourne les trames de réponse encodées. Les
+        réponses en continu sont produites paresseusement, au rythme où
+        elles sont consommées. Le `request_id` de la requête, s'il y en a
+        un, est recopié dans chaque réponse.
+
+        Les requêtes de _AUTHENTICATED_HEADERS reçoivent une erreur si
+        aucun utilisateur n'est connecté sur la connexion.
+
+        La durée du traitement est mesurée par entête; pour une réponse en
+        continu, seule sa préparation l'est.
+        """
+        codec = connection.codec
+        request_id = message.get("request_id")
+        start = time.perf_counter()
+        answer = None
+
+        def encode(answer: gloutils.GloMessage) -> bytes:
+            if request_id is not None:
+                answer["request_id"] = request_id
+            return glocodec.encode(answer, codec)
+
+        match message:
+            case {"header": header} if (header in _AUTHENTICATED_HEADERS
+                                        and connection.soc not in self._logged_users):
+                answer = GloMessage(header=Headers.ERROR, payload=ErrorPayload(
+                    error_message="Vous devez être connecté."))
+                answers = (encode(answer),)
+            case {"header": Headers.HELLO, "payload": payload}:
+                answer = self._hello(connection, payload)
+                answers = (encode(answer),)
+                connection.codec = answer["payload"]["codecs"][0]
+                connection.compression = next(iter(answer["payload"].get("compression", [])), None)
+            case {"header": Headers.EMAIL_STREAM_START, "payload": payload}:
+                self._start_upload(connection, payload)
+                answers = ()
+            case {"header": Headers.EMAIL_CHUNK, "payload": {"data": data}}:
+                self._receive_chunk(connection, data)
+                answers = ()
+            case {"header": Headers.EMAIL_STREAM_END}:
+                answer = self._finish_upload(connection)
+                answers = (encode(answer),)
+            case {"header": Headers.INBOX_READING_STREAM, "payload": payload}:
+                answers = (encode(answer)
+                           for answer in self._get_email_stream(connection.soc, payload))
+            case {"header": Headers.INBOX_READING_CHOICE, "payload": payload}:
+                answer, data = self._get_email(connection, payload)
+                answers = (data if request_id is None
+                           else glocodec.with_request_id(data, request_id, codec),)
+            case _:
+                answer = self._dispatch(connection.soc, message)
+                answers = () if answer is None else (encode(answer),)
+        self._metrics.request(message.get("header"), time.perf_counter() - start,
+                              answer is not None and answer["header"] == Headers.ERROR)
+        return answers
+
+    def _read_client(self, connection: _Connection) -> None:
+        """
+        Lit les octets disponibles du client, au plus environ
+        _MAX_QUEUED_OUTBOUND à la fois, et met en file chaque trame
+        complète. Une trame partielle reste dans le tampon jusqu'à
+        la prochaine lecture.
+        """
+        try:
+            received = glosocket.recv_available(connection.soc, connection.inbound,
+                                                limit=_MAX_QUEUED_OUTBOUND)
+        except glosocket.GLOSocketError:
+            self._remove_client(connection.soc)
+            return
+        connection.bytes_in += received
+        self._metrics.transfer(received=received)
+        if self._idle is not None:
+            self._idle.touch(connection)
+        try:
+            connection.requests.extend(connection.inbound.frames())
+        except glosocket.GLOSocketError as ex:
+            if isinstance(ex, glosocket.FrameTooLargeError):
+                self._metrics.rejected("frame_size")
+            self._remove_client(connection.soc)
+            return
+        self._service(connection)
+
+    def _process(self, connection: _Connection,
+                 message: gloutils.GloMessage) -> tuple[list[bytes], Iterator[bytes] | None]:
+        """
+        Traite une requête et prépare les trames à transmettre, compressées
+        au besoin; exécuté dans le bassin de travailleurs.
+        """
+        compression = connection.compression
+        answers = self._handle_message(connection, message)
+        if isinstance(answers, tuple):
+            return [glosocket.frame_bytes(data, compression) for data in answers], None
+        return _pull(glosocket.frame_bytes(data, compression) for data in answers)
+
+    def _service(self, connection: _Connection) -> None:
+        """
+        Lance les prochains traitements de la connexion selon ce qui est
+        déjà en cours, puis transmet ce qui est prêt.
+
+        Les requêtes portant un `request_id` dont l'entête est dans
+        _PIPELINED_HEADERS sont lancées sans attendre les précédentes (au
+        plus _MAX_PIPELINED à la fois) et leurs réponses sont transmises
+        dans l'ordre où elles se terminent. Les autres (authentification,
+        négociation, transferts en continu) attendent la fin des
+        traitements en cours et bloquent les suivantes jusqu'à leur fin.
+
+        Une réponse en continu n'est poursuivie que lorsque le tampon de
+        sortie est redescendu sous STREAM_CHUNK_SIZE octets; les requêtes
+        suivantes attendent qu'elle soit terminée. De même, aucune requête
+        n'est lancée tant que le tampon dépasse _MAX_QUEUED_OUTBOUND octets.
+
+        Une requête refusée par `_admit` reçoit son erreur, s'il y a lieu,
+        sans passer par le bassin de travailleurs.
+        """
+        while not connection.exclusive and connection.soc in self._client_socs:
+            if connection.stream is not None:
+                if connection.inflight:
+                    break
+                if len(connection.outbound) >= gloutils.STREAM_CHUNK_SIZE:
+                    self._flush_client(connection)
+                    if len(connection.outbound) >= gloutils.STREAM_CHUNK_SIZE:
+                        break
+                job = functools.partial(_pull, connection.stream)
+                exclusive = True
+            else:
+                if connection.pending is None:
+                    if not connection.requests:
+                        break
+                    try:
+                        connection.pending = glocodec.decode(connection.requests.popleft(),
+                                                             connection.codec)
+                    except Exception:  # pylint: disable=broad-except
+                        # Une trame indécodable, quelle qu'en soit la cause,
+                        # ferme la connexion sans interrompre la boucle.
+                        self._remove_client(connection.soc)
+                        return
+                message = connection.pending
+                exclusive = ("request_id" not in message
+                             or message.get("header") not in _PIPELINED_HEADERS)
+                if connection.inflight and (exclusive
+                                            or connection.inflight >= _MAX_PIPELINED):
+                    break
+                if len(connection.outbound) >= _MAX_QUEUED_OUTBOUND:
+                    self._flush_client(connection)
+                    if len(connection.outbound) >= _MAX_QUEUED_OUTBOUND:
+                        break
+                connection.pending = None
+                rejection = self._admit(connection, message)
+                if rejection is not None:
+                    for answer in rejection:
+                        connection.outbound += glosocket.frame_bytes(
+                            glocodec.encode(answer, connection.codec), connection.compression)
+                    continue
+                job = functools.partial(self._process, connection, message)
+
+            connection.inflight += 1
+            connection.exclusive = exclusive
+            if self._executor is None:
+                future = concurrent.futures.Future()
+                try:
+                    future.set_result(job())
+                except Exception as ex:  # pylint: disable=broad-except
+                    future.set_exception(ex)
+                self._complete(connection, future)
+            else:
+                future = self._executor.submit(job)
+                future.add_done_callback(functools.partial(self._post, connection))
+        self._flush_client(connection)
+
+    def _post(self, connection: _Connection,
+              future: concurrent.futures.Future) -> None:
+        """Signale à la boucle qu'un traitement est terminé (fil travailleur)."""
+        self._completions.append((connection, future))
+        self._wake()
+
+    def _wake(self) -> None:
+        """Réveille la boucle `selectors` (tout fil)."""
+        try:
+            self._waker_signal.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _complete(self, connection: _Connection,
+                  future: concurrent.futures.Future) -> None:
+        """Récupère le résultat d'un traitement et met ses trames en sortie."""
+        connection.inflight -= 1
+        connection.exclusive = False
+        if connection.soc not in self._client_socs:
+            if connection.upload is not None and not connection.inflight:
+                connection.upload.abort()
+            return
+        try:
+            frames, connection.stream = future.result()
+        except Exception:  # pylint: disable=broad-except
+            self._remove_client(connection.soc)
+            return
+        for data in frames:
+            connection.outbound += data
+
+    def _drain_completions(self) -> None:
+        """Traite les résultats et les avis signalés par les autres fils."""
+        try:
+            while self._waker.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._completions:
+            connection, future = self._completions.popleft()
+            self._complete(connection, future)
+            self._service(connection)
+        while self._notices:
+            self._send_notice(*self._notices.popleft())
+
+    def _flush_client(self, connection: _Connection) -> None:
+        """
+        Transmet le tampon de sortie du client et ajuste les événements
+        surveillés selon ce qui reste à envoyer.
+
+        La lecture est suspendue (contre-pression) tant que plus de
+        _MAX_QUEUED_FRAMES requêtes attendent leur traitement ou que plus
+        de _MAX_QUEUED_OUTBOUND octets attendent d'être transmis: un
+        client qui envoie sans lire les réponses ne fait pas grossir la
+        mémoire du serveur. Elle reprend lorsque ces files se vident.
+        """
+        if connection.soc not in self._client_socs:
+            return
+        try:
+            sent = glosocket.send_available(connection.soc, connection.outbound)
+        except glosocket.GLOSocketError:
+            self._remove_client(connection.soc)
+            return
+        if sent:
+            connection.bytes_out += sent
+            self._metrics.transfer(sent=sent)
+            if self._idle is not None:
+                self._idle.touch(connection)
+        events = 0
+        if (len(connection.requests) < _MAX_QUEUED_FRAMES
+                and len(connection.outbound) < _MAX_QUEUED_OUTBOUND):
+            events |= selectors.EVENT_READ
+        if connection.outbound:
+            events |= selectors.EVENT_WRITE
+        self._watch(connection, events)
+
+    def _watch(self, connection: _Connection, events: int) -> None:
+        """
+        Ajuste les événements surveillés sur le socket du client; sans
+        événement, le socket est retiré du sélecteur jusqu'à ce qu'un
+        traitement terminé le relance (voir `_drain_completions`).
+        """
+        key = self._selector.get_map().get(connection.soc)
+        if not events:
+            if key is not None:
+                self._selector.unregister(connection.soc)
+        elif key is None:
+            self._selector.register(connection.soc, events, connection)
+        elif key.events != events:
+            self._selector.modify(connection.soc, events, connection)
+
     def run(self):
         """Point d'entrée du serveur."""
 
         print("server starts")
         while True:
-            waiters, _, _ = select.select([self._server_socket] + self._client_socs, [], [])
-
-            # Select readable sockets
-            for waiter in waiters:
-                # Handle sockets
-                if waiter is self._server_socket:
-                    # ... Handle new connection
+            ready = self._selector.select(
+                self._idle.next_timeout() if self._idle is not None else None)
+            start = time.perf_counter()
+            for key, events in ready:
+                if key.fileobj is self._server_socket:
                     self._accept_client()
-                else:
-                    # ... Handle existing connection
-                    try:
-                        data = glosocket.recv_mesg(waiter)
-                    except glosocket.GLOSocketError:
-                        self._remove_client(waiter)
-                        continue
-
-                    match json.loads(data):
-                        case {"header": Headers.AUTH_REGISTER, "payload": payload}:
-                            answer = self._create_account(waiter, payload)
-                            send_mesg(waiter, json.dumps(answer))
-                        case {"header": Headers.AUTH_LOGIN, "payload": payload}:
-                            answer = self._login(waiter, payload)
-                            send_mesg(waiter, json.dumps(answer))
-                        case {"header": Headers.AUTH_LOGOUT}:
-                            answer = self._logout(waiter)
-                            send_mesg(waiter, json.dumps(answer))
-                        case {"header": Headers.INBOX_READING_CHOICE, "payload": payload}:
-                            answer = self._get_email(waiter, payload)
-                            send_mesg(waiter, json.dumps(answer))
-                        case {"header": Headers.INBOX_READING_REQUEST}:
-                            answer = self._get_email_list(waiter)
-                            send_mesg(waiter, json.dumps(answer))
-                        case {"header": Headers.EMAIL_SENDING, "payload": payload}:
-                            answer = self._send_email(payload)
-                            send_mesg(waiter, json.dumps(answer))
-                        case {"header": Headers.STATS_REQUEST}:
-                            answer = self._get_stats(waiter)
-                            send_mesg(waiter, json.dumps(answer))
+                    continue
+                if key.fileobj is self._waker:
+                    self._drain_completions()
+                    continue
+                connection: _Connection = key.data
+                if events & selectors.EVENT_READ:
+                    self._read_client(connection)
+                if events & selectors.EVENT_WRITE:
+                    self._service(connection)
+            if self._idle is not None:
+                self._close_idle()
+            self._metrics.loop(time.perf_counter() - start)
 
+    def _close_idle(self) -> None:
+        """
+        Ferme les connexions inactives depuis plus de `_idle_timeout`
+        secondes. Une connexion dont un traitement ou une réponse en
+        continu est en cours n'est pas inactive.
+        """
+        for connection in self._idle.expired():
+            if connection.soc not in self._client_socs:
+                continue
+            if connection.inflight or connection.stream is not None:
+                self._idle.add(connection)
+                continue
+            self._metrics.rejected("idle")
+            self._remove_client(connection.soc)
 
-def _main() -> int:
-    server = Server()
+    async def _serve_async_client(self, reader: asyncio.StreamReader,
+                                  writer: asyncio.StreamWriter) -> None:
+        """
+        Traite les requêtes d'un client du moteur asyncio.
+
+        Le flux d'écriture sert de clé dans `_logged_users`, comme le socket
+        dans le moteur `selectors`. Les traitements, qui font des accès
+        disque bloquants, sont exécutés dans `_executor` (ou l'exécuteur
+        par défaut d'asyncio si le bassin est désactivé). Les requêtes y sont
+        traitées une à la fois, même celles qui portent un `request_id`.
+
+        Les limites de connexions, de taille de trame, d'inactivité et de
+        débit sont les mêmes que pour le moteur `selectors`. Une requête
+        n'est lue qu'une fois la réponse précédente transmise: le flux de
+        lecture suspend alors la réception (contre-pression) lorsque son
+        tampon dépasse _MAX_QUEUED_OUTBOUND octets.
+
+        Les octets reçus sont comptés après décompression des trames.
+        """
+        if (self._max_connections is not None
+                and len(self._async_clients) >= self._max_connections):
+            self._metrics.rejected("connections")
+            writer.close()
+            return
+        loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info("peername")
+        connection = _Connection(writer, peer[0] if peer else "")
+        self._async_clients[writer] = connection
+        self._metrics.connection_opened()
+
+        async def send(data: bytes, compression: str | None) -> None:
+            sent = await glosocket.send_bytes_async(writer, data, compression)
+            connection.bytes_out += sent
+            self._metrics.transfer(sent=sent)
+
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(
+                        glosocket.recv_bytes_async(reader, self._max_frame_size),
+                        self._idle_timeout)
+                except glosocket.FrameTooLargeError:
+                    self._metrics.rejected("frame_size")
+                    break
+                except asyncio.TimeoutError:
+                    self._metrics.rejected("idle")
+                    break
+                except glosocket.GLOSocketError:
+                    break
+                connection.bytes_in += len(frame) + 4
+                self._metrics.transfer(received=len(frame) + 4)
+                compression = connection.compression
+                message = glocodec.decode(frame, connection.codec)
+                rejection = self._admit(connection, message)
+                if rejection is not None:
+                    for answer in rejection:
+                        await send(glocodec.encode(answer, connection.codec), compression)
+                    continue
+                answers = await loop.run_in_executor(
+                    self._executor, self._handle_message, connection, message)
+                if isinstance(answers, tuple):
+                    for data in answers:
+                        await send(data, compression)
+                    continue
+                while (data := await loop.run_in_executor(
+                        self._executor, next, answers, None)) is not None:
+                    await send(data, compression)
+        except Exception:  # pylint: disable=broad-except
+            # Comme pour le moteur `selectors`, une trame invalide ou une
+            # erreur de traitement ferme la connexion.
+            pass
+        finally:
+            with self._session_lock:
+                self._async_clients.pop(writer, None)
+                self._unsubscribe(connection, self._logged_users.pop(writer, None))
+                self._session_tokens.pop(writer, None)
+            if connection.upload is not None:
+                connection.upload.abort()
+            writer.close()
+
+    async def _run_asyncio(self) -> None:
+        """Boucle principale du moteur asyncio."""
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._serve_async_client,
+                                            sock=self._server_socket,
+                                            limit=_MAX_QUEUED_OUTBOUND)
+        async with server:
+            await server.serve_forever()
+
+    def run_asyncio(self) -> None:
+        """
+        Point d'entrée du serveur avec le moteur asyncio.
+
+        Les mêmes traitements que `run` sont utilisés.
+        """
+        self._selector.unregister(self._server_socket)
+        print("server starts (asyncio)")
+        asyncio.run(self._run_asyncio())
+
+
+_RESTART_DELAY = 0.5
+_RESTART_MAX_DELAY = 30.0
+# Un processus qui s'est terminé moins de _RESTART_STABLE secondes après son
+# démarrage a échoué rapidement; au-delà de _MAX_FAST_FAILURES échecs rapides
+# consécutifs, le superviseur abandonne.
+_RESTART_STABLE = 10.0
+_MAX_FAST_FAILURES = 5
+_ADDRESS_PATTERN = re.compile(r"([^@\s]+)@([^@\s]+)")
+_MAX_PIPELINED = 32
+_TOP_CONNECTIONS = 10
+_MAX_NOTICE_BACKLOG = 4 * gloutils.STREAM_CHUNK_SIZE
+# Au-delà, la lecture d'une connexion est suspendue (voir Server._flush_client).
+_MAX_QUEUED_FRAMES = 2 * _MAX_PIPELINED
+_MAX_QUEUED_OUTBOUND = 4 * gloutils.STREAM_CHUNK_SIZE
+# Requêtes non comptées par les limites de débit (voir Server._admit).
+_UNLIMITED_HEADERS = frozenset((Headers.HELLO, Headers.BYE))
+# Requêtes qui portent sur la boîte de l'utilisateur connecté.
+_AUTHENTICATED_HEADERS = frozenset((Headers.INBOX_READING_REQUEST,
+                                    Headers.INBOX_READING_CHOICE,
+                                    Headers.INBOX_READING_STREAM,
+                                    Headers.EMAIL_DELETE,
+                                    Headers.STATS_REQUEST,
+                                    Headers.INBOX_SEARCH))
+_PIPELINED_HEADERS = frozenset((Headers.INBOX_READING_REQUEST,
+                                Headers.INBOX_READING_CHOICE,
+                                Headers.EMAIL_SENDING,
+                                Headers.EMAIL_SENDING_BATCH,
+                                Headers.STATS_REQUEST,
+                                Headers.INBOX_SEARCH))
+
+
+def _pull(answers: Iterator[bytes]) -> tuple[list[bytes], Iterator[bytes] | None]:
+    """
+    Produit les prochaines trames d'une réponse jusqu'à environ
+    STREAM_CHUNK_SIZE octets. Retourne les trames et l'itérateur s'il
+    reste des trames à produire.
+    """
+    frames = []
+    size = 0
+    for data in answers:
+        frames.append(data)
+        size += len(data)
+        if size >= gloutils.STREAM_CHUNK_SIZE:
+            return frames, answers
+    return frames, None
+
+
+def _format_subjects(entries: list[glostorage.IndexEntry],
+                     first_number: int) -> list[str]:
+    """Formate des entrées d'index avec le gabarit SUBJECT_DISPLAY."""
+    return [SUBJECT_DISPLAY.format(number=number, sender=entry["sender"],
+                                   subject=entry["subject"], date=entry["date"])
+            for number, entry in enumerate(entries, start=first_number)]
+
+
+def _parse_route(route: str) -> tuple[str, tuple[str, int]]:
+    """Analyse une route de relais `domaine=hôte:port`."""
+    domain, _, address = route.partition("=")
+    host, _, port = address.rpartition(":")
+    if not domain or not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"route invalide: {route}")
+    return domain, (host, int(port))
+
+
+def _run_server(args: argparse.Namespace, reuse_port: bool = False,
+                maintenance: bool = True, relay_owner: bool = True) -> None:
+    """
+    Crée un serveur et exécute sa boucle jusqu'à son arrêt. Avec
+    `maintenance`, les index sont reconstruits, les compteurs vérifiés et
+    les boîtes compactées au démarrage si demandé. Avec `relay_owner`, ce
+    processus démarre les fils relais; les autres ne font qu'alimenter la
+    file.
+
+    Les mesures et les profils sont écrits dans les fichiers demandés; avec
+    `reuse_port`, le numéro du processus est ajouté à leur nom pour que les
+    processus supervisés ne s'écrasent pas.
+    """
+    if args.storage == "segment":
+        store = glostorage.SegmentStore(fsync=args.fsync,
+                                        fsync_interval=args.fsync_interval)
+    else:
+        store = glostorage.FileStore(fanout=args.fanout, fsync=args.fsync,
+                                     fsync_interval=args.fsync_interval)
+    hasher = gloauth.PasswordHasher(args.kdf, args.kdf_cost)
+    relay = None
+    if args.relay:
+        relay = glorelay.RelayQueue(gloutils.SERVER_OUTBOX_DIR, gloutils.SERVER_LOST_DIR,
+                                    routes=dict(args.relay_routes),
+                                    workers=args.relay_workers)
+    metrics = glometrics.Metrics()
+    server = Server(io_workers=args.io_workers, reuse_port=reuse_port, store=store,
+                    hasher=hasher, session_capacity=args.session_cache,
+                    frame_cache_size=args.frame_cache * 1024 * 1024,
+                    user_refresh=args.user_refresh, compression=args.compression,
+                    port=args.port, domain=args.domain, relay=relay,
+                    metrics=metrics, admins=args.admins,
+                    idle_timeout=args.idle_timeout, max_connections=args.max_connections,
+                    max_frame_size=args.max_frame_size or None,
+                    max_upload_size=args.max_upload_size or None,
+                    user_limits=(glolimit.TokenBuckets(args.user_rate, args.rate_burst)
+                                 if args.user_rate else None),
+                    ip_limits=(glolimit.TokenBuckets(args.ip_rate, args.rate_burst)
+                               if args.ip_rate else None))
+
+    def output_path(path: str) -> str:
+        return f"{path}.{os.getpid()}" if reuse_port else path
+
+    if maintenance and args.rebuild_index:
+        server.rebuild_indexes()
+    if maintenance and args.verify_stats:
+        print("compteurs corrigés:", server.verify_stats())
+    if maintenance and args.compact:
+        print("compaction:", server.compact_mailboxes(), "octets récupérés")
+    if relay is not None and relay_owner:
+        relay.start()
+    if args.metrics_file:
+        metrics.start_dump(output_path(args.metrics_file), args.metrics_interval,
+                           server.metrics)
+    sampler = profiler = None
+    if args.sample:
+        sampler = glometrics.Sampler(output_path(args.sample), args.sample_interval)
+        sampler.start()
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
-        server.run()
+        if args.engine == "asyncio":
+            server.run_asyncio()
+        else:
+            server.run()
     except KeyboardInterrupt:
+        pass
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(output_path(args.profile))
+        if sampler is not None:
+            sampler.stop()
+        metrics.stop_dump()
         server.cleanup()
+        if relay is not None:
+            relay.stop()
+
+
+def _run_worker(args: argparse.Namespace, maintenance: bool, relay_owner: bool) -> None:
+    """
+    Point d'entrée d'un processus serveur supervisé. L'interruption est
+    ignorée: c'est le superviseur qui demande l'arrêt avec SIGTERM.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    _run_server(args, reuse_port=True, maintenance=maintenance, relay_owner=relay_owner)
+
+
+def _supervise(args: argparse.Namespace) -> int:
+    """
+    Lance `args.workers` processus serveurs qui partagent le port, redémarre
+    ceux qui se terminent et leur transmet l'arrêt (SIGTERM) à la fin. Le
+    processus 0 livre les courriels de la file de relais.
+
+    Le délai avant un redémarrage double à chaque échec rapide consécutif du
+    même processus (au plus _RESTART_MAX_DELAY). Après _MAX_FAST_FAILURES
+    échecs rapides consécutifs, par exemple une erreur au démarrage, les
+    processus sont arrêtés et 1 est retourné.
+    """
+    started: dict[int, float] = {}
+
+    def start(slot: int, maintenance: bool = False) -> multiprocessing.Process:
+        process = multiprocessing.Process(target=_run_worker,
+                                          args=(args, maintenance, slot == 0),
+                                          name=f"glo-worker-{slot}")
+        process.start()
+        started[slot] = time.monotonic()
+        return process
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    workers = {slot: start(slot, maintenance=slot == 0)
+               for slot in range(args.workers)}
+    failures = dict.fromkeys(workers, 0)
+    restarts: dict[int, float] = {}
+    try:
+        while True:
+            sentinels = {process.sentinel: slot for slot, process in workers.items()
+                         if slot not in restarts}
+            timeout = (max(0.0, min(restarts.values()) - time.monotonic())
+                       if restarts else None)
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout):
+                slot = sentinels[sentinel]
+                workers[slot].join()
+                exitcode = workers[slot].exitcode
+                if time.monotonic() - started[slot] < _RESTART_STABLE:
+                    failures[slot] += 1
+                else:
+                    failures[slot] = 0
+                if failures[slot] >= _MAX_FAST_FAILURES:
+                    print(f"worker {slot} exited with code {exitcode}"
+                          f" {failures[slot]} times in a row, giving up")
+                    return 1
+                delay = min(_RESTART_MAX_DELAY, _RESTART_DELAY * 2 ** failures[slot])
+                print(f"worker {slot} exited with code {exitcode},"
+                      f" restarting in {delay:g}s")
+                restarts[slot] = time.monotonic() + delay
+            for slot, due in list(restarts.items()):
+                if due <= time.monotonic():
+                    del restarts[slot]
+                    workers[slot] = start(slot)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
+    return 0
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", action="store", dest="engine",
+                        choices=("selectors", "asyncio"), default="selectors",
+                        help="Moteur de la boucle d'événements.")
+    parser.add_argument("--idle-timeout", action="store", dest="idle_timeout",
+                        type=float, default=None,
+                        help="Délai d'inactivité (s) avant fermeture d'une connexion.")
+    parser.add_argument("--max-connections", action="store", dest="max_connections",
+                        type=int, default=None,
+                        help="Nombre maximal de connexions simultanées par processus.")
+    parser.add_argument("--max-frame-size", action="store", dest="max_frame_size",
+                        type=int, default=DEFAULT_MAX_FRAME_SIZE,
+                        help="Taille maximale (octets) d'une trame reçue; 0 pour "
+                             "ne pas la limiter.")
+    parser.add_argument("--max-upload-size", action="store", dest="max_upload_size",
+                        type=int, default=gloutils.MAX_UPLOAD_SIZE,
+                        help="Taille maximale (octets) d'un courriel reçu en continu; "
+                             "0 pour ne pas la limiter.")
+    parser.add_argument("--user-rate", action="store", dest="user_rate",
+                        type=float, default=None,
+                        help="Requêtes par seconde permises à chaque utilisateur.")
+    parser.add_argument("--ip-rate", action="store", dest="ip_rate",
+                        type=float, default=None,
+                        help="Requêtes par seconde permises à chaque adresse IP.")
+    parser.add_argument("--rate-burst", action="store", dest="rate_burst",
+                        type=float, default=50,
+                        help="Requêtes permises en rafale par utilisateur ou adresse IP.")
+    parser.add_argument("--io-workers", action="store", dest="io_workers",
+                        type=int, default=4,
+                        help="Nombre de fils pour les traitements bloquants "
+                             "(0 pour les exécuter dans la boucle).")
+    parser.add_argument("--rebuild-index", action="store_true", dest="rebuild_index",
+                        help="Reconstruit l'index des boîtes au démarrage.")
+    parser.add_argument("--verify-stats", action="store_true", dest="verify_stats",
+                        help="Vérifie les compteurs des boîtes au démarrage.")
+    parser.add_argument("--storage", action="store", dest="storage",
+                        choices=("file", "segment"), default="file",
+                        help="Stockage des courriels: un fichier par courriel "
+                             "ou segments en ajout seul.")
+    parser.add_argument("--compact", action="store_true", dest="compact",
+                        help="Compacte les boîtes au démarrage.")
+    parser.add_argument("--fanout", action="store", dest="fanout",
+                        type=int, default=2,
+                        help="Niveaux de sous-dossiers des boîtes de courriels.")
+    parser.add_argument("--fsync", action="store", dest="fsync",
+                        choices=glostorage.FSYNC_MODES, default=glostorage.FSYNC_NONE,
+                        help="Synchronisation sur disque des livraisons.")
+    parser.add_argument("--fsync-interval", action="store", dest="fsync_interval",
+                        type=float, default=0.005,
+                        help="Attente maximale (s) d'un lot de synchronisation.")
+    parser.add_argument("--kdf", action="store", dest="kdf",
+                        choices=gloauth.KDF_ALGORITHMS, default=gloauth.KDF_SCRYPT,
+                        help="Dérivation des mots de passe.")
+    parser.add_argument("--kdf-cost", action="store", dest="kdf_cost",
+                        type=int, default=None,
+                        help="Coût de la dérivation (log2 de n pour scrypt, "
+                             "itérations pour PBKDF2).")
+    parser.add_argument("--session-cache", action="store", dest="session_cache",
+                        type=int, default=4096,
+                        help="Nombre de sessions et d'identifiants vérifiés retenus.")
+    parser.add_argument("--frame-cache", action="store", dest="frame_cache",
+                        type=int, default=64,
+                        help="Taille (Mio) du cache des courriels encodés; 0 le désactive.")
+    parser.add_argument("--user-refresh", action="store", dest="user_refresh",
+                        type=float, default=None,
+                        help="Intervalle (s) de rafraîchissement du registre des comptes.")
+    parser.add_argument("--no-compression", action="store_false", dest="compression",
+                        help="Refuse la compression des trames.")
+    parser.add_argument("--port", action="store", dest="port",
+                        type=int, default=gloutils.APP_PORT,
+                        help="Port d'écoute du serveur.")
+    parser.add_argument("--domain", action="store", dest="domain",
+                        default=gloutils.SERVER_DOMAIN,
+                        help="Domaine des boîtes de ce serveur.")
+    parser.add_argument("--no-relay", action="store_false", dest="relay",
+                        help="Refuse les envois vers d'autres domaines.")
+    parser.add_argument("--relay-route", action="append", dest="relay_routes",
+                        type=_parse_route, default=[], metavar="DOMAINE=HÔTE:PORT",
+                        help="Serveur à joindre pour un domaine (répétable).")
+    parser.add_argument("--relay-workers", action="store", dest="relay_workers",
+                        type=int, default=4,
+                        help="Nombre de fils relais vers les autres domaines.")
+    parser.add_argument("--workers", action="store", dest="workers",
+                        type=int, default=1,
+                        help="Nombre de processus serveurs partageant le port.")
+    parser.add_argument("--admin", action="append", dest="admins",
+                        default=[], metavar="UTILISATEUR",
+                        help="Utilisateur autorisé à consulter les mesures.")
+    parser.add_argument("--metrics-file", action="store", dest="metrics_file",
+                        default=None,
+                        help="Fichier JSON où écrire périodiquement les mesures.")
+    parser.add_argument("--metrics-interval", action="store", dest="metrics_interval",
+                        type=float, default=10.0,
+                        help="Intervalle (s) d'écriture des mesures.")
+    parser.add_argument("--profile", action="store", dest="profile", default=None,
+                        help="Profile la boucle d'événements avec cProfile et écrit "
+                             "les statistiques (pstats) dans ce fichier à l'arrêt; "
+                             "avec --io-workers 0 pour y inclure les traitements.")
+    parser.add_argument("--sample", action="store", dest="sample", default=None,
+                        help="Échantillonne les piles de tous les fils et les écrit "
+                             "(format replié) dans ce fichier à l'arrêt.")
+    parser.add_argument("--sample-interval", action="store", dest="sample_interval",
+                        type=float, default=0.01,
+                        help="Intervalle (s) d'échantillonnage des piles.")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.workers > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers requiert SO_REUSEPORT")
+        return _supervise(args)
+    _run_server(args)
     return 0
 
 
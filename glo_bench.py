@@ -0,0 +1,366 @@
+"""\
+Outil de mesure des performances du protocole GLO.
+
+Sous-commandes:
+- `codec` compare le débit d'encodage/décodage et la taille sur le fil
+  des encodages de glocodec.
+- `load` lance un serveur (TP4_server.py) dans un dossier de données
+  temporaire et le soumet à des clients simulés qui s'inscrivent, se
+  connectent, puis envoient, listent et lisent des courriels et
+  demandent leurs statistiques pendant une durée donnée. Rapporte le
+  débit et les latences p50/p95/p99 de chaque opération.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Iterator
+
+import glocodec
+import gloclient
+import glosocket
+import gloutils
+from gloutils import *
+
+_SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TP4_server.py")
+_SERVER_START_TIMEOUT = 30.0
+_PREFILL_BATCH = 100
+MIXED_OPERATIONS = ("send", "list", "read", "stats")
+DEFAULT_MIX = "send=2,list=3,read=3,stats=2"
+
+
+def _sample_messages() -> dict[str, gloutils.GloMessage]:
+    """Messages représentatifs du trafic entre client et serveur."""
+    date = get_current_utc_time()
+    email = EmailContentPayload(sender="alice@glo2000.ca",
+                                destination="bob@glo2000.ca",
+                                subject="Compte rendu de la réunion",
+                                date=date, content="Bonjour,\n" * 200)
+    subjects = [SUBJECT_DISPLAY.format(number=number, sender="alice@glo2000.ca",
+                                       subject=f"Sujet {number}", date=date)
+                for number in range(1, gloutils.INBOX_PAGE_SIZE + 1)]
+    return {
+        "ok": GloMessage(header=Headers.OK),
+        "auth": GloMessage(header=Headers.AUTH_LOGIN,
+                           payload=AuthPayload(username="alice", password="secret")),
+        "email": GloMessage(header=Headers.EMAIL_SENDING, payload=email),
+        "list_page": GloMessage(header=Headers.OK,
+                                payload=EmailPagePayload(email_list=subjects,
+                                                         offset=0, total=1000)),
+        "stats": GloMessage(header=Headers.OK,
+                            payload=StatsPayload(count=1000, size=123456789)),
+    }
+
+
+def _time_per_op(function, argument, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_codecs(iterations: int) -> list[dict]:
+    """Mesure chaque encodage sur chaque message type."""
+    results = []
+    for name, message in _sample_messages().items():
+        for codec in glocodec.SUPPORTED_CODECS:
+            data = glocodec.encode(message, codec)
+            if glocodec.decode(data, codec) != message:
+                raise AssertionError(f"{codec} does not round-trip {name}")
+            encode_time = _time_per_op(lambda m: glocodec.encode(m, codec),
+                                       message, iterations)
+            decode_time = _time_per_op(lambda d: glocodec.decode(d, codec),
+                                       data, iterations)
+            results.append({"message": name, "codec": codec, "bytes": len(data),
+                            "encode_ops": round(1 / encode_time),
+                            "decode_ops": round(1 / decode_time)})
+    return results
+
+
+def _parse_mix(text: str) -> dict[str, int]:
+    """Analyse une répartition des opérations `send=2,list=3,...`."""
+    mix = {}
+    for item in text.split(","):
+        operation, _, weight = item.partition("=")
+        operation = operation.strip()
+        if operation not in MIXED_OPERATIONS or not weight.strip().isdigit():
+            raise argparse.ArgumentTypeError(f"répartition invalide: {item}")
+        mix[operation] = int(weight)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("répartition vide")
+    return mix
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as soc:
+        soc.bind(("127.0.0.1", 0))
+        return soc.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _spawn_server(args: argparse.Namespace) -> Iterator[int]:
+    """
+    Lance le serveur dans un dossier de données temporaire et retourne son
+    port une fois qu'il accepte les connexions. Sa sortie est conservée
+    dans le dossier, et affichée s'il ne démarre pas. Le serveur est
+    arrêté et le dossier supprimé à la sortie du bloc.
+    """
+    port = _free_port()
+    with tempfile.TemporaryDirectory(prefix="glo_bench_") as data_dir:
+        os.makedirs(os.path.join(data_dir, gloutils.SERVER_DATA_DIR))
+        command = [sys.executable, _SERVER_SCRIPT, "--port", str(port), "--no-relay",
+                   "--engine", args.engine, "--storage", args.storage,
+                   "--io-workers", str(args.io_workers)]
+        if args.kdf_cost is not None:
+            command += ["--kdf-cost", str(args.kdf_cost)]
+        command += args.server_args
+        log_path = os.path.join(data_dir, "server.log")
+        with open(log_path, 'wb') as log:
+            process = subprocess.Popen(command, cwd=data_dir, stdout=log,
+                                       stderr=subprocess.STDOUT)
+        try:
+            deadline = time.monotonic() + _SERVER_START_TIMEOUT
+            while True:
+                if process.poll() is not None:
+                    with open(log_path, 'r', encoding='utf-8', errors='replace') as log:
+                        sys.stderr.write(log.read())
+                    raise RuntimeError(f"server exited with code {process.returncode}")
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+            yield port
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+class _LoadStats:
+    """Latences et erreurs de chaque opération, partagées entre les clients."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    def record(self, operation: str, latency: float | None) -> None:
+        """Enregistre une opération réussie, ou un échec si `latency` est None."""
+        with self._lock:
+            if latency is None:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+            else:
+                self.latencies.setdefault(operation, []).append(latency)
+
+
+def _timed(stats: _LoadStats, operation: str, function, *arguments) -> None:
+    start = time.perf_counter()
+    try:
+        function(*arguments)
+    except gloclient.GloClientError:
+        stats.record(operation, None)
+    else:
+        stats.record(operation, time.perf_counter() - start)
+
+
+def _simulate_client(number: int, port: int, args: argparse.Namespace,
+                     barrier: threading.Barrier, stats: _LoadStats) -> None:
+    """
+    Déroule les phases d'un client simulé, synchronisées entre clients par
+    `barrier`: inscription, remplissage de la boîte (non mesuré),
+    connexion, puis opérations tirées selon `args.mix` pendant
+    `args.duration` secondes.
+    """
+    try:
+        username = f"bench{number}"
+        address = f"{username}@{SERVER_DOMAIN}"
+        compressions = glosocket.SUPPORTED_COMPRESSIONS if args.compression else ()
+        connection = gloclient.GloConnection("127.0.0.1", port, timeout=60,
+                                             codecs=(args.codec,), compressions=compressions)
+        rng = random.Random(number)
+        body = "x" * args.body_size
+
+        def email(destination: str) -> gloutils.EmailContentPayload:
+            return EmailContentPayload(sender=address, destination=destination,
+                                       subject=f"Bench {number}",
+                                       date=get_current_utc_time(), content=body)
+
+        def send() -> None:
+            destination = f"bench{rng.randrange(args.clients)}@{SERVER_DOMAIN}"
+            if not connection.send_email(email(destination))[0]["delivered"]:
+                raise gloclient.GloClientError("Échec de l'envoi du courriel")
+
+        operations = {"send": send,
+                      "list": lambda: connection.list_emails(0, gloutils.INBOX_PAGE_SIZE),
+                      "read": lambda: connection.read_email(
+                          rng.randint(1, max(1, args.mailbox_size))),
+                      "stats": connection.stats}
+        names = list(args.mix)
+        weights = [args.mix[name] for name in names]
+
+        barrier.wait()
+        _timed(stats, "register", connection.register, username, args.password)
+        barrier.wait()
+        for start in range(0, args.mailbox_size, _PREFILL_BATCH):
+            count = min(_PREFILL_BATCH, args.mailbox_size - start)
+            with contextlib.suppress(gloclient.GloClientError):
+                connection.send_batch([email(address)] * count)
+        barrier.wait()
+        _timed(stats, "login", connection.login, username, args.password)
+        barrier.wait()
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            _timed(stats, name, operations[name])
+        connection.close()
+    except BaseException:
+        barrier.abort()
+        raise
+
+
+def _percentile(samples: list[float], fraction: float) -> float:
+    """Percentile par rang le plus proche d'une liste triée."""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, round(fraction * len(samples)) - 1))]
+
+
+def bench_load(args: argparse.Namespace) -> list[dict]:
+    """
+    Mesure le serveur sous la charge de `args.clients` clients simulés et
+    retourne une ligne par opération. Le débit de l'inscription et de la
+    connexion est mesuré sur la durée de leur phase, celui des autres
+    opérations sur `args.duration`.
+    """
+    stats = _LoadStats()
+    barrier = threading.Barrier(args.clients + 1)
+    phases = {}
+    with _spawn_server(args) as port:
+        threads = [threading.Thread(target=_simulate_client,
+                                    args=(number, port, args, barrier, stats), daemon=True)
+                   for number in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        barrier.wait()
+        phases["register"] = time.perf_counter() - start
+        barrier.wait()
+        start = time.perf_counter()
+        barrier.wait()
+        phases["login"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    results = []
+    total = []
+    for operation in ("register", "login", *MIXED_OPERATIONS):
+        samples = sorted(stats.latencies.get(operation, []))
+        errors = stats.errors.get(operation, 0)
+        if not samples and not errors:
+            continue
+        if operation in MIXED_OPERATIONS:
+            total.extend(samples)
+        duration = phases.get(operation, elapsed)
+        results.append(_load_row(args, operation, samples, errors, duration))
+    total.sort()
+    errors = sum(stats.errors.get(operation, 0) for operation in MIXED_OPERATIONS)
+    results.append(_load_row(args, "total", total, errors, elapsed))
+    return results
+
+
+def _load_row(args: argparse.Namespace, operation: str, samples: list[float],
+              errors: int, duration: float) -> dict:
+    return {"engine": args.engine, "storage": args.storage, "codec": args.codec,
+            "operation": operation, "ops": len(samples), "errors": errors,
+            "ops_per_s": round(len(samples) / duration, 1) if duration else 0.0,
+            "p50_ms": round(_percentile(samples, 0.50) * 1000, 3),
+            "p95_ms": round(_percentile(samples, 0.95) * 1000, 3),
+            "p99_ms": round(_percentile(samples, 0.99) * 1000, 3)}
+
+
+def _print_table(results: list[dict]) -> None:
+    columns = list(results[0])
+    widths = [max(len(column), *(len(str(row[column])) for row in results))
+              for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in results:
+        print("  ".join(str(row[column]).ljust(width)
+                        for column, width in zip(columns, widths)))
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json", action="store_true", dest="json",
+                        help="Sortie JSON plutôt qu'un tableau.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    codec_parser = commands.add_parser("codec", help="Compare les encodages.")
+    codec_parser.add_argument("-n", "--iterations", action="store", dest="iterations",
+                              type=int, default=20000)
+    load_parser = commands.add_parser("load", help="Soumet un serveur à une charge.")
+    load_parser.add_argument("-c", "--clients", action="store", dest="clients",
+                             type=int, default=16, help="Nombre de clients simulés.")
+    load_parser.add_argument("-t", "--duration", action="store", dest="duration",
+                             type=float, default=10.0,
+                             help="Durée (s) de la phase d'opérations mixtes.")
+    load_parser.add_argument("--mix", action="store", dest="mix",
+                             type=_parse_mix, default=_parse_mix(DEFAULT_MIX),
+                             help=f"Poids des opérations (défaut: {DEFAULT_MIX}).")
+    load_parser.add_argument("--mailbox-size", action="store", dest="mailbox_size",
+                             type=int, default=100,
+                             help="Courriels placés dans chaque boîte avant la mesure.")
+    load_parser.add_argument("--body-size", action="store", dest="body_size",
+                             type=int, default=1024,
+                             help="Taille (caractères) du corps des courriels.")
+    load_parser.add_argument("--codec", action="store", dest="codec",
+                             choices=glocodec.SUPPORTED_CODECS,
+                             default=glocodec.SUPPORTED_CODECS[0],
+                             help="Encodage offert par les clients.")
+    load_parser.add_argument("--no-compression", action="store_false", dest="compression",
+                             help="Les clients n'offrent pas la compression.")
+    load_parser.add_argument("--password", action="store", dest="password",
+                             default="bench-password")
+    load_parser.add_argument("--engine", action="store", dest="engine",
+                             choices=("selectors", "asyncio"), default="selectors")
+    load_parser.add_argument("--storage", action="store", dest="storage",
+                             choices=("file", "segment"), default="file")
+    load_parser.add_argument("--io-workers", action="store", dest="io_workers",
+                             type=int, default=4)
+    load_parser.add_argument("--kdf-cost", action="store", dest="kdf_cost",
+                             type=int, default=None,
+                             help="Coût de la dérivation des mots de passe du serveur.")
+    load_parser.add_argument("--server-arg", action="append", dest="server_args",
+                             default=[],
+                             help="Option supplémentaire du serveur, "
+                                  "p. ex. --server-arg=--fsync=batch.")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.command == "codec":
+        results = bench_codecs(args.iterations)
+    elif args.command == "load":
+        results = bench_load(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,167 @@
+"""\
+Module fournissant le hachage des mots de passe et le cache des sessions.
+
+Les mots de passe sont dérivés avec une fonction à coût réglable (scrypt
+ou PBKDF2) et un sel aléatoire. Le format stocké est auto-descriptif:
+
+    scrypt$<log2 n>$<r>$<p>$<sel>$<empreinte>
+    pbkdf2_sha256$<itérations>$<sel>$<empreinte>
+
+Les anciennes empreintes SHA-256 sans sel (64 caractères hexadécimaux)
+sont encore acceptées et remplacées à la connexion suivante.
+"""
+import base64
+import collections
+import hashlib
+import hmac
+import secrets
+import threading
+
+KDF_SCRYPT = "scrypt"
+KDF_PBKDF2 = "pbkdf2_sha256"
+KDF_ALGORITHMS = (KDF_SCRYPT, KDF_PBKDF2)
+
+# Coût par défaut: log2 de n pour scrypt, nombre d'itérations pour PBKDF2.
+DEFAULT_COSTS = {KDF_SCRYPT: 14, KDF_PBKDF2: 600_000}
+
+_SALT_SIZE = 16
+_SCRYPT_R = 8
+_SCRYPT_P = 1
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data.encode('ascii'))
+
+
+class PasswordHasher:
+    """
+    Dérive et vérifie les empreintes de mots de passe.
+
+    `cost` est le log2 de n pour scrypt et le nombre d'itérations pour
+    PBKDF2; None retient la valeur de DEFAULT_COSTS.
+    """
+
+    def __init__(self, algorithm: str = KDF_SCRYPT, cost: int | None = None) -> None:
+        if algorithm not in KDF_ALGORITHMS:
+            raise ValueError(f"Unknown KDF algorithm: {algorithm}")
+        self._algorithm = algorithm
+        self._cost = cost if cost is not None else DEFAULT_COSTS[algorithm]
+
+    def hash(self, password: str) -> str:
+        """Retourne l'empreinte salée du mot de passe au coût courant."""
+        salt = secrets.token_bytes(_SALT_SIZE)
+        if self._algorithm == KDF_SCRYPT:
+            digest = _scrypt(password, salt, self._cost, _SCRYPT_R, _SCRYPT_P)
+            return "$".join((KDF_SCRYPT, str(self._cost), str(_SCRYPT_R), str(_SCRYPT_P),
+                             _b64encode(salt), _b64encode(digest)))
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, self._cost)
+        return "$".join((KDF_PBKDF2, str(self._cost), _b64encode(salt), _b64encode(digest)))
+
+    def verify(self, password: str, stored: str) -> bool:
+        """Vérifie le mot de passe par rapport à une empreinte stockée."""
+        fields = stored.strip().split("$")
+        try:
+            match fields:
+                case [KDF_SCRYPT, log_n, r, p, salt, digest]:
+                    computed = _scrypt(password, _b64decode(salt),
+                                       int(log_n), int(r), int(p))
+                case [KDF_PBKDF2, iterations, salt, digest]:
+                    computed = hashlib.pbkdf2_hmac("sha256", password.encode(),
+                                                   _b64decode(salt), int(iterations))
+                case [digest]:
+                    computed = hashlib.sha256(password.encode()).digest()
+                    digest = _b64encode(bytes.fromhex(digest))
+                case _:
+                    return False
+            return hmac.compare_digest(computed, _b64decode(digest))
+        except ValueError:
+            return False
+
+    def needs_upgrade(self, stored: str) -> bool:
+        """
+        Indique si l'empreinte doit être recalculée: ancien format,
+        autre algorithme ou coût différent du coût courant.
+        """
+        fields = stored.strip().split("$")
+        return (len(fields) < 2 or fields[0] != self._algorithm
+                or fields[1] != str(self._cost))
+
+
+def _scrypt(password: str, salt: bytes, log_n: int, r: int, p: int) -> bytes:
+    n = 1 << log_n
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * r * n * p + (1 << 20))
+
+
+class SessionCache:
+    """
+    Cache LRU borné des identifiants vérifiés récemment.
+
+    - Les jetons de session émis à la connexion permettent de reprendre
+      une session (`AUTH_RESUME`) sans dériver le mot de passe à nouveau.
+    - Les couples utilisateur/mot de passe vérifiés sont retenus sous la
+      forme d'un HMAC à clé aléatoire propre au processus, associé à
+      l'empreinte stockée: une connexion répétée évite la dérivation tant
+      que l'empreinte n'a pas changé.
+
+    Les entrées les moins récemment utilisées sont évincées au-delà de
+    `capacity`. Les accès sont protégés par un verrou entre fils.
+    """
+
+    def __init__(self, capacity: int = 4096) -> None:
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._key = secrets.token_bytes(32)
+        self._tokens: collections.OrderedDict[str, str] = collections.OrderedDict()
+        self._credentials: collections.OrderedDict[bytes, str] = collections.OrderedDict()
+
+    def issue(self, username: str) -> str:
+        """Émet un nouveau jeton de session pour l'utilisateur."""
+        token = secrets.token_urlsafe(24)
+        with self._lock:
+            self._put(self._tokens, token, username)
+        return token
+
+    def resume(self, token: str) -> str | None:
+        """Retourne l'utilisateur associé au jeton, ou None s'il est inconnu."""
+        with self._lock:
+            username = self._tokens.get(token)
+            if username is not None:
+                self._tokens.move_to_end(token)
+            return username
+
+    def revoke(self, token: str) -> None:
+        """Invalide un jeton de session."""
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def remember(self, username: str, password: str, stored: str) -> None:
+        """Retient que le mot de passe correspond à l'empreinte stockée."""
+        with self._lock:
+            self._put(self._credentials, self._credential_key(username, password), stored)
+
+    def check(self, username: str, password: str, stored: str) -> bool:
+        """
+        Indique si ce mot de passe a déjà été vérifié contre cette
+        empreinte; un échec n'exclut pas que le mot de passe soit valide.
+        """
+        key = self._credential_key(username, password)
+        with self._lock:
+            cached = self._credentials.get(key)
+            if cached is None:
+                return False
+            self._credentials.move_to_end(key)
+        return hmac.compare_digest(cached, stored)
+
+    def _credential_key(self, username: str, password: str) -> bytes:
+        return hmac.digest(self._key, f"{username}\0{password}".encode(), "sha256")
+
+    def _put(self, entries: collections.OrderedDict, key, value) -> None:
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self._capacity:
+            entries.popitem(last=False)
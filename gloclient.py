@@ -0,0 +1,777 @@
+"""\
+Module fournissant une interface de programmation du client GLO.
+
+`GloConnection` est une connexion au serveur qui expose les opérations du
+protocole (inscription, connexion, liste, lecture, envoi, statistiques)
+sans interaction avec l'utilisateur. Elle négocie l'encodage et la
+compression, se reconnecte d'elle-même et reprend sa session avec le
+jeton émis par le serveur (`AUTH_RESUME`), ou à défaut avec ses
+identifiants.
+
+`ClientPool` partage entre fils un ensemble de connexions déjà
+authentifiées. `AsyncGloConnection` et `AsyncClientPool` en sont les
+équivalents asyncio.
+"""
+import asyncio
+import collections
+import contextlib
+import itertools
+import select
+import socket
+import threading
+from typing import AsyncIterator, Iterator, Sequence
+
+import glocodec
+import glosocket
+import gloutils
+from gloutils import (DeliveryStatus, EmailBatchPayload, EmailChoicePayload,
+                      EmailChunkPayload, EmailContentPayload, EmailListRequestPayload,
+                      GloMessage, Headers, HelloPayload, SearchPayload, SessionPayload)
+
+# Avis de nouveaux courriels retenus au plus en attendant d'être consultés.
+_MAX_NOTIFICATIONS = 1024
+
+
+class GloClientError(Exception):
+    """Erreur retournée par le serveur, ou perte de la connexion."""
+
+
+def _payload(answer: gloutils.GloMessage) -> dict:
+    """Retourne le payload d'une réponse `OK`, ou lève l'erreur reçue."""
+    match answer:
+        case {"header": Headers.OK}:
+            return answer.get("payload", {})
+        case {"header": Headers.ERROR, "payload": {"error_message": error_message}}:
+            raise GloClientError(error_message)
+    raise GloClientError("Réponse inattendue du serveur.")
+
+
+def _hello(codecs: Sequence[str], compressions: Sequence[str],
+           notify: bool = False) -> gloutils.GloMessage:
+    payload = HelloPayload(codecs=list(codecs), compression=list(compressions))
+    if notify:
+        payload["notify"] = True
+    return GloMessage(header=Headers.HELLO, payload=payload)
+
+
+def _is_notification(message: gloutils.GloMessage) -> bool:
+    """Indique si le message est un avis transmis sans requête."""
+    return message.get("header") == Headers.EMAIL_NOTIFICATION and "request_id" not in message
+
+
+def _statuses(email: gloutils.EmailContentPayload,
+              answer: gloutils.GloMessage) -> list[gloutils.DeliveryStatus]:
+    """Statuts de livraison d'un envoi, y compris à une seule adresse."""
+    payload = _payload(answer)
+    if "statuses" in payload:
+        return payload["statuses"]
+    return [DeliveryStatus(destination=email["destination"], delivered=True)]
+
+
+def _stream_messages(email: gloutils.EmailContentPayload) -> Iterator[gloutils.GloMessage]:
+    """Messages d'un envoi en continu (voir `EMAIL_STREAM_START`)."""
+    content = email["content"]
+    yield GloMessage(header=Headers.EMAIL_STREAM_START,
+                     payload=EmailContentPayload(email, content=""))
+    for start in range(0, len(content), gloutils.STREAM_CHUNK_SIZE):
+        yield GloMessage(header=Headers.EMAIL_CHUNK,
+                         payload=EmailChunkPayload(
+                             data=content[start:start + gloutils.STREAM_CHUNK_SIZE]))
+    yield GloMessage(header=Headers.EMAIL_STREAM_END)
+
+
+def _streamed(email: gloutils.EmailContentPayload) -> bool:
+    return (isinstance(email["destination"], str)
+            and len(email["content"]) > gloutils.STREAM_CHUNK_SIZE)
+
+
+class GloConnection:
+    """
+    Connexion non interactive au serveur GLO.
+
+    Les méthodes lèvent GloClientError lorsque le serveur retourne une
+    erreur ou que la connexion est perdue, tout comme la construction
+    lorsque le serveur refuse la connexion. Une connexion perdue est
+    rétablie à la requête suivante; les requêtes sans effet de bord
+    (lecture, statistiques) sont alors reprises d'elles-mêmes.
+
+    `codecs` et `compressions` sont offerts au serveur, par ordre de
+    préférence; une liste vide de compressions la désactive.
+
+    Avec `notify`, le serveur avise la connexion des courriels livrés à
+    l'utilisateur connecté (`EMAIL_NOTIFICATION`). Les avis reçus entre
+    les réponses sont retenus pour `notifications` et `wait_notification`;
+    sans `notify`, un avis reçu est simplement ignoré.
+
+    Une instance n'est pas partagée entre fils; voir ClientPool.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = gloutils.APP_PORT,
+                 timeout: float | None = None,
+                 codecs: Sequence[str] = glocodec.SUPPORTED_CODECS,
+                 compressions: Sequence[str] = glosocket.SUPPORTED_COMPRESSIONS,
+                 notify: bool = False) -> None:
+        self._address = (host, port)
+        self._timeout = timeout
+        self._offers = (codecs, compressions, notify)
+        self._notifications: collections.deque[gloutils.NotificationPayload] = (
+            collections.deque(maxlen=_MAX_NOTIFICATIONS if notify else 0))
+        self._socket: socket.socket | None = None
+        self._codec = glocodec.JSON_CODEC
+        self._compression: str | None = None
+        self._username = ""
+        self._password: str | None = None
+        self._token = ""
+        self._request_ids = itertools.count(1)
+        try:
+            self._connect()
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+            self._drop()
+            raise GloClientError("Connexion au serveur impossible.") from ex
+
+    def __enter__(self) -> "GloConnection":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def username(self) -> str:
+        """Nom de l'utilisateur connecté, vide s'il n'y en a pas."""
+        return self._username
+
+    @property
+    def token(self) -> str:
+        """Jeton de la session courante, vide s'il n'y en a pas."""
+        return self._token
+
+    def close(self) -> None:
+        """Préviens le serveur avec l'entête `BYE` et ferme le socket."""
+        if self._socket is None:
+            return
+        with contextlib.suppress(glosocket.GLOSocketError):
+            self._send(GloMessage(header=Headers.BYE))
+        self._socket.close()
+        self._socket = None
+
+    def _connect(self) -> None:
+        """Ouvre le socket, négocie l'encodage et reprend la session."""
+        self._socket = socket.create_connection(self._address, timeout=self._timeout)
+        self._codec, self._compression = glocodec.JSON_CODEC, None
+        self._send(_hello(*self._offers))
+        match self._recv():
+            case {"header": Headers.OK, "payload": {"codecs": [codec]} as payload}:
+                self._codec = codec
+                self._compression = next(iter(payload.get("compression", [])), None)
+        if self._token:
+            self._send(GloMessage(header=Headers.AUTH_RESUME,
+                                  payload=SessionPayload(token=self._token)))
+            if self._recv().get("header") == Headers.OK:
+                return
+            self._token = ""
+            if self._password is None:
+                self._username = ""
+        if self._username and self._password is not None:
+            self.login(self._username, self._password)
+
+    def _drop(self) -> None:
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _send(self, message: gloutils.GloMessage) -> None:
+        glosocket.send_bytes(self._socket, glocodec.encode(message, self._codec),
+                             self._compression)
+
+    def _recv(self) -> gloutils.GloMessage:
+        while (message := self._recv_frame()) is None:
+            pass
+        return message
+
+    def _recv_frame(self) -> gloutils.GloMessage | None:
+        """Reçoit un message; un avis est retenu et None est retourné."""
+        message = glocodec.decode(glosocket.recv_bytes(self._socket), self._codec)
+        if not _is_notification(message):
+            return message
+        self._notifications.append(message.get("payload", {}))
+        return None
+
+    def notifications(self) -> list[gloutils.NotificationPayload]:
+        """Retourne les avis de nouveaux courriels reçus depuis le dernier appel."""
+        notifications = list(self._notifications)
+        self._notifications.clear()
+        return notifications
+
+    def wait_notification(self, timeout: float | None = None
+                          ) -> gloutils.NotificationPayload | None:
+        """
+        Retourne le plus ancien avis de nouveaux courriels reçu, en
+        l'attendant au plus `timeout` secondes; None si aucun n'arrive.
+        Ne doit pas être appelé en attendant des réponses.
+        """
+        try:
+            if self._socket is None:
+                self._connect()
+            while not self._notifications:
+                readable, _, _ = select.select([self._socket], [], [], timeout)
+                if not readable:
+                    return None
+                if self._recv_frame() is not None:
+                    raise GloClientError("Réponse inattendue du serveur.")
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+            self._drop()
+            raise GloClientError("Connexion au serveur perdue.") from ex
+        return self._notifications.popleft()
+
+    def request(self, message: gloutils.GloMessage,
+                retry: bool = False) -> gloutils.GloMessage:
+        """
+        Transmet une requête et retourne la réponse. Avec `retry`, la
+        requête est reprise une fois sur une nouvelle connexion si la
+        connexion est perdue.
+        """
+        for _ in range(2 if retry else 1):
+            try:
+                if self._socket is None:
+                    self._connect()
+                self._send(message)
+                return self._recv()
+            except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+                self._drop()
+                error = ex
+        raise GloClientError("Connexion au serveur perdue.") from error
+
+    def pipeline(self, messages: list[gloutils.GloMessage]) -> list[gloutils.GloMessage]:
+        """
+        Transmet plusieurs requêtes sans attendre les réponses, chacune avec
+        un `request_id`, et retourne les réponses dans l'ordre des requêtes.
+        """
+        ids = []
+        try:
+            if self._socket is None:
+                self._connect()
+            for message in messages:
+                ids.append(next(self._request_ids))
+                self._send(GloMessage(message, request_id=ids[-1]))
+            answers = {}
+            while len(answers) < len(ids):
+                answer = self._recv()
+                answers[answer.pop("request_id", None)] = answer
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+            self._drop()
+            raise GloClientError("Connexion au serveur perdue.") from ex
+        return [answers[request_id] for request_id in ids]
+
+    def register(self, username: str, password: str) -> None:
+        """Crée un compte et s'y connecte (`AUTH_REGISTER`)."""
+        self._authenticate(Headers.AUTH_REGISTER, username, password)
+
+    def login(self, username: str, password: str) -> None:
+        """Se connecte à un compte existant (`AUTH_LOGIN`)."""
+        self._authenticate(Headers.AUTH_LOGIN, username, password)
+
+    def _authenticate(self, header: Headers, username: str, password: str) -> None:
+        answer = self.request(GloMessage(header=header, payload=gloutils.AuthPayload(
+            username=username, password=password)))
+        payload = _payload(answer)
+        self._username, self._password = username, password
+        self._token = payload.get("token", "")
+
+    def resume(self, username: str, token: str, password: str | None = None) -> None:
+        """
+        Reprend une session existante avec son jeton (`AUTH_RESUME`). Le mot
+        de passe, s'il est donné, sert à se reconnecter si le jeton expire.
+        """
+        _payload(self.request(GloMessage(header=Headers.AUTH_RESUME,
+                                         payload=SessionPayload(token=token))))
+        self._username, self._password, self._token = username, password, token
+
+    def logout(self) -> None:
+        """
+        Termine la session (`AUTH_LOGOUT`, sans réponse): le serveur révoque
+        son jeton. Les identifiants retenus sont oubliés même si le serveur
+        ne peut être joint.
+        """
+        if not self._username:
+            return
+        try:
+            if self._socket is None:
+                self._connect()
+            self._send(GloMessage(header=Headers.AUTH_LOGOUT))
+            # AUTH_LOGOUT n'a pas de réponse: attendre celle d'une requête
+            # sans effet assure que le serveur l'a traitée avant une
+            # éventuelle fermeture, qui abandonnerait les requêtes en attente.
+            self._send(GloMessage(header=Headers.STATS_REQUEST))
+            self._recv()
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+            self._drop()
+            raise GloClientError("Connexion au serveur perdue.") from ex
+        finally:
+            self._username, self._password, self._token = "", None, ""
+
+    def list_emails(self, offset: int = 0,
+                    limit: int = gloutils.INBOX_PAGE_SIZE) -> gloutils.EmailPagePayload:
+        """Retourne une page de la liste des courriels, du plus récent au plus ancien."""
+        return _payload(self.request(GloMessage(
+            header=Headers.INBOX_READING_REQUEST,
+            payload=EmailListRequestPayload(offset=offset, limit=limit)), retry=True))
+
+    def search(self, query: str, offset: int = 0,
+               limit: int = gloutils.INBOX_PAGE_SIZE) -> gloutils.EmailPagePayload:
+        """
+        Retourne une page des courriels qui contiennent tous les mots de
+        `query` (`INBOX_SEARCH`), du plus pertinent au moins pertinent.
+        """
+        return _payload(self.request(GloMessage(
+            header=Headers.INBOX_SEARCH,
+            payload=SearchPayload(query=query, offset=offset, limit=limit)), retry=True))
+
+    def read_email(self, choice: int) -> gloutils.EmailContentPayload:
+        """Retourne le courriel numéro `choice` de la liste (`INBOX_READING_CHOICE`)."""
+        return _payload(self.request(GloMessage(header=Headers.INBOX_READING_CHOICE,
+                                                payload=EmailChoicePayload(choice=choice)),
+                                     retry=True))
+
+    def iter_email(self, choice: int
+                   ) -> tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        """
+        Lit le courriel numéro `choice` en continu (`INBOX_READING_STREAM`)
+        et retourne le courriel sans contenu et un itérateur sur les
+        morceaux du corps, à consommer avant la requête suivante.
+        """
+        answer = self.request(GloMessage(header=Headers.INBOX_READING_STREAM,
+                                         payload=EmailChoicePayload(choice=choice)),
+                              retry=True)
+        if answer.get("header") != Headers.EMAIL_STREAM_START:
+            _payload(answer)
+            raise GloClientError("Réponse inattendue du serveur.")
+
+        def chunks() -> Iterator[str]:
+            try:
+                while True:
+                    match self._recv():
+                        case {"header": Headers.EMAIL_CHUNK, "payload": {"data": data}}:
+                            yield data
+                        case _:
+                            return
+            except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+                self._drop()
+                raise GloClientError("Connexion au serveur perdue.") from ex
+
+        return answer["payload"], chunks()
+
+    def send_email(self, email: gloutils.EmailContentPayload
+                   ) -> list[gloutils.DeliveryStatus]:
+        """
+        Envoie un courriel et retourne le statut de chaque destinataire. Un
+        corps de plus de STREAM_CHUNK_SIZE caractères à une seule adresse
+        est transmis en continu.
+        """
+        if not _streamed(email):
+            return _statuses(email, self.request(GloMessage(header=Headers.EMAIL_SENDING,
+                                                            payload=email)))
+        *messages, last = _stream_messages(email)
+        try:
+            if self._socket is None:
+                self._connect()
+            for message in messages:
+                self._send(message)
+        except (OSError, glosocket.GLOSocketError) as ex:
+            self._drop()
+            raise GloClientError("Connexion au serveur perdue.") from ex
+        return _statuses(email, self.request(last))
+
+    def send_batch(self, emails: list[gloutils.EmailContentPayload]
+                   ) -> list[gloutils.DeliveryStatus]:
+        """Envoie plusieurs courriels en une requête (`EMAIL_SENDING_BATCH`)."""
+        return _payload(self.request(GloMessage(header=Headers.EMAIL_SENDING_BATCH,
+                                                payload=EmailBatchPayload(emails=emails))
+                                     ))["statuses"]
+
+    def delete_email(self, choice: int) -> None:
+        """Supprime le courriel numéro `choice` de la liste (`EMAIL_DELETE`)."""
+        _payload(self.request(GloMessage(header=Headers.EMAIL_DELETE,
+                                         payload=EmailChoicePayload(choice=choice))))
+
+    def stats(self) -> gloutils.StatsPayload:
+        """Retourne le nombre de courriels et leur taille (`STATS_REQUEST`)."""
+        return _payload(self.request(GloMessage(header=Headers.STATS_REQUEST), retry=True))
+
+    def metrics(self) -> dict:
+        """Retourne les mesures du serveur (`METRICS_REQUEST`, administrateurs)."""
+        return _payload(self.request(GloMessage(header=Headers.METRICS_REQUEST),
+                                     retry=True))["metrics"]
+
+
+class ClientPool:
+    """
+    Ensemble de connexions partagé entre fils.
+
+    Les connexions sont ouvertes à la demande, jusqu'à `size`, puis
+    réutilisées. Si `username` est donné, chaque connexion s'y connecte et
+    détient son propre jeton de session: une déconnexion ou une nouvelle
+    connexion sur l'une ne révoque pas la session des autres. Le serveur
+    retient les identifiants vérifiés et ne dérive le mot de passe qu'une
+    fois. `close` termine les sessions des connexions qu'il ferme.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = gloutils.APP_PORT,
+                 username: str = "", password: str = "", size: int = 8,
+                 timeout: float | None = None) -> None:
+        self._host, self._port, self._timeout = host, port, timeout
+        self._username, self._password = username, password
+        self._size = size
+        self._idle: list[GloConnection] = []
+        self._opened = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[GloConnection]:
+        """Emprunte une connexion authentifiée pour la durée du bloc."""
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            with self._condition:
+                self._idle.append(connection)
+                self._condition.notify()
+
+    def _acquire(self) -> GloConnection:
+        with self._condition:
+            while not self._idle and self._opened >= self._size:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        try:
+            return self._open()
+        except BaseException:
+            with self._condition:
+                self._opened -= 1
+                self._condition.notify()
+            raise
+
+    def _open(self) -> GloConnection:
+        connection = GloConnection(self._host, self._port, self._timeout)
+        if self._username:
+            try:
+                connection.login(self._username, self._password)
+            except BaseException:
+                connection.close()
+                raise
+        return connection
+
+    def close(self) -> None:
+        """Termine les sessions des connexions inactives et les ferme."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for connection in idle:
+            with contextlib.suppress(GloClientError):
+                connection.logout()
+            connection.close()
+
+
+class AsyncGloConnection:
+    """
+    Équivalent asyncio de GloConnection, créé avec `AsyncGloConnection.open`.
+    Une instance n'est pas partagée entre tâches; voir AsyncClientPool.
+    """
+
+    def __init__(self, host: str, port: int, codecs: Sequence[str],
+                 compressions: Sequence[str], notify: bool = False) -> None:
+        self._address = (host, port)
+        self._offers = (codecs, compressions, notify)
+        self._notifications: collections.deque[gloutils.NotificationPayload] = (
+            collections.deque(maxlen=_MAX_NOTIFICATIONS if notify else 0))
+        # Lecture de trame laissée en cours par wait_notification.
+        self._receiving: asyncio.Task | None = None
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._codec = glocodec.JSON_CODEC
+        self._compression: str | None = None
+        self._username = ""
+        self._password: str | None = None
+        self._token = ""
+
+    @classmethod
+    async def open(cls, host: str = "127.0.0.1", port: int = gloutils.APP_PORT,
+                   codecs: Sequence[str] = glocodec.SUPPORTED_CODECS,
+                   compressions: Sequence[str] = glosocket.SUPPORTED_COMPRESSIONS,
+                   notify: bool = False) -> "AsyncGloConnection":
+        """Ouvre une connexion et négocie l'encodage (voir GloConnection)."""
+        connection = cls(host, port, codecs, compressions, notify)
+        try:
+            await connection._connect()
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+            connection._drop()
+            raise GloClientError("Connexion au serveur impossible.") from ex
+        return connection
+
+    @property
+    def username(self) -> str:
+        """Nom de l'utilisateur connecté, vide s'il n'y en a pas."""
+        return self._username
+
+    @property
+    def token(self) -> str:
+        """Jeton de la session courante, vide s'il n'y en a pas."""
+        return self._token
+
+    async def close(self) -> None:
+        """Préviens le serveur avec l'entête `BYE` et ferme la connexion."""
+        if self._writer is None:
+            return
+        with contextlib.suppress(glosocket.GLOSocketError):
+            await self._send(GloMessage(header=Headers.BYE))
+        self._drop()
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(*self._address)
+        self._codec, self._compression = glocodec.JSON_CODEC, None
+        await self._send(_hello(*self._offers))
+        match await self._recv():
+            case {"header": Headers.OK, "payload": {"codecs": [codec]} as payload}:
+                self._codec = codec
+                self._compression = next(iter(payload.get("compression", [])), None)
+        if self._token:
+            await self._send(GloMessage(header=Headers.AUTH_RESUME,
+                                        payload=SessionPayload(token=self._token)))
+            if (await self._recv()).get("header") == Headers.OK:
+                return
+            self._token = ""
+            if self._password is None:
+                self._username = ""
+        if self._username and self._password is not None:
+            await self.login(self._username, self._password)
+
+    def _drop(self) -> None:
+        if self._receiving is not None:
+            self._receiving.cancel()
+            self._receiving = None
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def _send(self, message: gloutils.GloMessage) -> None:
+        await glosocket.send_bytes_async(self._writer, glocodec.encode(message, self._codec),
+                                         self._compression)
+
+    async def _recv(self) -> gloutils.GloMessage:
+        while (message := await self._recv_frame()) is None:
+            pass
+        return message
+
+    async def _recv_frame(self) -> gloutils.GloMessage | None:
+        """Équivalent de GloConnection._recv_frame."""
+        if self._receiving is not None:
+            receiving, self._receiving = self._receiving, None
+            frame = await receiving
+        else:
+            frame = await glosocket.recv_bytes_async(self._reader)
+        message = glocodec.decode(frame, self._codec)
+        if not _is_notification(message):
+            return message
+        self._notifications.append(message.get("payload", {}))
+        return None
+
+    def notifications(self) -> list[gloutils.NotificationPayload]:
+        """Équivalent de GloConnection.notifications."""
+        notifications = list(self._notifications)
+        self._notifications.clear()
+        return notifications
+
+    async def wait_notification(self, timeout: float | None = None
+                                ) -> gloutils.NotificationPayload | None:
+        """Équivalent de GloConnection.wait_notification."""
+        try:
+            if self._writer is None:
+                await self._connect()
+            while not self._notifications:
+                # La lecture n'est pas annulée à l'expiration, ce qui perdrait
+                # une trame à moitié lue: la suivante l'attendra.
+                if self._receiving is None:
+                    self._receiving = asyncio.ensure_future(
+                        glosocket.recv_bytes_async(self._reader))
+                done, _ = await asyncio.wait((self._receiving,), timeout=timeout)
+                if not done:
+                    return None
+                if await self._recv_frame() is not None:
+                    raise GloClientError("Réponse inattendue du serveur.")
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+            self._drop()
+            raise GloClientError("Connexion au serveur perdue.") from ex
+        return self._notifications.popleft()
+
+    async def request(self, message: gloutils.GloMessage,
+                      retry: bool = False) -> gloutils.GloMessage:
+        """Équivalent de GloConnection.request."""
+        for _ in range(2 if retry else 1):
+            try:
+                if self._writer is None:
+                    await self._connect()
+                await self._send(message)
+                return await self._recv()
+            except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+                self._drop()
+                error = ex
+        raise GloClientError("Connexion au serveur perdue.") from error
+
+    async def register(self, username: str, password: str) -> None:
+        """Crée un compte et s'y connecte (`AUTH_REGISTER`)."""
+        await self._authenticate(Headers.AUTH_REGISTER, username, password)
+
+    async def login(self, username: str, password: str) -> None:
+        """Se connecte à un compte existant (`AUTH_LOGIN`)."""
+        await self._authenticate(Headers.AUTH_LOGIN, username, password)
+
+    async def _authenticate(self, header: Headers, username: str, password: str) -> None:
+        answer = await self.request(GloMessage(header=header, payload=gloutils.AuthPayload(
+            username=username, password=password)))
+        payload = _payload(answer)
+        self._username, self._password = username, password
+        self._token = payload.get("token", "")
+
+    async def resume(self, username: str, token: str, password: str | None = None) -> None:
+        """Équivalent de GloConnection.resume."""
+        _payload(await self.request(GloMessage(header=Headers.AUTH_RESUME,
+                                               payload=SessionPayload(token=token))))
+        self._username, self._password, self._token = username, password, token
+
+    async def logout(self) -> None:
+        """Équivalent de GloConnection.logout."""
+        if not self._username:
+            return
+        try:
+            if self._writer is None:
+                await self._connect()
+            await self._send(GloMessage(header=Headers.AUTH_LOGOUT))
+            await self._send(GloMessage(header=Headers.STATS_REQUEST))
+            await self._recv()
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+            self._drop()
+            raise GloClientError("Connexion au serveur perdue.") from ex
+        finally:
+            self._username, self._password, self._token = "", None, ""
+
+    async def list_emails(self, offset: int = 0,
+                          limit: int = gloutils.INBOX_PAGE_SIZE) -> gloutils.EmailPagePayload:
+        """Équivalent de GloConnection.list_emails."""
+        return _payload(await self.request(GloMessage(
+            header=Headers.INBOX_READING_REQUEST,
+            payload=EmailListRequestPayload(offset=offset, limit=limit)), retry=True))
+
+    async def search(self, query: str, offset: int = 0,
+                     limit: int = gloutils.INBOX_PAGE_SIZE) -> gloutils.EmailPagePayload:
+        """Équivalent de GloConnection.search."""
+        return _payload(await self.request(GloMessage(
+            header=Headers.INBOX_SEARCH,
+            payload=SearchPayload(query=query, offset=offset, limit=limit)), retry=True))
+
+    async def read_email(self, choice: int) -> gloutils.EmailContentPayload:
+        """Équivalent de GloConnection.read_email."""
+        return _payload(await self.request(GloMessage(header=Headers.INBOX_READING_CHOICE,
+                                                      payload=EmailChoicePayload(choice=choice)),
+                                           retry=True))
+
+    async def iter_email(self, choice: int
+                         ) -> tuple[gloutils.EmailContentPayload, AsyncIterator[str]]:
+        """Équivalent de GloConnection.iter_email."""
+        answer = await self.request(GloMessage(header=Headers.INBOX_READING_STREAM,
+                                               payload=EmailChoicePayload(choice=choice)),
+                                    retry=True)
+        if answer.get("header") != Headers.EMAIL_STREAM_START:
+            _payload(answer)
+            raise GloClientError("Réponse inattendue du serveur.")
+
+        async def chunks() -> AsyncIterator[str]:
+            try:
+                while True:
+                    match await self._recv():
+                        case {"header": Headers.EMAIL_CHUNK, "payload": {"data": data}}:
+                            yield data
+                        case _:
+                            return
+            except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+                self._drop()
+                raise GloClientError("Connexion au serveur perdue.") from ex
+
+        return answer["payload"], chunks()
+
+    async def send_email(self, email: gloutils.EmailContentPayload
+                         ) -> list[gloutils.DeliveryStatus]:
+        """Équivalent de GloConnection.send_email."""
+        if not _streamed(email):
+            return _statuses(email, await self.request(
+                GloMessage(header=Headers.EMAIL_SENDING, payload=email)))
+        *messages, last = _stream_messages(email)
+        try:
+            if self._writer is None:
+                await self._connect()
+            for message in messages:
+                await self._send(message)
+        except (OSError, glosocket.GLOSocketError) as ex:
+            self._drop()
+            raise GloClientError("Connexion au serveur perdue.") from ex
+        return _statuses(email, await self.request(last))
+
+    async def send_batch(self, emails: list[gloutils.EmailContentPayload]
+                         ) -> list[gloutils.DeliveryStatus]:
+        """Équivalent de GloConnection.send_batch."""
+        return _payload(await self.request(GloMessage(
+            header=Headers.EMAIL_SENDING_BATCH, payload=EmailBatchPayload(emails=emails))
+        ))["statuses"]
+
+    async def delete_email(self, choice: int) -> None:
+        """Équivalent de GloConnection.delete_email."""
+        _payload(await self.request(GloMessage(header=Headers.EMAIL_DELETE,
+                                               payload=EmailChoicePayload(choice=choice))))
+
+    async def stats(self) -> gloutils.StatsPayload:
+        """Équivalent de GloConnection.stats."""
+        return _payload(await self.request(GloMessage(header=Headers.STATS_REQUEST),
+                                           retry=True))
+
+    async def metrics(self) -> dict:
+        """Équivalent de GloConnection.metrics."""
+        return _payload(await self.request(GloMessage(header=Headers.METRICS_REQUEST),
+                                           retry=True))["metrics"]
+
+
+class AsyncClientPool:
+    """Équivalent asyncio de ClientPool."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = gloutils.APP_PORT,
+                 username: str = "", password: str = "", size: int = 8) -> None:
+        self._host, self._port = host, port
+        self._username, self._password = username, password
+        self._idle: list[AsyncGloConnection] = []
+        self._slots = asyncio.Semaphore(size)
+
+    @contextlib.asynccontextmanager
+    async def connection(self) -> AsyncIterator[AsyncGloConnection]:
+        """Emprunte une connexion authentifiée pour la durée du bloc."""
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._open()
+            try:
+                yield connection
+            finally:
+                self._idle.append(connection)
+
+    async def _open(self) -> AsyncGloConnection:
+        connection = await AsyncGloConnection.open(self._host, self._port)
+        if self._username:
+            try:
+                await connection.login(self._username, self._password)
+            except BaseException:
+                await connection.close()
+                raise
+        return connection
+
+    async def close(self) -> None:
+        """Équivalent de ClientPool.close."""
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            with contextlib.suppress(GloClientError):
+                await connection.logout()
+            await connection.close()
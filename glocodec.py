@@ -0,0 +1,313 @@
+"""\
+Module fournissant l'encodage des GloMessage pour le transport.
+
+Deux encodages sont disponibles: JSON, utilisé par défaut, et un
+encodage binaire compact négocié à la connexion avec l'entête `HELLO`.
+
+`FrameCache` conserve des messages déjà encodés pour les réponses
+répétées; `with_request_id` y ajoute le `request_id` d'une requête sans
+réencoder le message.
+"""
+import collections
+import json
+import struct
+import threading
+
+import gloutils
+
+JSON_CODEC = "json"
+BINARY_CODEC = "binary"
+SUPPORTED_CODECS = (BINARY_CODEC, JSON_CODEC)
+
+_STR, _INT, _STRLIST, _JSON = range(4)
+
+_NO_PAYLOAD = 0
+_JSON_FALLBACK = 255
+
+# Bit de l'octet d'entête indiquant qu'un `request_id` (`!I`) suit l'entête.
+_REQUEST_ID_FLAG = 0x80
+
+# Champs de chaque type de payload, dans l'ordre d'encodage. L'étiquette
+# est transmise après l'entête; elle ne doit jamais être réattribuée.
+_PAYLOAD_FIELDS: dict[int, tuple[tuple[str, int], ...]] = {
+    1: (("error_message", _STR),),
+    2: (("username", _STR), ("password", _STR)),
+    3: (("sender", _STR), ("destination", _STR), ("subject", _STR),
+        ("date", _STR), ("content", _STR)),
+    4: (("email_list", _STRLIST),),
+    5: (("offset", _INT), ("limit", _INT)),
+    6: (("email_list", _STRLIST), ("offset", _INT), ("total", _INT)),
+    7: (("choice", _INT),),
+    8: (("count", _INT), ("size", _INT)),
+    9: (("codecs", _STRLIST),),
+    10: (("data", _STR),),
+    11: (("token", _STR),),
+    12: (("emails", _JSON),),
+    13: (("statuses", _JSON),),
+    14: (("codecs", _STRLIST), ("compression", _STRLIST)),
+    15: (("metrics", _JSON),),
+    16: (("query", _STR), ("offset", _INT), ("limit", _INT)),
+}
+
+_HEAD = struct.Struct("!BBB")
+_LENGTH = struct.Struct("!I")
+_INTEGER = struct.Struct("!q")
+_REQUEST_ID = struct.Struct("!I")
+
+_tags_by_keys: dict[frozenset, int | None] = {}
+
+
+class CodecError(Exception):
+    """Erreur levée lorsqu'un message reçu ne peut pas être décodé."""
+
+
+def negotiate(offered: list[str]) -> str:
+    """
+    Choisit l'encodage à utiliser parmi ceux offerts par le client.
+
+    L'ordre de préférence du client est respecté; JSON est retenu si
+    aucun encodage offert n'est supporté.
+    """
+    for codec in offered:
+        if codec in SUPPORTED_CODECS:
+            return codec
+    return JSON_CODEC
+
+
+def encode(message: gloutils.GloMessage, codec: str = JSON_CODEC) -> bytes:
+    """Encode un message selon l'encodage demandé."""
+    if codec == BINARY_CODEC:
+        return _encode_binary(message)
+    return json.dumps(message).encode('utf-8')
+
+
+def decode(data: bytes, codec: str = JSON_CODEC) -> gloutils.GloMessage:
+    """
+    Décode un message selon l'encodage demandé.
+
+    Lève une exception CodecError si les données sont invalides ou ne
+    sont pas un message (objet avec un entête entier).
+    """
+    try:
+        if codec == BINARY_CODEC:
+            message = _decode_binary(data)
+        else:
+            message = json.loads(data)
+    except (ValueError, TypeError, KeyError, IndexError, struct.error, RecursionError) as ex:
+        # RecursionError: imbrication trop profonde, par exemple b"[" * 200000.
+        raise CodecError("The received data is not a valid message") from ex
+    if not isinstance(message, dict) or not isinstance(message.get("header"), int):
+        raise CodecError("The received data is not a valid message")
+    return message
+
+
+def with_request_id(data: bytes, request_id: int, codec: str = JSON_CODEC) -> bytes:
+    """
+    Retourne le message encodé `data`, qui n'a pas de `request_id`, avec
+    celui-ci, comme s'il avait été encodé avec.
+    """
+    if codec == BINARY_CODEC and data[1] != _JSON_FALLBACK:
+        if not 0 <= request_id <= 0xFFFFFFFF:
+            message = _decode_binary(data)
+            message["request_id"] = request_id
+            return _encode_binary(message)
+        return (bytes((data[0] | _REQUEST_ID_FLAG,)) + data[1:_HEAD.size]
+                + _REQUEST_ID.pack(request_id) + data[_HEAD.size:])
+    # Objet JSON, seul ou après l'entête binaire: la clé est ajoutée à la fin.
+    closing = data.rindex(b"}")
+    return data[:closing] + b', "request_id": ' + json.dumps(request_id).encode() + b"}"
+
+
+class FrameCache:
+    """
+    Cache LRU de messages encodés, borné par leur taille totale en octets.
+
+    Les clés sont de la forme (utilisateur, identifiant, encodage).
+    Au-delà de `capacity` octets, les messages les moins récemment
+    utilisés sont évincés; un message de plus du huitième de la capacité
+    n'est pas conservé, pour ne pas vider le cache d'un coup. Les accès
+    sont protégés par un verrou entre fils.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._size = 0
+        self._lock = threading.Lock()
+        self._frames: collections.OrderedDict[tuple[str, str, str], bytes] = (
+            collections.OrderedDict())
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: tuple[str, str, str]) -> bytes | None:
+        """Retourne le message encodé sous `key`, ou None."""
+        with self._lock:
+            data = self._frames.get(key)
+            if data is None:
+                self._misses += 1
+                return None
+            self._frames.move_to_end(key)
+            self._hits += 1
+            return data
+
+    def put(self, key: tuple[str, str, str], data: bytes) -> None:
+        """Conserve un message encodé, en évinçant les plus anciens au besoin."""
+        if len(data) > self._capacity // 8:
+            return
+        with self._lock:
+            previous = self._frames.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._frames[key] = data
+            self._size += len(data)
+            while self._size > self._capacity:
+                _, evicted = self._frames.popitem(last=False)
+                self._size -= len(evicted)
+                self._evictions += 1
+
+    def invalidate(self, username: str, message_ids: list[str]) -> None:
+        """Retire les messages conservés de ces courriels, dans tous les encodages."""
+        with self._lock:
+            for message_id in message_ids:
+                for codec in SUPPORTED_CODECS:
+                    data = self._frames.pop((username, message_id, codec), None)
+                    if data is not None:
+                        self._size -= len(data)
+
+    def clear(self) -> None:
+        """Vide le cache."""
+        with self._lock:
+            self._frames.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """Retourne les compteurs du cache."""
+        with self._lock:
+            return {"entries": len(self._frames), "bytes": self._size,
+                    "capacity": self._capacity, "hits": self._hits,
+                    "misses": self._misses, "evictions": self._evictions}
+
+
+def _tag_for(keys: frozenset) -> int | None:
+    """Retourne l'étiquette du premier type de payload compatible."""
+    try:
+        return _tags_by_keys[keys]
+    except KeyError:
+        pass
+    tag = None
+    for candidate, fields in _PAYLOAD_FIELDS.items():
+        if keys <= {name for name, _ in fields}:
+            tag = candidate
+            break
+    _tags_by_keys[keys] = tag
+    return tag
+
+
+def _matches(tag: int, payload: dict) -> bool:
+    """
+    Vérifie que les valeurs ont le type prévu par l'étiquette, par exemple
+    une liste de destinataires plutôt qu'une seule adresse.
+    """
+    for name, kind in _PAYLOAD_FIELDS[tag]:
+        if name not in payload:
+            continue
+        value = payload[name]
+        if kind == _STR and not isinstance(value, str):
+            return False
+        if kind == _INT and (not isinstance(value, int) or isinstance(value, bool)):
+            return False
+        if kind == _STRLIST and not isinstance(value, list):
+            return False
+    return True
+
+
+def _pack_str(parts: list[bytes], value: str) -> None:
+    data = value.encode('utf-8')
+    parts.append(_LENGTH.pack(len(data)))
+    parts.append(data)
+
+
+def _encode_binary(message: gloutils.GloMessage) -> bytes:
+    payload = message.get("payload")
+    header = message["header"]
+    request_id = message.get("request_id")
+    suffix = b""
+    if isinstance(request_id, int) and 0 <= request_id <= 0xFFFFFFFF:
+        header |= _REQUEST_ID_FLAG
+        suffix = _REQUEST_ID.pack(request_id)
+    elif request_id is not None:
+        header, suffix = None, b""
+
+    if header is None or len(message) - ("payload" in message) - bool(suffix) != 1:
+        tag = None
+    elif payload is None:
+        return _HEAD.pack(header, _NO_PAYLOAD, 0) + suffix
+    else:
+        tag = _tag_for(frozenset(payload))
+    if tag is None or not _matches(tag, payload):
+        return (_HEAD.pack(message["header"], _JSON_FALLBACK, 0)
+                + json.dumps(message).encode('utf-8'))
+
+    parts = [b"", suffix]
+    presence = 0
+    for position, (name, kind) in enumerate(_PAYLOAD_FIELDS[tag]):
+        if name not in payload:
+            continue
+        presence |= 1 << position
+        value = payload[name]
+        if kind == _STR:
+            _pack_str(parts, value)
+        elif kind == _INT:
+            parts.append(_INTEGER.pack(value))
+        elif kind == _STRLIST:
+            parts.append(_LENGTH.pack(len(value)))
+            for item in value:
+                _pack_str(parts, item)
+        else:
+            _pack_str(parts, json.dumps(value))
+    parts[0] = _HEAD.pack(header, tag, presence)
+    return b"".join(parts)
+
+
+def _decode_binary(data: bytes) -> gloutils.GloMessage:
+    header, tag, presence = _HEAD.unpack_from(data, 0)
+    if tag == _JSON_FALLBACK:
+        return json.loads(data[_HEAD.size:])
+    position = _HEAD.size
+    message = gloutils.GloMessage(header=header & ~_REQUEST_ID_FLAG)
+    if header & _REQUEST_ID_FLAG:
+        message["request_id"], = _REQUEST_ID.unpack_from(data, position)
+        position += _REQUEST_ID.size
+    if tag == _NO_PAYLOAD:
+        if position != len(data):
+            raise ValueError("Trailing data after the header")
+        return message
+
+    view = memoryview(data)
+    payload = {}
+    for index, (name, kind) in enumerate(_PAYLOAD_FIELDS[tag]):
+        if not presence & (1 << index):
+            continue
+        if kind == _INT:
+            payload[name], = _INTEGER.unpack_from(data, position)
+            position += _INTEGER.size
+        elif kind == _STRLIST:
+            count, = _LENGTH.unpack_from(data, position)
+            position += _LENGTH.size
+            items = []
+            for _ in range(count):
+                length, = _LENGTH.unpack_from(data, position)
+                position += _LENGTH.size
+                items.append(str(view[position:position + length], 'utf-8'))
+                position += length
+            payload[name] = items
+        else:
+            length, = _LENGTH.unpack_from(data, position)
+            position += _LENGTH.size
+            value = str(view[position:position + length], 'utf-8')
+            position += length
+            payload[name] = json.loads(value) if kind == _JSON else value
+    if position != len(data):
+        raise ValueError("Trailing data after the payload")
+    message["payload"] = payload
+    return message
@@ -0,0 +1,111 @@
+"""\
+Module fournissant le contrôle d'admission du serveur GLO.
+
+`TokenBuckets` limite le débit de requêtes par clé (utilisateur, adresse
+IP) avec un seau à jetons: chaque clé dispose de `burst` jetons, regagnés
+au rythme de `rate` par seconde, et chaque requête en consomme un.
+
+`IdleTimer` repère les connexions inactives depuis plus de `timeout`
+secondes avec un tas d'échéances: une activité ne coûte qu'une
+affectation, et seules les échéances atteintes sont examinées.
+"""
+import collections
+import heapq
+import itertools
+import threading
+import time
+from typing import Hashable
+
+
+class TokenBuckets:
+    """
+    Seaux à jetons indépendants, un par clé.
+
+    Au plus `capacity` seaux sont retenus; les moins récemment utilisés
+    sont oubliés, ce qui revient à leur rendre tous leurs jetons. Les
+    accès sont protégés par un verrou entre fils.
+    """
+
+    def __init__(self, rate: float, burst: float, capacity: int = 65536) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._buckets: collections.OrderedDict[Hashable, list[float]] = (
+            collections.OrderedDict())
+
+    def allow(self, key: Hashable, cost: float = 1.0) -> bool:
+        """Consomme `cost` jetons du seau de `key` s'il en a assez."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self._burst, now]
+                if len(self._buckets) > self._capacity:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+                bucket[1] = now
+            if bucket[0] < cost:
+                return False
+            bucket[0] -= cost
+            return True
+
+
+class IdleTimer:
+    """
+    Échéances d'inactivité de clés, utilisé par une seule boucle.
+
+    `touch` note une activité; `expired` retourne les clés inactives
+    depuis plus de `timeout` secondes et cesse de les suivre. Une
+    activité ne modifie pas le tas: l'échéance atteinte d'une clé active
+    depuis est simplement repoussée.
+    """
+
+    def __init__(self, timeout: float) -> None:
+        self._timeout = timeout
+        self._last: dict[Hashable, float] = {}
+        self._deadlines: list[tuple[float, int, Hashable]] = []
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._last)
+
+    def add(self, key: Hashable) -> None:
+        """Commence à suivre une clé, active maintenant."""
+        now = time.monotonic()
+        if key not in self._last:
+            heapq.heappush(self._deadlines, (now + self._timeout, next(self._sequence), key))
+        self._last[key] = now
+
+    def touch(self, key: Hashable) -> None:
+        """Note une activité de la clé, si elle est suivie."""
+        if key in self._last:
+            self._last[key] = time.monotonic()
+
+    def remove(self, key: Hashable) -> None:
+        """Cesse de suivre une clé; son échéance sera ignorée."""
+        self._last.pop(key, None)
+
+    def expired(self) -> list[Hashable]:
+        """Retourne les clés inactives depuis plus de `timeout` secondes."""
+        now = time.monotonic()
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, sequence, key = heapq.heappop(self._deadlines)
+            last = self._last.get(key)
+            if last is None:
+                continue
+            if last + self._timeout <= now:
+                del self._last[key]
+                expired.append(key)
+            else:
+                heapq.heappush(self._deadlines, (last + self._timeout, sequence, key))
+        return expired
+
+    def next_timeout(self) -> float | None:
+        """Secondes avant la prochaine échéance, ou None s'il n'y en a pas."""
+        if not self._deadlines:
+            return None
+        return max(0.0, self._deadlines[0][0] - time.monotonic())
@@ -0,0 +1,310 @@
+"""\
+Module fournissant les mesures du serveur GLO.
+
+`Metrics` compte les requêtes et mesure leur latence par entête, les
+octets reçus et transmis, la durée des itérations de la boucle
+d'événements et celle des accès au stockage. Les durées sont accumulées
+dans des histogrammes à seaux fixes: une mesure coûte une recherche
+dichotomique et quelques additions, quelle que soit la charge.
+
+`TimedStore` mesure les accès d'un stockage de glostorage et `Sampler`
+échantillonne la pile de tous les fils pour trouver où le temps est
+passé, sans le coût de cProfile.
+"""
+import bisect
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable, Iterator
+
+import gloutils
+
+# Bornes supérieures (s) des seaux des histogrammes, de 10 µs à environ 42 s;
+# un dernier seau reçoit les durées plus longues.
+_BOUNDS = tuple(10e-6 * 2 ** exponent for exponent in range(23))
+
+_HEADER_NAMES = {header.value: header.name for header in gloutils.Headers}
+_UNKNOWN_HEADER = "UNKNOWN"
+
+
+class Histogram:
+    """Histogramme de durées à seaux exponentiels fixes."""
+
+    __slots__ = ("counts", "count", "total", "maximum")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        """Ajoute une durée à l'histogramme."""
+        self.counts[bisect.bisect_left(_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def quantile(self, fraction: float) -> float:
+        """
+        Estime le quantile demandé par la borne supérieure du seau qui le
+        contient, sans dépasser la plus longue durée observée.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index < len(_BOUNDS):
+                    return min(_BOUNDS[index], self.maximum)
+                return self.maximum
+        return 0.0
+
+    def snapshot(self) -> dict:
+        """Résumé de l'histogramme en millisecondes."""
+        mean = self.total / self.count if self.count else 0.0
+        return {"count": self.count,
+                "mean_ms": round(mean * 1000, 3),
+                "p50_ms": round(self.quantile(0.50) * 1000, 3),
+                "p95_ms": round(self.quantile(0.95) * 1000, 3),
+                "p99_ms": round(self.quantile(0.99) * 1000, 3),
+                "max_ms": round(self.maximum * 1000, 3)}
+
+
+class Metrics:
+    """
+    Mesures cumulées d'un processus serveur, protégées par un verrou
+    entre la boucle d'événements et les fils travailleurs.
+
+    - `request` compte une requête traitée, par entête, avec la durée de
+      son traitement et si la réponse est une erreur.
+    - `transfer` cumule les octets reçus et transmis sur les sockets.
+    - `loop` mesure une itération de la boucle d'événements, sans
+      l'attente dans le sélecteur.
+    - `disk` mesure un accès au stockage (voir TimedStore).
+    - `notification` compte les avis de nouveaux courriels transmis et
+      ceux abandonnés parce que le client ne lit pas assez vite.
+    - `rejected` compte les connexions et requêtes refusées par le
+      contrôle d'admission, par motif (voir glolimit).
+
+    `snapshot` en retourne un instantané sérialisable en JSON; il peut
+    aussi être écrit périodiquement dans un fichier (`start_dump`).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._requests: dict[str, Histogram] = {}
+        self._errors: collections.Counter[str] = collections.Counter()
+        self._disk: dict[str, Histogram] = {}
+        self._loop = Histogram()
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._connections = 0
+        self._notifications = 0
+        self._notifications_dropped = 0
+        self._rejected: collections.Counter[str] = collections.Counter()
+        self._dumping: threading.Event | None = None
+
+    def request(self, header, seconds: float, error: bool = False) -> None:
+        """
+        Enregistre une requête traitée. Les entêtes inconnus sont comptés
+        ensemble, pour qu'un client ne puisse pas multiplier les séries.
+        """
+        name = (_HEADER_NAMES.get(header, _UNKNOWN_HEADER) if isinstance(header, int)
+                else _UNKNOWN_HEADER)
+        with self._lock:
+            histogram = self._requests.get(name)
+            if histogram is None:
+                histogram = self._requests[name] = Histogram()
+            histogram.observe(seconds)
+            if error:
+                self._errors[name] += 1
+
+    def disk(self, operation: str, seconds: float) -> None:
+        """Enregistre un accès au stockage."""
+        with self._lock:
+            histogram = self._disk.get(operation)
+            if histogram is None:
+                histogram = self._disk[operation] = Histogram()
+            histogram.observe(seconds)
+
+    def loop(self, seconds: float) -> None:
+        """Enregistre une itération de la boucle d'événements."""
+        with self._lock:
+            self._loop.observe(seconds)
+
+    def transfer(self, received: int = 0, sent: int = 0) -> None:
+        """Cumule des octets reçus et transmis."""
+        with self._lock:
+            self._bytes_in += received
+            self._bytes_out += sent
+
+    def connection_opened(self) -> None:
+        """Compte une nouvelle connexion cliente."""
+        with self._lock:
+            self._connections += 1
+
+    def notification(self, dropped: bool = False) -> None:
+        """Compte un avis de nouveau courriel transmis ou abandonné."""
+        with self._lock:
+            if dropped:
+                self._notifications_dropped += 1
+            else:
+                self._notifications += 1
+
+    def rejected(self, reason: str) -> None:
+        """Compte une connexion ou une requête refusée pour ce motif."""
+        with self._lock:
+            self._rejected[reason] += 1
+
+    def snapshot(self) -> dict:
+        """Retourne un instantané des mesures."""
+        with self._lock:
+            return {
+                "uptime_s": round(time.time() - self._started, 3),
+                "connections_total": self._connections,
+                "bytes_in": self._bytes_in,
+                "bytes_out": self._bytes_out,
+                "notifications": self._notifications,
+                "notifications_dropped": self._notifications_dropped,
+                "rejected": dict(sorted(self._rejected.items())),
+                "requests": {name: dict(histogram.snapshot(), errors=self._errors[name])
+                             for name, histogram in sorted(self._requests.items())},
+                "loop": self._loop.snapshot(),
+                "disk": {operation: histogram.snapshot()
+                         for operation, histogram in sorted(self._disk.items())},
+            }
+
+    def start_dump(self, path: str, interval: float,
+                   snapshot: Callable[[], dict] | None = None) -> None:
+        """
+        Écrit toutes les `interval` secondes l'instantané retourné par
+        `snapshot` (par défaut celui de ces mesures) dans le fichier JSON
+        `path`, remplacé atomiquement.
+        """
+        self._dumping = threading.Event()
+        thread = threading.Thread(target=self._dump,
+                                  args=(path, interval, snapshot or self.snapshot,
+                                        self._dumping),
+                                  name="glo-metrics-dump", daemon=True)
+        thread.start()
+
+    def stop_dump(self) -> None:
+        """Arrête l'écriture périodique."""
+        if self._dumping is not None:
+            self._dumping.set()
+            self._dumping = None
+
+    @staticmethod
+    def _dump(path: str, interval: float, snapshot: Callable[[], dict],
+              stopped: threading.Event) -> None:
+        while not stopped.wait(interval):
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    json.dump(snapshot(), file, indent=2)
+                os.replace(temp_path, path)
+            except OSError:
+                pass
+
+
+class TimedStore:
+    """
+    Enveloppe d'un stockage de glostorage (MailStore) qui mesure la durée
+    de chacune de ses méthodes dans `metrics`. Les méthodes qui retournent
+    un itérateur (`iter_body`, `scan`) sont mesurées sur tout leur
+    parcours.
+    """
+
+    _ITERATORS = frozenset(("iter_body", "scan"))
+
+    def __init__(self, store, metrics: Metrics) -> None:
+        self._store = store
+        self._metrics = metrics
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._store, name)
+        if not callable(attribute):
+            return attribute
+        metrics = self._metrics
+        if name in self._ITERATORS:
+            def timed(*args, **kwargs):
+                return _timed_iterator(metrics, name, attribute(*args, **kwargs))
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return attribute(*args, **kwargs)
+                finally:
+                    metrics.disk(name, time.perf_counter() - start)
+        setattr(self, name, timed)
+        return timed
+
+
+def _timed_iterator(metrics: Metrics, name: str, iterator: Iterator) -> Iterator:
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        metrics.disk(name, elapsed)
+
+
+class Sampler:
+    """
+    Profileur par échantillonnage: toutes les `interval` secondes, la pile
+    de chaque fil du processus est relevée. À l'arrêt, les piles sont
+    écrites dans `path` au format « replié » (une ligne
+    `fonction;fonction;... nombre` par pile), lu par les outils de flame
+    graph. Contrairement à cProfile, tous les fils sont couverts et le
+    coût ne dépend pas du nombre d'appels.
+    """
+
+    def __init__(self, path: str, interval: float = 0.01) -> None:
+        self._path = path
+        self._interval = interval
+        self._stacks: collections.Counter[str] = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        """Démarre l'échantillonnage."""
+        self._thread = threading.Thread(target=self._run, name="glo-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Arrête l'échantillonnage et écrit les piles relevées."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with open(self._path, 'w', encoding='utf-8') as file:
+            for stack, count in self._stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+    def _run(self) -> None:
+        own_ident = threading.get_ident()
+        while not self._stopped.wait(self._interval):
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} "
+                                 f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                self._stacks[";".join(stack)] += 1
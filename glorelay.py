@@ -0,0 +1,386 @@
+"""\
+Module fournissant le relais des courriels vers les autres serveurs GLO.
+
+Les courriels destinés à un autre domaine sont placés dans une file
+persistante (un fichier JSON par destinataire dans le dossier de la file)
+puis livrés par des fils relais au serveur du domaine, avec le protocole
+GLO habituel (`EMAIL_SENDING`). Une livraison refusée par le serveur
+distant est définitive; une erreur de connexion est reprise plus tard
+avec un délai qui double à chaque tentative. Une connexion perdue après
+la transmission du courriel, en attendant la réponse, n'est pas reprise:
+le courriel a pu être livré, et il est écarté plutôt que livré deux fois.
+"""
+import heapq
+import json
+import logging
+import os
+import random
+import select
+import socket
+import threading
+import time
+import uuid
+from typing import TypedDict
+
+import glocodec
+import glosocket
+import gloutils
+from gloutils import GloMessage, Headers, HelloPayload
+
+RELAY_BASE_DELAY = 1.0
+RELAY_MAX_DELAY = 300.0
+RELAY_MAX_ATTEMPTS = 10
+RELAY_TIMEOUT = 10.0
+RELAY_IDLE_TIMEOUT = 30.0
+
+_logger = logging.getLogger(__name__)
+
+
+class _Unconfirmed(Exception):
+    """Requête transmise au serveur distant dont la réponse est perdue."""
+
+
+class RelayJob(TypedDict, total=True):
+    """Courriel en attente de relais, tel qu'enregistré dans la file."""
+    email: gloutils.EmailContentPayload
+    destination: str
+    attempts: int
+    next_attempt: float
+
+
+class _PeerConnection:
+    """Connexion à un serveur distant, réutilisée d'un courriel à l'autre."""
+
+    __slots__ = ("soc", "codec", "compression", "last_used")
+
+    def __init__(self, address: tuple[str, int]) -> None:
+        self.soc = socket.create_connection(address, timeout=RELAY_TIMEOUT)
+        self.codec = glocodec.JSON_CODEC
+        self.compression: str | None = None
+        self.last_used = time.monotonic()
+        hello_payload = HelloPayload(codecs=list(glocodec.SUPPORTED_CODECS),
+                                     compression=list(glosocket.SUPPORTED_COMPRESSIONS))
+        try:
+            answer = self.request(GloMessage(header=Headers.HELLO, payload=hello_payload))
+        except BaseException:
+            self.soc.close()
+            raise
+        match answer:
+            case {"header": Headers.OK, "payload": {"codecs": [codec]} as payload}:
+                self.codec = codec
+                self.compression = next(iter(payload.get("compression", [])), None)
+
+    def request(self, message: gloutils.GloMessage) -> gloutils.GloMessage:
+        """Transmet une requête et retourne la réponse du serveur distant."""
+        self.send(message)
+        return self.receive()
+
+    def send(self, message: gloutils.GloMessage) -> None:
+        glosocket.send_bytes(self.soc, glocodec.encode(message, self.codec),
+                             self.compression)
+
+    def receive(self) -> gloutils.GloMessage:
+        answer = glocodec.decode(glosocket.recv_bytes(self.soc), self.codec)
+        self.last_used = time.monotonic()
+        return answer
+
+    def stale(self) -> bool:
+        """
+        Indique si la connexion inactive est lisible sans requête en cours:
+        le serveur distant l'a fermée (ou a écrit sans y être invité).
+        """
+        try:
+            readable, _, _ = select.select([self.soc], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def close(self) -> None:
+        try:
+            glosocket.send_bytes(self.soc, glocodec.encode(GloMessage(header=Headers.BYE),
+                                                           self.codec))
+        except glosocket.GLOSocketError:
+            pass
+        self.soc.close()
+
+
+class RelayQueue:
+    """
+    File persistante et fils relais des courriels vers d'autres domaines.
+
+    `routes` associe un domaine à l'adresse (hôte, port) de son serveur;
+    les autres domaines sont joints sur leur nom au port APP_PORT. Les
+    connexions inactives sont conservées par hôte pour les livraisons
+    suivantes. Les courriels abandonnés après `max_attempts` tentatives
+    ou refusés sont déplacés dans `failed_dir`, tout comme les fichiers de
+    la file illisibles ou mal formés, qui n'interrompent pas les fils.
+
+    `enqueue` peut être appelé par plusieurs processus qui partagent la
+    file; seul celui qui appelle `start` livre et planifie les courriels,
+    et il parcourt la file toutes les `poll_interval` secondes pour y
+    trouver ceux ajoutés par les autres, qui ne font que les écrire.
+    """
+
+    def __init__(self, queue_dir: str, failed_dir: str,
+                 routes: dict[str, tuple[str, int]] | None = None,
+                 workers: int = 4, max_attempts: int = RELAY_MAX_ATTEMPTS,
+                 poll_interval: float = 1.0) -> None:
+        self._queue_dir = queue_dir
+        self._failed_dir = failed_dir
+        self._routes = {domain.lower(): address for domain, address in (routes or {}).items()}
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._schedule: list[tuple[float, str]] = []
+        self._known: set[str] = set()
+        self._idle: dict[tuple[str, int], list[_PeerConnection]] = {}
+        self._idle_lock = threading.Lock()
+        self._started = False
+        self._stopping = False
+        self._stopped = threading.Event()
+        self._threads: list[threading.Thread] = []
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def enqueue(self, email: gloutils.EmailContentPayload, destination: str) -> str:
+        """
+        Enregistre un courriel à relayer et retourne son identifiant. Il
+        n'est planifié que si la file est démarrée dans ce processus;
+        sinon le processus qui l'a démarrée le trouvera à son parcours.
+        """
+        job_id = uuid.uuid4().hex + ".json"
+        job = RelayJob(email=email, destination=destination, attempts=0, next_attempt=0.0)
+        self._write(job_id, job)
+        if self._started:
+            self._schedule_job(job_id, 0.0)
+        return job_id
+
+    def pending(self) -> int:
+        """
+        Retourne le nombre de courriels en attente de relais: ceux planifiés
+        si la file est démarrée dans ce processus, sinon ceux de la file
+        sur le disque.
+        """
+        if not self._started:
+            try:
+                return sum(1 for job_id in os.listdir(self._queue_dir)
+                           if job_id.endswith(".json"))
+            except OSError:
+                return 0
+        with self._condition:
+            return len(self._known)
+
+    def start(self) -> None:
+        """Charge la file existante et démarre les fils relais."""
+        self._started = True
+        self._scan()
+        for number in range(self._workers):
+            thread = threading.Thread(target=self._work, name=f"glo-relay-{number}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._poll, name="glo-relay-poll", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Arrête les fils relais et ferme les connexions conservées."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        with self._idle_lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self._queue_dir, job_id)
+
+    def _write(self, job_id: str, job: RelayJob) -> None:
+        path = self._path(job_id)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(job, file)
+        os.replace(temp_path, path)
+
+    def _schedule_job(self, job_id: str, when: float) -> None:
+        with self._condition:
+            self._known.add(job_id)
+            heapq.heappush(self._schedule, (when, job_id))
+            self._condition.notify()
+
+    def _scan(self) -> None:
+        """Planifie les courriels de la file qui ne le sont pas encore."""
+        for job_id in os.listdir(self._queue_dir):
+            if not job_id.endswith(".json") or job_id in self._known:
+                continue
+            try:
+                with open(self._path(job_id), 'r', encoding='utf-8') as file:
+                    job: RelayJob = json.load(file)
+                when = float(job["next_attempt"])
+            except OSError:
+                continue
+            except (ValueError, TypeError, KeyError):
+                when = 0.0  # mal formé: écarté par le fil relais qui le reprend
+            with self._condition:
+                if job_id not in self._known:
+                    self._known.add(job_id)
+                    heapq.heappush(self._schedule, (when, job_id))
+                    self._condition.notify()
+
+    def _poll(self) -> None:
+        while not self._stopped.wait(self._poll_interval):
+            try:
+                self._scan()
+                self._close_idle()
+            except OSError:
+                pass
+
+    def _next_job(self) -> str | None:
+        """Attend le prochain courriel dû, ou retourne None à l'arrêt."""
+        with self._condition:
+            while not self._stopping:
+                if self._schedule:
+                    due, job_id = self._schedule[0]
+                    delay = due - time.time()
+                    if delay <= 0:
+                        heapq.heappop(self._schedule)
+                        return job_id
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+            return None
+
+    def _work(self) -> None:
+        while (job_id := self._next_job()) is not None:
+            try:
+                with open(self._path(job_id), 'r', encoding='utf-8') as file:
+                    job: RelayJob = json.load(file)
+            except OSError:
+                with self._condition:
+                    self._known.discard(job_id)
+                continue
+            except ValueError:
+                _logger.warning("relay job %s is not valid JSON", job_id)
+                self._finish(job_id, delivered=False)
+                continue
+            try:
+                self._attempt(job_id, job)
+            except Exception:  # pylint: disable=broad-except
+                # Un courriel mal formé ne doit pas arrêter le fil relais.
+                _logger.exception("relay job %s failed", job_id)
+                self._finish(job_id, delivered=False)
+
+    def _attempt(self, job_id: str, job: RelayJob) -> None:
+        """Tente de relayer un courriel et le replanifie en cas d'échec."""
+        address = self._route(job["destination"])
+        email = gloutils.EmailContentPayload(job["email"], destination=job["destination"])
+        try:
+            answer = self._send(address, GloMessage(header=Headers.EMAIL_SENDING,
+                                                    payload=email))
+        except _Unconfirmed:
+            _logger.warning("relay job %s sent but not confirmed by %s:%d",
+                            job_id, *address)
+            self._finish(job_id, delivered=False)
+            return
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError):
+            job["attempts"] += 1
+            if job["attempts"] >= self._max_attempts:
+                self._finish(job_id, delivered=False)
+                return
+            delay = min(RELAY_MAX_DELAY, RELAY_BASE_DELAY * 2 ** (job["attempts"] - 1))
+            job["next_attempt"] = time.time() + delay * random.uniform(0.5, 1.0)
+            self._write(job_id, job)
+            self._schedule_job(job_id, job["next_attempt"])
+            return
+        self._finish(job_id, delivered=answer.get("header") == Headers.OK)
+
+    def _finish(self, job_id: str, delivered: bool) -> None:
+        """Retire un courriel de la file, dans `failed_dir` s'il n'a pas été livré."""
+        try:
+            if delivered:
+                os.remove(self._path(job_id))
+            else:
+                os.makedirs(self._failed_dir, exist_ok=True)
+                os.replace(self._path(job_id), os.path.join(self._failed_dir, job_id))
+        except OSError:
+            pass
+        with self._condition:
+            self._known.discard(job_id)
+
+    def _route(self, destination: str) -> tuple[str, int]:
+        domain = destination.rpartition("@")[2].strip().lower()
+        return self._routes.get(domain, (domain, gloutils.APP_PORT))
+
+    def _send(self, address: tuple[str, int],
+              message: gloutils.GloMessage) -> gloutils.GloMessage:
+        """
+        Transmet la requête sur une connexion conservée vers l'hôte, ou sur
+        une nouvelle si elle a été fermée entre-temps.
+
+        La requête n'est reprise sur une autre connexion que si elle n'a
+        pas pu être transmise: une trame tronquée n'est pas traitée par le
+        serveur distant. Une fois la trame transmise, une erreur est levée
+        sans reprise immédiate, puisque le courriel a pu être livré.
+        """
+        while (connection := self._take(address)) is not None:
+            if connection.stale():
+                connection.soc.close()
+                continue
+            try:
+                connection.send(message)
+            except (OSError, glosocket.GLOSocketError):
+                connection.soc.close()
+                continue
+            return self._receive(address, connection)
+        connection = _PeerConnection(address)
+        try:
+            connection.send(message)
+        except BaseException:
+            connection.soc.close()
+            raise
+        return self._receive(address, connection)
+
+    def _receive(self, address: tuple[str, int],
+                 connection: _PeerConnection) -> gloutils.GloMessage:
+        """
+        Attend la réponse et remet la connexion parmi celles conservées.
+        Lève _Unconfirmed si la réponse ne peut être reçue.
+        """
+        try:
+            answer = connection.receive()
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+            connection.soc.close()
+            raise _Unconfirmed() from ex
+        except BaseException:
+            connection.soc.close()
+            raise
+        self._release(address, connection)
+        return answer
+
+    def _take(self, address: tuple[str, int]) -> _PeerConnection | None:
+        with self._idle_lock:
+            connections = self._idle.get(address)
+            return connections.pop() if connections else None
+
+    def _release(self, address: tuple[str, int], connection: _PeerConnection) -> None:
+        with self._idle_lock:
+            self._idle.setdefault(address, []).append(connection)
+
+    def _close_idle(self) -> None:
+        """Ferme les connexions inactives depuis plus de RELAY_IDLE_TIMEOUT."""
+        deadline = time.monotonic() - RELAY_IDLE_TIMEOUT
+        expired = []
+        with self._idle_lock:
+            for address, connections in self._idle.items():
+                expired.extend(connection for connection in connections
+                               if connection.last_used < deadline)
+                connections[:] = [connection for connection in connections
+                                  if connection.last_used >= deadline]
+        for connection in expired:
+            connection.close()
@@ -1,9 +1,41 @@
 """\
 Module fournissant les fonctions d'envoi et de réception
 de messages de taille arbitraire pour les sockets Python.
+
+Chaque trame est précédée de sa longueur (`!I`). Le bit de poids fort de
+la longueur (COMPRESSED_FLAG) indique une trame compressée avec zlib; la
+réception la décompresse toujours, tandis que l'envoi ne compresse que si
+une méthode a été négociée et que la trame atteint COMPRESSION_THRESHOLD
+octets.
+
+Les fonctions de réception acceptent une taille maximale de trame
+(`max_size`), vérifiée sur l'entête avant toute allocation et sur la
+taille décompressée; une trame plus grande lève FrameTooLargeError.
 """
+import asyncio
 import socket
 import struct
+import zlib
+
+COMPRESSED_FLAG = 0x80000000
+ZLIB = "zlib"
+ZLIB_DICT = "zlib-dict-1"
+SUPPORTED_COMPRESSIONS = (ZLIB_DICT, ZLIB)
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 6
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+# Taille maximale par défaut des trames reçues par le serveur.
+DEFAULT_MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Dictionnaire partagé de ZLIB_DICT: noms des champs et fragments fréquents
+# des messages. Ne jamais le modifier; en ajouter un avec une nouvelle méthode.
+_ZDICT = (b'{"header": , "request_id": "payload": {"error_message": '
+          b'"username": "password": "codecs": ["binary", "json"], "compression": '
+          b'"email_list": ["#"offset": "total": "choice": "count": "size": '
+          b'"data": "token": "statuses": [{"destination": "delivered": true}, '
+          b'"emails": [{"sender": "@glo2000.ca", "destination": "subject": '
+          b'"date": "Mon, Tue, Wed, Thu, Fri, Sat, Sun, Jan Feb Mar Apr May Jun '
+          b'Jul Aug Sep Oct Nov Dec 2026 +0000", "content": "')
 
 
 class GLOSocketError(Exception):
@@ -13,42 +45,191 @@ class GLOSocketError(Exception):
     """
 
 
-def _recvall(source: socket.socket, size: int) -> bytes:
+class FrameTooLargeError(GLOSocketError):
+    """Erreur levée lorsqu'une trame reçue dépasse la taille maximale."""
+
+
+def _check_length(length: int, max_size: int | None) -> int:
+    """Retourne la taille des données d'une trame, si elle est admise."""
+    size = length & ~COMPRESSED_FLAG
+    if max_size is not None and size > max_size:
+        raise FrameTooLargeError(f"The received frame exceeds {max_size} bytes")
+    return size
+
+
+def _recvall_into(source: socket.socket, view: memoryview) -> None:
     """
-    Fonction utilitaire pour recv_mesg.
+    Fonction utilitaire pour recv_bytes et recv_mesg_into.
 
-    Applique socket.recv en boucle pour jusqu'à la
-    réception d'un message de la taille voulue.
+    Applique socket.recv_into en boucle jusqu'à ce que la vue soit
+    remplie, sans copie intermédiaire ni limite de taille des morceaux.
     """
-    msg = b""
-    while size > 0:
-        chunk_size = min(size, 4096)
+    while len(view):
         try:
-            buffer = source.recv(chunk_size)
+            received = source.recv_into(view)
         except OSError as ex:
             raise GLOSocketError("The source socket is closed.") from ex
-        if not buffer:
+        if not received:
             raise GLOSocketError("The other socket is closed.")
-        msg += buffer
-        size -= len(buffer)
-    return msg
+        view = view[received:]
 
 
-def send_mesg(dest_soc: socket.socket, message: str) -> None:
+def _recvall(source: socket.socket, size: int) -> bytearray:
     """
-    Encode le message puis le transmet à la destination.
+    Fonction utilitaire pour recv_mesg.
+
+    Reçoit exactement `size` octets dans un tampon préalloué.
+    """
+    buffer = bytearray(size)
+    _recvall_into(source, memoryview(buffer))
+    return buffer
+
+
+def _recv_length(source: socket.socket) -> int:
+    """
+    Reçoit l'entête de longueur d'un message, avec son bit
+    COMPRESSED_FLAG.
+    """
+    data_length = _recvall(source, 4)
+    try:
+        length, = struct.unpack("!I", data_length)
+    except struct.error as ex:
+        raise GLOSocketError("The received data was"
+                             " not the message's length") from ex
+    return length
+
+
+def _send_vectored(dest: socket.socket, *buffers: bytes) -> None:
+    """
+    Transmet les tampons à la suite sans les concaténer.
+
+    Utilise sendmsg (scatter-gather) lorsque disponible, sinon
+    un sendall par tampon.
+    """
+    if not hasattr(dest, "sendmsg"):
+        for buffer in buffers:
+            dest.sendall(buffer)
+        return
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    while views:
+        sent = dest.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+def negotiate_compression(offered: list[str]) -> str | None:
+    """
+    Choisit la compression à utiliser parmi celles offertes par le pair,
+    dans son ordre de préférence, ou None si aucune n'est supportée.
+    """
+    for compression in offered:
+        if compression in SUPPORTED_COMPRESSIONS:
+            return compression
+    return None
+
+
+def _frame_parts(data: bytes, compression: str | None) -> tuple[bytes, bytes]:
+    """
+    Retourne l'entête de longueur et les données d'une trame, compressées
+    si `compression` est donnée, que la trame atteint COMPRESSION_THRESHOLD
+    octets et que la compression la rend plus petite.
+    """
+    if len(data) >= COMPRESSED_FLAG:
+        raise GLOSocketError("The message is too large to be framed")
+    if compression is not None and len(data) >= COMPRESSION_THRESHOLD:
+        if compression == ZLIB_DICT:
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=_ZDICT)
+        else:
+            compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) < len(data):
+            return struct.pack("!I", len(compressed) | COMPRESSED_FLAG), compressed
+    return struct.pack("!I", len(data)), data
+
+
+def _unframe(length: int, data: bytes, max_size: int | None = None) -> bytes:
+    """Décompresse les données d'une trame si son entête l'indique."""
+    if not length & COMPRESSED_FLAG:
+        return data
+    limit = MAX_DECOMPRESSED_SIZE if max_size is None else min(max_size, MAX_DECOMPRESSED_SIZE)
+    decompressor = zlib.decompressobj(zdict=_ZDICT)
+    try:
+        result = decompressor.decompress(data, limit)
+    except zlib.error as ex:
+        raise GLOSocketError("The received frame is not valid zlib data") from ex
+    if decompressor.unconsumed_tail and limit == max_size:
+        raise FrameTooLargeError(f"The received frame exceeds {max_size} bytes")
+    if not decompressor.eof or decompressor.unconsumed_tail:
+        raise GLOSocketError("The received frame is truncated or too large")
+    return result
+
+
+def send_bytes(dest_soc: socket.socket, data: bytes,
+               compression: str | None = None) -> None:
+    """
+    Transmet des octets déjà encodés précédés de leur longueur, en les
+    compressant selon `compression` (voir negotiate_compression).
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
+    data_length, data = _frame_parts(data, compression)
     try:
-        dest_soc.sendall(data_length + data)
+        _send_vectored(dest_soc, data_length, data)
     except OSError as ex:
         raise GLOSocketError("Cannot send data with socket") from ex
 
 
+def send_mesg(dest_soc: socket.socket, message: str,
+              compression: str | None = None) -> None:
+    """
+    Encode le message puis le transmet à la destination.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    send_bytes(dest_soc, message.encode(encoding='utf-8'), compression)
+
+
+def recv_bytes(source_soc: socket.socket,
+               max_size: int | None = None) -> bytes | bytearray:
+    """
+    Récupère un message de la source sans le décoder.
+
+    Le tampon est alloué une seule fois à la taille annoncée par
+    l'entête, si elle ne dépasse pas `max_size`. Lève une exception
+    GLOSocketError en cas de problème de communication.
+    """
+    length = _recv_length(source_soc)
+    return _unframe(length, _recvall(source_soc, _check_length(length, max_size)), max_size)
+
+
+def recv_mesg_into(source_soc: socket.socket, buffer: bytearray,
+                   max_size: int | None = None) -> memoryview:
+    """
+    Récupère un message de la source dans un tampon réutilisable.
+
+    Le tampon est agrandi au besoin et une vue sur le message reçu est
+    retournée. La vue doit être libérée avant le prochain appel avec le
+    même tampon. Lève une exception GLOSocketError en cas de problème
+    de communication. Un message compressé est décompressé dans un
+    nouveau tampon.
+    """
+    length = _recv_length(source_soc)
+    size = _check_length(length, max_size)
+    if length & COMPRESSED_FLAG:
+        return memoryview(_unframe(length, _recvall(source_soc, size), max_size))
+    if len(buffer) < length:
+        buffer.extend(bytes(length - len(buffer)))
+    view = memoryview(buffer)[:length]
+    _recvall_into(source_soc, view)
+    return view
+
+
 def recv_mesg(source_soc: socket.socket) -> str:
     """
     Récupère un message de la source et le décode.
@@ -56,12 +237,164 @@ def recv_mesg(source_soc: socket.socket) -> str:
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data_length = _recvall(source_soc, 4)
+    return recv_bytes(source_soc).decode('utf-8')
+
+
+def frame_bytes(data: bytes, compression: str | None = None) -> bytes:
+    """
+    Préfixe des octets déjà encodés de leur longueur, en les compressant
+    selon `compression` comme send_bytes.
+
+    Utilisé par les boucles non bloquantes qui mettent les trames
+    en tampon au lieu de les transmettre immédiatement.
+    """
+    data_length, data = _frame_parts(data, compression)
+    return data_length + data
+
+
+def frame_mesg(message: str, compression: str | None = None) -> bytes:
+    """Encode le message et le préfixe de sa longueur."""
+    return frame_bytes(message.encode(encoding='utf-8'), compression)
+
+
+class FrameBuffer:
+    """
+    Tampon de réassemblage des trames reçues par morceaux.
+
+    Les octets sont accumulés au fil des lectures non bloquantes et
+    les trames complètes (entête `!I` et données) sont extraites dès
+    qu'elles sont disponibles. Une trame partielle reste en attente
+    sans bloquer l'appelant. Les trames compressées sont décompressées
+    à l'extraction.
+
+    Une trame qui annonce plus de `max_size` octets est refusée dès la
+    réception de son entête, avant que ses données ne s'accumulent.
+    """
+
+    def __init__(self, max_size: int | None = None) -> None:
+        self._buffer = bytearray()
+        self._max_size = max_size
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def feed(self, data: bytes) -> None:
+        """Ajoute des octets reçus au tampon."""
+        self._buffer += data
+
+    def frames(self) -> list[bytes]:
+        """
+        Retire et retourne toutes les trames complètes du tampon.
+
+        Lève une exception GLOSocketError si une trame compressée est
+        invalide, FrameTooLargeError si une trame est trop grande.
+        """
+        frames = []
+        start = 0
+        available = len(self._buffer)
+        while available - start >= 4:
+            field, = struct.unpack_from("!I", self._buffer, start)
+            length = _check_length(field, self._max_size)
+            if available - start - 4 < length:
+                break
+            with memoryview(self._buffer) as view:
+                frames.append(_unframe(field, bytes(view[start + 4:start + 4 + length]),
+                                       self._max_size))
+            start += 4 + length
+        if start:
+            del self._buffer[:start]
+        return frames
+
+
+def recv_available(source: socket.socket, buffer: FrameBuffer,
+                   chunk_size: int = 65536, limit: int | None = None) -> int:
+    """
+    Lit tout ce qui est disponible sur un socket non bloquant, ou au
+    moins `limit` octets s'il est donné, l'ajoute au tampon et retourne
+    le nombre d'octets lus.
+
+    Lève une exception GLOSocketError si le socket est fermé.
+    """
+    received = 0
+    while True:
+        try:
+            data = source.recv(chunk_size)
+        except (BlockingIOError, InterruptedError):
+            return received
+        except OSError as ex:
+            raise GLOSocketError("The source socket is closed.") from ex
+        if not data:
+            raise GLOSocketError("The other socket is closed.")
+        buffer.feed(data)
+        received += len(data)
+        if len(data) < chunk_size or (limit is not None and received >= limit):
+            return received
+
+
+def send_available(dest: socket.socket, pending: bytearray) -> int:
+    """
+    Transmet autant d'octets en attente que le socket non bloquant
+    peut en accepter, les retire de `pending` et retourne leur nombre.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    total = 0
+    while pending:
+        try:
+            sent = dest.send(pending)
+        except (BlockingIOError, InterruptedError):
+            return total
+        except OSError as ex:
+            raise GLOSocketError("Cannot send data with socket") from ex
+        del pending[:sent]
+        total += sent
+    return total
+
+
+async def send_bytes_async(dest: asyncio.StreamWriter, data: bytes,
+                           compression: str | None = None) -> int:
+    """
+    Équivalent de send_bytes pour un flux asyncio. Retourne la taille
+    de la trame transmise.
+
+    Attend que le tampon d'écriture se vide (contre-pression) avant
+    de rendre la main. Lève une exception GLOSocketError en cas de
+    problème de communication.
+    """
+    length, payload = _frame_parts(data, compression)
+    dest.writelines((length, payload))
+    try:
+        await dest.drain()
+    except ConnectionError as ex:
+        raise GLOSocketError("Cannot send data with socket") from ex
+    return len(length) + len(payload)
+
+
+async def send_mesg_async(dest: asyncio.StreamWriter, message: str,
+                          compression: str | None = None) -> None:
+    """Équivalent de send_mesg pour un flux asyncio."""
+    await send_bytes_async(dest, message.encode(encoding='utf-8'), compression)
+
+
+async def recv_bytes_async(source: asyncio.StreamReader,
+                           max_size: int | None = None) -> bytes:
+    """
+    Équivalent de recv_bytes pour un flux asyncio.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
     try:
+        data_length = await source.readexactly(4)
         length, = struct.unpack("!I", data_length)
-    except struct.error as ex:
-        raise GLOSocketError("The received data was"
-                             " not the message's length") from ex
+        data = await source.readexactly(_check_length(length, max_size))
+    except (asyncio.IncompleteReadError, ConnectionError) as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    return _unframe(length, data, max_size)
+
 
-    data = _recvall(source_soc, length)
+async def recv_mesg_async(source: asyncio.StreamReader) -> str:
+    """Équivalent de recv_mesg pour un flux asyncio."""
+    data = await recv_bytes_async(source)
     return data.decode('utf-8')
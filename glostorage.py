@@ -0,0 +1,1620 @@
+"""\
+Module fournissant le stockage des boîtes de courriel du serveur.
+"""
+import array
+import collections
+import contextlib
+import email.utils
+import errno
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+from typing import Callable, Iterator, TypedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: verrouillage entre fils seulement
+    fcntl = None
+
+import gloutils
+
+_OFFSET = struct.Struct("!Q")
+# Compteurs: nombre de courriels, taille totale, inode et taille de l'index décrit.
+_COUNTERS = struct.Struct("!QQQQ")
+
+FSYNC_NONE = "none"
+FSYNC_ALWAYS = "always"
+FSYNC_BATCH = "batch"
+FSYNC_MODES = (FSYNC_NONE, FSYNC_ALWAYS, FSYNC_BATCH)
+
+
+class IndexEntry(TypedDict, total=True):
+    """Résumé d'un courriel conservé dans l'index d'une boîte."""
+    id: str
+    sender: str
+    subject: str
+    date: str
+    size: int
+    received: int
+
+
+class MailboxIndex:
+    """
+    Index persistant des courriels d'une boîte.
+
+    Chaque livraison ajoute une ligne JSON au fichier INDEX_FILENAME,
+    dans l'ordre de réception, et la position de cette ligne au fichier
+    de décalages (entiers `!Q` de taille fixe). La liste des courriels se
+    construit donc sans ouvrir les fichiers des courriels, et une page de
+    la liste ne lit que les lignes qui la composent.
+
+    Le nombre de courriels et leur taille totale sont tenus à jour dans
+    un fichier de compteurs à chaque ajout et suppression, pour répondre
+    aux statistiques sans parcourir la boîte.
+
+    Les trois fichiers ne peuvent pas être remplacés ensemble: les
+    compteurs, écrits en dernier, retiennent l'inode et la taille du
+    fichier d'index qu'ils décrivent. Des décalages ou des compteurs qui
+    ne correspondent pas à l'index, après un arrêt entre deux écritures,
+    ne sont pas utilisés: l'index est reconstruit (voir `_valid`).
+
+    Les accès sont protégés par un verrou entre fils et, lorsque `fcntl`
+    est disponible, par un verrou de fichier partagé entre processus.
+    """
+
+    def __init__(self, user_dir: str,
+                 scan: Callable[[str], Iterator[IndexEntry]] | None = None) -> None:
+        self._user_dir = user_dir
+        self._scan = scan if scan is not None else scan_files
+        self._path = os.path.join(user_dir, gloutils.INDEX_FILENAME)
+        self._offsets_path = self._path + ".off"
+        self._counters_path = self._path + ".stats"
+        self._lock = threading.Lock()
+        self._lock_path = self._path + ".lock"
+        # Position de chaque courriel, tenue à jour depuis l'index (voir positions).
+        self._positions: dict[str, int] = {}
+        self._positions_read: tuple[int, int] | None = None
+
+    def _locked(self, exclusive: bool = True) -> contextlib.AbstractContextManager:
+        """Verrouille l'index pour ce processus et les autres."""
+        return _file_lock(self._lock, self._lock_path, exclusive)
+
+    def add(self, message_id: str, email: gloutils.EmailContentPayload,
+            size: int) -> IndexEntry:
+        """Ajoute un courriel livré à la fin de l'index."""
+        return self.add_many([(message_id, email, size)])[0]
+
+    def add_many(self, deliveries: list[tuple[str, gloutils.EmailContentPayload, int]]
+                 ) -> list[IndexEntry]:
+        """
+        Ajoute des courriels livrés (identifiant, courriel, taille) à la fin
+        de l'index en une seule écriture, sous un seul verrou.
+        """
+        received = time.time_ns()
+        entries = [IndexEntry(id=message_id, sender=email["sender"],
+                              subject=email["subject"], date=email["date"],
+                              size=size, received=received)
+                   for message_id, email, size in deliveries]
+        lines = [(json.dumps(entry) + "\n").encode('utf-8') for entry in entries]
+        with self._locked():
+            if not self._valid():
+                self._rebuild()
+                return entries
+            offsets = bytearray()
+            with open(self._path, 'ab') as file:
+                position = file.seek(0, os.SEEK_END)
+                for line in lines:
+                    offsets += _OFFSET.pack(position)
+                    position += len(line)
+                file.write(b"".join(lines))
+                inode = os.fstat(file.fileno()).st_ino
+            with open(self._offsets_path, 'ab') as file:
+                file.write(offsets)
+            with open(self._counters_path, 'r+b') as file:
+                count, total_size, _, _ = _COUNTERS.unpack(file.read(_COUNTERS.size))
+                file.seek(0)
+                file.write(_COUNTERS.pack(count + len(entries),
+                                          total_size + sum(entry["size"] for entry in entries),
+                                          inode, position))
+        return entries
+
+    def stats(self) -> tuple[int, int]:
+        """Retourne le nombre de courriels et leur taille totale en octets."""
+        self._ensure()
+        with self._locked(exclusive=False):
+            with open(self._counters_path, 'rb') as file:
+                count, total_size, _, _ = _COUNTERS.unpack(file.read(_COUNTERS.size))
+            return count, total_size
+
+    def verify(self) -> bool:
+        """
+        Compare les compteurs et l'index au contenu réel de la boîte et
+        reconstruit l'index en cas d'écart. Retourne True s'ils concordaient.
+        """
+        with self._locked():
+            if self._valid():
+                with open(self._counters_path, 'rb') as file:
+                    counters = _COUNTERS.unpack(file.read(_COUNTERS.size))[:2]
+                with open(self._path, 'r', encoding='utf-8') as file:
+                    indexed = sorted(json.loads(line)["id"] for line in file if line.strip())
+            else:
+                counters, indexed = None, None
+            entries = list(self._scan(self._user_dir))
+            actual = (len(entries), sum(entry["size"] for entry in entries))
+            if counters == actual and indexed == sorted(entry["id"] for entry in entries):
+                return True
+            entries.sort(key=lambda entry: (entry["received"], _date_key(entry)))
+            self._write(entries)
+            return False
+
+    def count(self) -> int:
+        """Retourne le nombre de courriels de l'index."""
+        self._ensure()
+        with self._locked(exclusive=False):
+            return os.path.getsize(self._offsets_path) // _OFFSET.size
+
+    def entries(self) -> list[IndexEntry]:
+        """
+        Retourne les entrées de l'index, de la plus ancienne à la plus
+        récente. L'index est reconstruit s'il n'existe pas encore.
+        """
+        self._ensure()
+        with self._locked(exclusive=False):
+            with open(self._path, 'r', encoding='utf-8') as file:
+                return [json.loads(line) for line in file if line.strip()]
+
+    def page(self, offset: int, limit: int) -> tuple[list[IndexEntry], int]:
+        """
+        Retourne au plus `limit` entrées, de la plus récente à la plus
+        ancienne, en sautant les `offset` plus récentes, ainsi que le
+        nombre total d'entrées.
+        """
+        self._ensure()
+        with self._locked(exclusive=False):
+            total = os.path.getsize(self._offsets_path) // _OFFSET.size
+            stop = max(0, total - max(0, offset))
+            start = max(0, stop - max(0, limit))
+            entries = self._read_range(start, stop, total)
+        entries.reverse()
+        return entries, total
+
+    def positions(self, message_ids: list[str]) -> dict[str, int]:
+        """
+        Retourne la position dans l'index (0 pour le plus ancien) de chacun
+        des courriels demandés qui s'y trouvent. Seules les lignes ajoutées
+        depuis le dernier appel sont lues.
+        """
+        self._ensure()
+        with self._locked(exclusive=False):
+            status = os.stat(self._path)
+            inode, position = self._positions_read or (None, 0)
+            if status.st_ino != inode or status.st_size < position:
+                self._positions, position = {}, 0
+            if status.st_size > position:
+                with open(self._path, 'rb') as file:
+                    file.seek(position)
+                    data = file.read(status.st_size - position)
+                data = data[:data.rfind(b"\n") + 1]
+                for line in data.splitlines():
+                    if line.strip():
+                        self._positions[json.loads(line)["id"]] = len(self._positions)
+                self._positions_read = (status.st_ino, position + len(data))
+            return {message_id: self._positions[message_id] for message_id in message_ids
+                    if message_id in self._positions}
+
+    def _read_range(self, start: int, stop: int, total: int) -> list[IndexEntry]:
+        """Lit les entrées de positions [start, stop) de l'index."""
+        if start >= stop:
+            return []
+        with open(self._offsets_path, 'rb') as file:
+            file.seek(start * _OFFSET.size)
+            count = stop - start + (1 if stop < total else 0)
+            raw = file.read(count * _OFFSET.size)
+        offsets = [offset for offset, in _OFFSET.iter_unpack(raw)]
+        with open(self._path, 'rb') as file:
+            file.seek(offsets[0])
+            if stop < total:
+                data = file.read(offsets[-1] - offsets[0])
+            else:
+                data = file.read()
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    def remove(self, message_id: str) -> IndexEntry | None:
+        """Retire un courriel de l'index et retourne son entrée."""
+        removed = []
+
+        def without(entries: list[IndexEntry]) -> list[IndexEntry]:
+            kept = [entry for entry in entries if entry["id"] != message_id]
+            removed.extend(entry for entry in entries if entry["id"] == message_id)
+            return kept
+
+        self.rewrite(without)
+        return removed[0] if removed else None
+
+    def rewrite(self, transform: Callable[[list[IndexEntry]], list[IndexEntry]]) -> None:
+        """
+        Remplace atomiquement les entrées de l'index par le résultat de
+        `transform`, appelé sous verrou exclusif.
+        """
+        self._ensure()
+        with self._locked():
+            with open(self._path, 'r', encoding='utf-8') as file:
+                entries = [json.loads(line) for line in file if line.strip()]
+            self._write(transform(entries))
+
+    def rebuild(self) -> list[IndexEntry]:
+        """Reconstruit l'index à partir des fichiers de la boîte."""
+        with self._locked():
+            return self._rebuild()
+
+    def _valid(self) -> bool:
+        """
+        Indique si l'index existe et si ses décalages et ses compteurs
+        décrivent bien le fichier d'index courant.
+        """
+        try:
+            status = os.stat(self._path)
+            with open(self._counters_path, 'rb') as file:
+                count, _, inode, index_size = _COUNTERS.unpack(file.read(_COUNTERS.size))
+            offsets_size = os.path.getsize(self._offsets_path)
+        except (OSError, struct.error):
+            return False
+        return (inode == status.st_ino and index_size == status.st_size
+                and offsets_size == count * _OFFSET.size)
+
+    def _ensure(self) -> None:
+        """Construit l'index s'il n'existe pas encore ou s'il est incohérent."""
+        if not self._valid():
+            with self._locked():
+                if not self._valid():
+                    self._rebuild()
+
+    def _rebuild(self) -> list[IndexEntry]:
+        entries = list(self._scan(self._user_dir))
+        entries.sort(key=lambda entry: (entry["received"], _date_key(entry)))
+        self._write(entries)
+        return entries
+
+    def _write(self, entries: list[IndexEntry]) -> None:
+        """
+        Réécrit l'index, puis ses décalages, puis ses compteurs, chacun
+        remplacé atomiquement. Jusqu'au remplacement des compteurs, qui
+        désignent le nouvel index, l'ensemble n'est pas `_valid`.
+        """
+        data = bytearray()
+        offsets = bytearray()
+        for entry in entries:
+            offsets += _OFFSET.pack(len(data))
+            data += (json.dumps(entry) + "\n").encode('utf-8')
+        inode = self._replace(self._path, data)
+        self._replace(self._offsets_path, offsets)
+        self._replace(self._counters_path, _COUNTERS.pack(
+            len(entries), sum(entry["size"] for entry in entries), inode, len(data)))
+        self._positions_read = None
+
+    @staticmethod
+    def _replace(path: str, content: bytes) -> int:
+        """Remplace atomiquement le contenu d'un fichier et retourne son inode."""
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+            inode = os.fstat(file.fileno()).st_ino
+        os.replace(temp_path, path)
+        return inode
+
+
+def _date_key(entry: IndexEntry) -> float:
+    """
+    Clé de tri secondaire basée sur la date du courriel, pour départager
+    les fichiers dont la date de modification est identique.
+    """
+    try:
+        return email.utils.parsedate_to_datetime(entry["date"]).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+@contextlib.contextmanager
+def _file_lock(thread_lock: threading.Lock, path: str,
+               exclusive: bool = True) -> Iterator[None]:
+    """
+    Verrou entre fils et, lorsque `fcntl` est disponible, entre processus
+    à l'aide d'un flock sur le fichier `path`.
+    """
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def scan_files(user_dir: str) -> Iterator[IndexEntry]:
+    """
+    Parcourt les fichiers de courriels d'une boîte: ceux à la racine
+    (anciens courriels nommés d'après leur sujet) et ceux de MAIL_DIRNAME.
+    La taille d'un courriel reçu en continu inclut son fichier de corps,
+    comme celle retournée par `FileStore.deliver`.
+    """
+    paths = [os.path.join(user_dir, filename) for filename in os.listdir(user_dir)
+             if filename.endswith(".json")]
+    for root, _, filenames in os.walk(os.path.join(user_dir, gloutils.MAIL_DIRNAME)):
+        paths.extend(os.path.join(root, filename) for filename in filenames
+                     if filename.endswith(".json"))
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                email_content = json.load(file)
+            status = os.stat(path)
+        except (OSError, json.JSONDecodeError):
+            continue
+        size = status.st_size
+        body_id = email_content.get("body")
+        if isinstance(body_id, str):
+            with contextlib.suppress(OSError):
+                size += os.path.getsize(os.path.join(user_dir, body_id))
+        message_id = os.path.relpath(path, user_dir).replace(os.sep, "/")
+        yield IndexEntry(id=message_id, sender=email_content["sender"],
+                         subject=email_content["subject"],
+                         date=email_content["date"],
+                         size=size,
+                         received=status.st_mtime_ns)
+
+
+def _fsync_path(path: str, directory: bool = False) -> None:
+    """Force l'écriture sur disque d'un fichier ou d'un dossier."""
+    if directory and os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Batch:
+    """Fichiers et dossiers d'un lot de `_GroupCommitter`, et son résultat."""
+
+    __slots__ = ("files", "dirs", "done", "error")
+
+    def __init__(self) -> None:
+        self.files: list[str] = []
+        self.dirs: list[str] = []
+        self.done = False
+        self.error: OSError | None = None
+
+
+class _GroupCommitter:
+    """
+    Regroupe les fsync de livraisons concurrentes (group commit).
+
+    Chaque livraison inscrit ses fichiers dans le lot en cours et attend
+    qu'il soit écrit sur disque; le lot est fermé `interval` secondes après
+    sa première inscription, et chaque dossier n'y est synchronisé qu'une
+    fois. Une erreur de synchronisation n'est levée que dans les livraisons
+    du lot qui a échoué; les lots suivants sont synchronisés normalement.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._condition = threading.Condition()
+        self._batch = _Batch()
+        threading.Thread(target=self._run, name="glo-group-commit",
+                         daemon=True).start()
+
+    def commit(self, files: list[str], dirs: list[str]) -> None:
+        """Attend que les fichiers et dossiers soient écrits sur disque."""
+        with self._condition:
+            batch = self._batch
+            batch.files.extend(files)
+            batch.dirs.extend(dirs)
+            self._condition.notify_all()
+            while not batch.done:
+                self._condition.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._batch.files and not self._batch.dirs:
+                    self._condition.wait()
+            time.sleep(self._interval)
+            with self._condition:
+                batch, self._batch = self._batch, _Batch()
+            try:
+                for path in dict.fromkeys(batch.files):
+                    try:
+                        _fsync_path(path)
+                    except FileNotFoundError:
+                        pass
+                for path in dict.fromkeys(batch.dirs):
+                    _fsync_path(path, directory=True)
+            except OSError as ex:
+                batch.error = ex
+            with self._condition:
+                batch.done = True
+                self._condition.notify_all()
+
+
+class FileStore:
+    """
+    Stockage des courriels à raison d'un fichier par courriel.
+
+    Chaque courriel reçoit un identifiant unique et est écrit dans un
+    fichier temporaire puis renommé, de sorte qu'un lecteur ne voit jamais
+    de courriel partiel et que deux sujets identiques ne s'écrasent pas.
+    Les fichiers sont répartis dans MAIL_DIRNAME sur `fanout` niveaux de
+    sous-dossiers (deux caractères hexadécimaux par niveau) pour garder des
+    dossiers de taille raisonnable.
+
+    `fsync` vaut FSYNC_NONE (cache du système), FSYNC_ALWAYS (chaque
+    livraison est synchronisée avant d'être confirmée) ou FSYNC_BATCH
+    (les livraisons concurrentes partagent les synchronisations, au plus
+    `fsync_interval` secondes d'attente).
+
+    Les identifiants retournés sont des chemins relatifs au dossier de la
+    boîte; les anciens courriels à la racine restent donc lisibles.
+    """
+
+    def __init__(self, fanout: int = 2, fsync: str = FSYNC_NONE,
+                 fsync_interval: float = 0.005) -> None:
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f"Unknown fsync mode: {fsync}")
+        self._fanout = fanout
+        self._fsync = fsync
+        self._committer = _GroupCommitter(fsync_interval) if fsync == FSYNC_BATCH else None
+
+    def _new_location(self, mailbox_dir: str) -> tuple[str, str]:
+        """Retourne un nouvel identifiant et son dossier, créé au besoin."""
+        name = uuid.uuid4().hex
+        parts = [gloutils.MAIL_DIRNAME]
+        parts += [name[2 * level:2 * level + 2] for level in range(self._fanout)]
+        directory = os.path.join(mailbox_dir, *parts)
+        os.makedirs(directory, exist_ok=True)
+        return "/".join(parts + [name]), directory
+
+    def body_temp_path(self, mailbox_dir: str) -> str:
+        """Retourne un chemin temporaire où recevoir un corps en continu."""
+        os.makedirs(os.path.join(mailbox_dir, gloutils.MAIL_DIRNAME), exist_ok=True)
+        return os.path.join(mailbox_dir, gloutils.MAIL_DIRNAME,
+                            f".{uuid.uuid4().hex}.body.tmp")
+
+    def deliver(self, mailbox_dir: str, email: gloutils.EmailContentPayload,
+                body_path: str | None = None) -> tuple[str, int]:
+        """
+        Écrit un courriel dans la boîte et retourne son identifiant et sa
+        taille sur disque. Si `body_path` est fourni, ce fichier (reçu en
+        continu) devient le corps du courriel.
+        """
+        base_id, directory = self._new_location(mailbox_dir)
+        message_id = base_id + ".json"
+        path = os.path.join(mailbox_dir, message_id)
+        written = []
+        size = 0
+
+        if body_path is not None:
+            body_id = base_id + ".body"
+            if self._fsync == FSYNC_ALWAYS:
+                _fsync_path(body_path)
+            os.replace(body_path, os.path.join(mailbox_dir, body_id))
+            written.append(os.path.join(mailbox_dir, body_id))
+            size += os.path.getsize(written[-1])
+            email = dict(email, content="", body=body_id)
+
+        data = json.dumps(dict(email)).encode('utf-8')
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+            if self._fsync == FSYNC_ALWAYS:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        written.append(path)
+        size += len(data)
+
+        if self._fsync == FSYNC_ALWAYS:
+            _fsync_path(directory, directory=True)
+        elif self._committer is not None:
+            self._committer.commit(written, [directory])
+        return message_id, size
+
+    def load_header(self, mailbox_dir: str,
+                    message_id: str) -> tuple[gloutils.EmailContentPayload, int]:
+        """
+        Retourne le courriel sans son contenu et la taille en octets de
+        son corps.
+        """
+        email = self._read(mailbox_dir, message_id)
+        body_id = email.pop("body", None)
+        if body_id is None:
+            size = len(email["content"].encode('utf-8'))
+        else:
+            size = os.path.getsize(os.path.join(mailbox_dir, body_id))
+        email["content"] = ""
+        return email, size
+
+    def iter_body(self, mailbox_dir: str, message_id: str,
+                  chunk_size: int) -> Iterator[bytes]:
+        """Produit le corps du courriel par morceaux d'au plus `chunk_size` octets."""
+        email = self._read(mailbox_dir, message_id)
+        body_id = email.get("body")
+        if body_id is None:
+            data = email["content"].encode('utf-8')
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+            return
+        with open(os.path.join(mailbox_dir, body_id), 'rb') as file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+
+    def load(self, mailbox_dir: str, message_id: str) -> gloutils.EmailContentPayload:
+        """Retourne le courriel complet."""
+        email = self._read(mailbox_dir, message_id)
+        body_id = email.pop("body", None)
+        if body_id is not None:
+            with open(os.path.join(mailbox_dir, body_id), 'r', encoding='utf-8') as file:
+                email["content"] = file.read()
+        return email
+
+    def delete(self, mailbox_dir: str, message_id: str) -> None:
+        """Supprime un courriel et son corps."""
+        path = os.path.join(mailbox_dir, message_id)
+        try:
+            body_id = self._read(mailbox_dir, message_id).get("body")
+        except (OSError, json.JSONDecodeError):
+            body_id = None
+        for target in (path, body_id and os.path.join(mailbox_dir, body_id)):
+            if target:
+                try:
+                    os.remove(target)
+                except FileNotFoundError:
+                    pass
+
+    def scan(self, mailbox_dir: str) -> Iterator[IndexEntry]:
+        """Parcourt les courriels de la boîte pour reconstruire son index."""
+        return scan_files(mailbox_dir)
+
+    def compact(self, mailbox_dir: str, index: MailboxIndex) -> tuple[int, dict[str, str]]:
+        """Rien à compacter: chaque suppression libère déjà son espace."""
+        return 0, {}
+
+    def close(self) -> None:
+        """Rien à fermer: chaque lecture ouvre et ferme son fichier."""
+
+    def _read(self, mailbox_dir: str, message_id: str) -> dict:
+        with open(os.path.join(mailbox_dir, message_id), 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+
+SEGMENTS_DIRNAME = "segments"
+_SEGMENT_ID_PREFIX = "seg:"
+_RECORD = struct.Struct("!BIQQ")
+_RECORD_DELETED = 1
+
+
+class SegmentStore:
+    """
+    Stockage des courriels dans des segments en ajout seul.
+
+    Chaque boîte possède des fichiers segments (SEGMENTS_DIRNAME) où une
+    livraison est un unique ajout d'enregistrement: une entête `!BIQQ`
+    (drapeaux, taille de l'entête JSON, taille du corps, heure de
+    réception), le courriel sans contenu en JSON, puis le corps brut.
+    L'identifiant `seg:<segment>:<position>` donne directement l'endroit
+    où lire l'enregistrement; les lectures passent par `mmap` et ne
+    décodent que l'entête JSON.
+
+    Une suppression marque l'enregistrement; `compact` réécrit les
+    segments sans les enregistrements supprimés. Les courriels d'un
+    FileStore déjà présents dans la boîte restent lisibles.
+
+    Au plus `map_capacity` projections (chacune retient un descripteur)
+    sont conservées, les moins récemment lues étant évincées. Chaque
+    lecture réserve sa projection (voir `_record`): une projection
+    évincée est fermée dès sa dernière lecture en cours terminée, par
+    exemple un `iter_body`. `close` ferme toutes les projections.
+    """
+
+    def __init__(self, segment_size: int = 64 * 1024 * 1024,
+                 fsync: str = FSYNC_NONE, fsync_interval: float = 0.005,
+                 map_capacity: int = 256) -> None:
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f"Unknown fsync mode: {fsync}")
+        self._segment_size = segment_size
+        self._fsync = fsync
+        self._committer = _GroupCommitter(fsync_interval) if fsync == FSYNC_BATCH else None
+        self._legacy = FileStore(fsync=fsync, fsync_interval=fsync_interval)
+        self._locks: dict[str, threading.Lock] = {}
+        self._map_capacity = map_capacity
+        self._maps: collections.OrderedDict[str, mmap.mmap] = collections.OrderedDict()
+        # Lectures en cours par projection, et projections évincées qui
+        # attendent la fin de leurs lectures pour être fermées (par id).
+        self._leases: dict[int, int] = {}
+        self._retired: dict[int, mmap.mmap] = {}
+        self._maps_lock = threading.Lock()
+
+    def _segments_dir(self, mailbox_dir: str) -> str:
+        return os.path.join(mailbox_dir, SEGMENTS_DIRNAME)
+
+    def _segment_path(self, mailbox_dir: str, segment: int) -> str:
+        return os.path.join(self._segments_dir(mailbox_dir), f"{segment:08d}.seg")
+
+    def _segments(self, mailbox_dir: str) -> list[int]:
+        try:
+            names = os.listdir(self._segments_dir(mailbox_dir))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith(".seg"))
+
+    def _locked(self, mailbox_dir: str) -> contextlib.AbstractContextManager:
+        """Verrouille les segments de la boîte pour ce processus et les autres."""
+        thread_lock = self._locks.setdefault(mailbox_dir, threading.Lock())
+        os.makedirs(self._segments_dir(mailbox_dir), exist_ok=True)
+        return _file_lock(thread_lock, os.path.join(self._segments_dir(mailbox_dir), ".lock"))
+
+    def body_temp_path(self, mailbox_dir: str) -> str:
+        """Retourne un chemin temporaire où recevoir un corps en continu."""
+        os.makedirs(self._segments_dir(mailbox_dir), exist_ok=True)
+        return os.path.join(self._segments_dir(mailbox_dir), f".{uuid.uuid4().hex}.body.tmp")
+
+    def deliver(self, mailbox_dir: str, email: gloutils.EmailContentPayload,
+                body_path: str | None = None) -> tuple[str, int]:
+        """
+        Ajoute un courriel au segment courant et retourne son identifiant
+        et la taille de l'enregistrement.
+        """
+        header = dict(email)
+        content = header.pop("content", "")
+        header_data = json.dumps(header).encode('utf-8')
+        if body_path is None:
+            body = content.encode('utf-8')
+            body_size = len(body)
+        else:
+            body = None
+            body_size = os.path.getsize(body_path)
+        record_head = _RECORD.pack(0, len(header_data), body_size, time.time_ns())
+
+        with self._locked(mailbox_dir):
+            segments = self._segments(mailbox_dir)
+            segment = segments[-1] if segments else 1
+            path = self._segment_path(mailbox_dir, segment)
+            if os.path.exists(path) and os.path.getsize(path) >= self._segment_size:
+                segment += 1
+                path = self._segment_path(mailbox_dir, segment)
+            with open(path, 'ab') as file:
+                position = file.seek(0, os.SEEK_END)
+                file.write(record_head)
+                file.write(header_data)
+                if body is not None:
+                    file.write(body)
+                else:
+                    with open(body_path, 'rb') as body_file:
+                        shutil.copyfileobj(body_file, file, gloutils.STREAM_CHUNK_SIZE)
+                if self._fsync == FSYNC_ALWAYS:
+                    file.flush()
+                    os.fsync(file.fileno())
+        if body_path is not None:
+            os.remove(body_path)
+        if self._committer is not None:
+            self._committer.commit([path], [self._segments_dir(mailbox_dir)])
+        return (f"{_SEGMENT_ID_PREFIX}{segment}:{position}",
+                _RECORD.size + len(header_data) + body_size)
+
+    @contextlib.contextmanager
+    def _record(self, mailbox_dir: str,
+                message_id: str) -> Iterator[tuple[mmap.mmap, int, int, int]]:
+        """
+        Fournit la projection du segment, la position et la taille de
+        l'entête JSON et la taille du corps d'un enregistrement. La
+        projection reste réservée, donc ouverte, jusqu'à la fin du bloc.
+        """
+        segment, position = (int(part) for part in
+                             message_id[len(_SEGMENT_ID_PREFIX):].split(":"))
+        path = self._segment_path(mailbox_dir, segment)
+        mapping = self._map(path, position + _RECORD.size)
+        try:
+            flags, header_size, body_size, _ = _RECORD.unpack_from(mapping, position)
+            if flags & _RECORD_DELETED:
+                raise FileNotFoundError(message_id)
+            header_start = position + _RECORD.size
+            if len(mapping) < header_start + header_size + body_size:
+                larger = self._map(path, header_start + header_size + body_size)
+                self._release(mapping)
+                mapping = larger
+            yield mapping, header_start, header_size, body_size
+        finally:
+            self._release(mapping)
+
+    def _map(self, path: str, size: int) -> mmap.mmap:
+        """
+        Réserve une projection du segment d'au moins `size` octets, du
+        cache si elle y est, sinon d'une nouvelle projection mise en cache.
+        Chaque réservation est rendue par `_release`.
+        """
+        with self._maps_lock:
+            mapping = self._maps.get(path)
+            if mapping is not None and len(mapping) >= size:
+                self._maps.move_to_end(path)
+                self._leases[id(mapping)] += 1
+                return mapping
+        with open(path, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        with self._maps_lock:
+            previous = self._maps.pop(path, None)
+            if previous is not None:
+                self._retire(previous)
+            self._maps[path] = mapping
+            self._leases[id(mapping)] = 1
+            while len(self._maps) > self._map_capacity:
+                self._retire(self._maps.popitem(last=False)[1])
+        return mapping
+
+    def _release(self, mapping: mmap.mmap) -> None:
+        """Rend une réservation; ferme la projection si elle a été évincée."""
+        with self._maps_lock:
+            if id(mapping) not in self._leases:  # déjà fermée par `close`
+                return
+            self._leases[id(mapping)] -= 1
+            if id(mapping) in self._retired:
+                self._retire(mapping)
+
+    def _retire(self, mapping: mmap.mmap) -> None:
+        """
+        Ferme une projection retirée du cache, ou la garde jusqu'à la fin
+        de ses lectures en cours. Appelé sous `_maps_lock`.
+        """
+        if self._leases[id(mapping)]:
+            self._retired[id(mapping)] = mapping
+            return
+        del self._leases[id(mapping)]
+        self._retired.pop(id(mapping), None)
+        mapping.close()
+
+    def close(self) -> None:
+        """Ferme les projections conservées."""
+        with self._maps_lock:
+            mappings = list(self._maps.values()) + list(self._retired.values())
+            self._maps.clear()
+            self._retired.clear()
+            self._leases.clear()
+        for mapping in mappings:
+            mapping.close()
+
+    def load_header(self, mailbox_dir: str,
+                    message_id: str) -> tuple[gloutils.EmailContentPayload, int]:
+        """
+        Retourne le courriel sans son contenu et la taille en octets de
+        son corps, en ne décodant que l'entête de l'enregistrement.
+        """
+        if not message_id.startswith(_SEGMENT_ID_PREFIX):
+            return self._legacy.load_header(mailbox_dir, message_id)
+        with self._record(mailbox_dir, message_id) as (mapping, start, header_size, body_size):
+            email = json.loads(mapping[start:start + header_size])
+        email["content"] = ""
+        return email, body_size
+
+    def iter_body(self, mailbox_dir: str, message_id: str,
+                  chunk_size: int) -> Iterator[bytes]:
+        """Produit le corps du courriel par tranches de la projection."""
+        if not message_id.startswith(_SEGMENT_ID_PREFIX):
+            yield from self._legacy.iter_body(mailbox_dir, message_id, chunk_size)
+            return
+        with self._record(mailbox_dir, message_id) as (mapping, start, header_size, body_size):
+            body_start = start + header_size
+            for offset in range(body_start, body_start + body_size, chunk_size):
+                yield mapping[offset:min(offset + chunk_size, body_start + body_size)]
+
+    def load(self, mailbox_dir: str, message_id: str) -> gloutils.EmailContentPayload:
+        """Retourne le courriel complet."""
+        if not message_id.startswith(_SEGMENT_ID_PREFIX):
+            return self._legacy.load(mailbox_dir, message_id)
+        with self._record(mailbox_dir, message_id) as (mapping, start, header_size, body_size):
+            email = json.loads(mapping[start:start + header_size])
+            body_start = start + header_size
+            email["content"] = str(mapping[body_start:body_start + body_size], 'utf-8')
+        return email
+
+    def delete(self, mailbox_dir: str, message_id: str) -> None:
+        """Marque l'enregistrement comme supprimé; `compact` libère l'espace."""
+        if not message_id.startswith(_SEGMENT_ID_PREFIX):
+            self._legacy.delete(mailbox_dir, message_id)
+            return
+        segment, position = (int(part) for part in
+                             message_id[len(_SEGMENT_ID_PREFIX):].split(":"))
+        with self._locked(mailbox_dir):
+            with open(self._segment_path(mailbox_dir, segment), 'r+b') as file:
+                file.seek(position)
+                flags = file.read(1)[0]
+                file.seek(position)
+                file.write(bytes([flags | _RECORD_DELETED]))
+
+    def _records(self, path: str) -> Iterator[tuple[int, int, bytes, int, int]]:
+        """
+        Parcourt les enregistrements d'un segment: position, drapeaux,
+        entête JSON, taille du corps et heure de réception.
+        """
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                position = 0
+                while position + _RECORD.size <= len(mapping):
+                    flags, header_size, body_size, received = _RECORD.unpack_from(mapping, position)
+                    header_start = position + _RECORD.size
+                    if header_start + header_size + body_size > len(mapping):
+                        return
+                    yield (position, flags, mapping[header_start:header_start + header_size],
+                           body_size, received)
+                    position = header_start + header_size + body_size
+
+    def scan(self, mailbox_dir: str) -> Iterator[IndexEntry]:
+        """
+        Parcourt les enregistrements non supprimés des segments, puis les
+        courriels d'un FileStore, pour reconstruire l'index.
+        """
+        for segment in self._segments(mailbox_dir):
+            for position, flags, header, body_size, received in self._records(
+                    self._segment_path(mailbox_dir, segment)):
+                if flags & _RECORD_DELETED:
+                    continue
+                email = json.loads(header)
+                yield IndexEntry(id=f"{_SEGMENT_ID_PREFIX}{segment}:{position}",
+                                 sender=email["sender"], subject=email["subject"],
+                                 date=email["date"],
+                                 size=_RECORD.size + len(header) + body_size,
+                                 received=received)
+        yield from self._legacy.scan(mailbox_dir)
+
+    def compact(self, mailbox_dir: str, index: MailboxIndex) -> tuple[int, dict[str, str]]:
+        """
+        Réécrit les segments scellés de la boîte (tous sauf le segment
+        courant, où se font les ajouts) sans les enregistrements supprimés
+        ni ceux absents de l'index, met l'index à jour avec les nouvelles
+        positions et retourne le nombre d'octets récupérés et le nouvel
+        identifiant de chaque courriel déplacé.
+        """
+        reclaimed = 0
+        moved: dict[str, str] = {}
+
+        def relocate(entries: list[IndexEntry]) -> list[IndexEntry]:
+            nonlocal reclaimed
+            live = {entry["id"] for entry in entries}
+            segments = self._segments(mailbox_dir)
+            old_segments = segments[:-1]
+            if not old_segments:
+                return entries
+            segment = segments[-1] + 1
+            output = open(self._segment_path(mailbox_dir, segment), 'wb')
+            try:
+                for old_segment in old_segments:
+                    path = self._segment_path(mailbox_dir, old_segment)
+                    reclaimed += os.path.getsize(path)
+                    with open(path, 'rb') as source:
+                        for position, flags, header, body_size, _ in self._records(path):
+                            message_id = f"{_SEGMENT_ID_PREFIX}{old_segment}:{position}"
+                            if flags & _RECORD_DELETED or message_id not in live:
+                                continue
+                            if output.tell() >= self._segment_size:
+                                output.close()
+                                segment += 1
+                                output = open(self._segment_path(mailbox_dir, segment), 'wb')
+                            moved[message_id] = f"{_SEGMENT_ID_PREFIX}{segment}:{output.tell()}"
+                            source.seek(position)
+                            remaining = _RECORD.size + len(header) + body_size
+                            reclaimed -= remaining
+                            while remaining:
+                                data = source.read(min(remaining, gloutils.STREAM_CHUNK_SIZE))
+                                output.write(data)
+                                remaining -= len(data)
+                output.flush()
+                os.fsync(output.fileno())
+            finally:
+                output.close()
+            for old_segment in old_segments:
+                path = self._segment_path(mailbox_dir, old_segment)
+                with self._maps_lock:
+                    mapping = self._maps.pop(path, None)
+                    if mapping is not None:
+                        self._retire(mapping)
+                os.remove(path)
+            return [dict(entry, id=moved.get(entry["id"], entry["id"])) for entry in entries]
+
+        with self._locked(mailbox_dir):
+            index.rewrite(relocate)
+        return reclaimed, moved
+
+
+MailStore = FileStore | SegmentStore
+
+
+SEARCH_DIRNAME = "search"
+SEARCH_DELTA_LIMIT = 512
+SEARCH_MERGE_FACTOR = 4
+_SEARCH_MAGIC = b"GLOS"
+# Entête d'un segment: magique, nombre de termes, de documents, position de la table.
+_SEARCH_HEADER = struct.Struct("<4sIIQ")
+# Entrée de la table: position du terme, longueur du terme, nombre de documents.
+_SEARCH_TERM = struct.Struct("<QHI")
+_TOKEN_PATTERN = re.compile(r"\w+")
+_COMBINING_PATTERN = re.compile("[\u0300-\u036f]")
+_MAX_TERM_LENGTH = 64
+_MAX_TERM_FREQUENCY = 255
+# Poids des termes de l'expéditeur et du sujet par rapport à ceux du corps.
+_FIELD_WEIGHT = 2
+
+
+def tokenize(text: str) -> list[str]:
+    """Découpe un texte en termes de recherche: minuscules, sans accents."""
+    folded = _COMBINING_PATTERN.sub("", unicodedata.normalize("NFKD", text.lower()))
+    return [term for term in _TOKEN_PATTERN.findall(folded)
+            if len(term) <= _MAX_TERM_LENGTH]
+
+
+def _document_terms(email_content: gloutils.EmailContentPayload) -> dict[str, int]:
+    """Fréquence pondérée de chaque terme d'un courriel."""
+    counts = collections.Counter(tokenize(email_content.get("content", "")))
+    for term in tokenize(f"{email_content['sender']} {email_content['subject']}"):
+        counts[term] += _FIELD_WEIGHT
+    return {term: min(count, _MAX_TERM_FREQUENCY) for term, count in counts.items()}
+
+
+def _little_endian(docs: array.array) -> bytes:
+    if sys.byteorder == "big":
+        docs = array.array("I", docs)
+        docs.byteswap()
+    return docs.tobytes()
+
+
+class _SearchSegment:
+    """
+    Segment immuable de l'index de recherche, projeté en mémoire.
+
+    Après l'entête viennent, pour chaque terme en ordre d'octets UTF-8, le
+    terme, les numéros de ses documents en ordre croissant (entiers de 32
+    bits) et la fréquence du terme dans chacun (un octet), puis la table
+    des termes (_SEARCH_TERM) où un terme est cherché par dichotomie.
+    """
+
+    __slots__ = ("name", "level", "map", "terms", "documents", "table")
+
+    def __init__(self, path: str, name: str, level: int) -> None:
+        self.name = name
+        self.level = level
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.terms, self.documents, self.table = _SEARCH_HEADER.unpack_from(self.map)
+        if magic != _SEARCH_MAGIC:
+            self.map.close()
+            raise ValueError(f"Invalid search segment: {path}")
+
+    def _entry(self, index: int) -> tuple[bytes, int, int]:
+        offset, length, frequency = _SEARCH_TERM.unpack_from(
+            self.map, self.table + index * _SEARCH_TERM.size)
+        return self.map[offset:offset + length], offset + length, frequency
+
+    def postings(self, term: bytes) -> tuple[array.array, bytes] | None:
+        """Retourne les documents du terme et les fréquences, ou None."""
+        low, high = 0, self.terms
+        while low < high:
+            middle = (low + high) // 2
+            candidate, start, frequency = self._entry(middle)
+            if candidate < term:
+                low = middle + 1
+            elif candidate > term:
+                high = middle
+            else:
+                docs = array.array("I")
+                docs.frombytes(self.map[start:start + 4 * frequency])
+                if sys.byteorder == "big":
+                    docs.byteswap()
+                return docs, self.map[start + 4 * frequency:start + 5 * frequency]
+        return None
+
+    def raw_terms(self) -> Iterator[tuple[bytes, bytes, bytes]]:
+        """Parcourt les termes en ordre avec leurs documents et fréquences encodés."""
+        for index in range(self.terms):
+            term, start, frequency = self._entry(index)
+            yield (term, self.map[start:start + 4 * frequency],
+                   self.map[start + 4 * frequency:start + 5 * frequency])
+
+    def close(self) -> None:
+        self.map.close()
+
+
+def _write_search_segment(path: str, terms: Iterator[tuple[bytes, bytes, bytes]],
+                          documents: int) -> None:
+    """Écrit atomiquement un segment à partir de termes triés déjà encodés."""
+    temp_path = path + ".tmp"
+    table = bytearray()
+    count = 0
+    with open(temp_path, 'wb') as file:
+        file.write(bytes(_SEARCH_HEADER.size))
+        position = _SEARCH_HEADER.size
+        for term, docs, frequencies in terms:
+            table += _SEARCH_TERM.pack(position, len(term), len(frequencies))
+            file.write(term)
+            file.write(docs)
+            file.write(frequencies)
+            position += len(term) + len(docs) + len(frequencies)
+            count += 1
+        file.write(table)
+        file.seek(0)
+        file.write(_SEARCH_HEADER.pack(_SEARCH_MAGIC, count, documents, position))
+    os.replace(temp_path, path)
+
+
+def _merged_terms(segments: list[_SearchSegment]) -> Iterator[tuple[bytes, bytes, bytes]]:
+    """
+    Fusionne les termes de segments consécutifs: les documents d'un terme
+    sont concaténés dans l'ordre des segments, donc restent croissants.
+    """
+    streams = [((term, number, docs, frequencies)
+                for term, docs, frequencies in segment.raw_terms())
+               for number, segment in enumerate(segments)]
+    current, docs_parts, frequency_parts = None, [], []
+    for term, _, docs, frequencies in heapq.merge(*streams):
+        if term != current and current is not None:
+            yield current, b"".join(docs_parts), b"".join(frequency_parts)
+            docs_parts, frequency_parts = [], []
+        current = term
+        docs_parts.append(docs)
+        frequency_parts.append(frequencies)
+    if current is not None:
+        yield current, b"".join(docs_parts), b"".join(frequency_parts)
+
+
+class SearchIndex:
+    """
+    Index inversé persistant de l'expéditeur, du sujet et du contenu des
+    courriels d'une boîte, dans le dossier SEARCH_DIRNAME.
+
+    - `docs` liste les identifiants des courriels indexés, un par ligne; le
+      numéro de ligne est le numéro de document.
+    - `delta` contient une ligne JSON (document et fréquence de ses termes)
+      par courriel ajouté depuis le dernier segment. Au-delà de
+      SEARCH_DELTA_LIMIT courriels, il est écrit en un segment immuable
+      (_SearchSegment), et SEARCH_MERGE_FACTOR segments consécutifs de même
+      niveau sont fusionnés en un segment du niveau suivant.
+    - `deleted` liste les documents supprimés, écartés des résultats.
+    - `manifest` décrit les segments en service; il est remplacé
+      atomiquement à chaque écriture de segment.
+
+    Un ajout n'écrit donc que quelques lignes, et une recherche cherche
+    chaque terme par dichotomie dans chaque segment et dans le delta gardé
+    en mémoire, sans lire les courriels. Les fichiers en ajout seul sont
+    relus à partir de la dernière position lue, ce qui garde ce processus
+    à jour des ajouts des autres.
+
+    Les accès sont protégés par le même type de verrou que MailboxIndex.
+    """
+
+    def __init__(self, user_dir: str) -> None:
+        self._dir = os.path.join(user_dir, SEARCH_DIRNAME)
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(user_dir, SEARCH_DIRNAME + ".lock")
+        self._manifest_path = os.path.join(self._dir, "manifest")
+        self._docs_path = os.path.join(self._dir, "docs")
+        self._delta_path = os.path.join(self._dir, "delta")
+        self._deleted_path = os.path.join(self._dir, "deleted")
+        self._manifest_stamp: tuple | None = None
+        self._generation = -1
+        self._next_segment = 0
+        self._segments: list[_SearchSegment] = []
+        self._ids: list[str] = []
+        self._numbers: dict[str, int] | None = None
+        self._delta: dict[str, dict[int, int]] = {}
+        self._delta_documents = 0
+        self._deleted: set[int] = set()
+        self._read: dict[str, tuple[int, int]] = {}
+
+    def _locked(self, exclusive: bool = True) -> contextlib.AbstractContextManager:
+        return _file_lock(self._lock, self._lock_path, exclusive)
+
+    def exists(self) -> bool:
+        """Indique si l'index a été construit."""
+        return os.path.exists(self._manifest_path)
+
+    def ensure(self, documents: Callable[[], Iterator[tuple[str, gloutils.EmailContentPayload]]]
+               ) -> None:
+        """
+        Construit l'index à partir des courriels (identifiant, courriel)
+        retournés par `documents` s'il n'existe pas encore.
+        """
+        if self.exists():
+            return
+        with self._locked():
+            if not self.exists():
+                self._build(documents())
+
+    def rebuild(self, documents: Iterator[tuple[str, gloutils.EmailContentPayload]]) -> None:
+        """Reconstruit l'index à partir des courriels (identifiant, courriel)."""
+        with self._locked():
+            self._build(documents)
+
+    def add(self, documents: list[tuple[str, gloutils.EmailContentPayload]]) -> None:
+        """
+        Indexe des courriels livrés (identifiant, courriel). Rien n'est fait
+        si l'index n'existe pas encore: il les inclura à sa construction.
+        Un courriel déjà indexé est ignoré.
+        """
+        with self._locked():
+            if not self.exists():
+                return
+            self._refresh()
+            numbers = self._id_numbers()
+            ids, lines = [], []
+            for message_id, email_content in documents:
+                if message_id in numbers:
+                    continue
+                number = len(self._ids) + len(ids)
+                numbers[message_id] = number
+                ids.append(message_id + "\n")
+                lines.append(json.dumps({"doc": number,
+                                         "terms": _document_terms(email_content)}) + "\n")
+            if not ids:
+                return
+            with open(self._docs_path, 'a', encoding='utf-8') as file:
+                file.write("".join(ids))
+            with open(self._delta_path, 'a', encoding='utf-8') as file:
+                file.write("".join(lines))
+            self._refresh()
+            if self._delta_documents >= SEARCH_DELTA_LIMIT:
+                self._flush()
+
+    def remove(self, message_id: str) -> None:
+        """Retire un courriel des résultats de recherche."""
+        with self._locked():
+            if not self.exists():
+                return
+            self._refresh()
+            number = self._id_numbers().get(message_id)
+            if number is not None and number not in self._deleted:
+                with open(self._deleted_path, 'a', encoding='utf-8') as file:
+                    file.write(f"{number}\n")
+
+    def rename(self, renamed: dict[str, str]) -> None:
+        """Remplace les identifiants de courriels déplacés par le stockage."""
+        with self._locked():
+            if not self.exists() or not renamed:
+                return
+            self._refresh()
+            self._write_lines(self._docs_path, [renamed.get(message_id, message_id)
+                                                for message_id in self._ids])
+            manifest = self._manifest()
+            manifest["generation"] += 1
+            self._write_manifest(manifest)
+
+    def search(self, query: str, offset: int = 0, limit: int = gloutils.INBOX_PAGE_SIZE
+               ) -> tuple[list[str], int]:
+        """
+        Retourne les identifiants des courriels qui contiennent tous les
+        termes de `query`, du plus pertinent au moins pertinent (à
+        pertinence égale, du plus récent au plus ancien), en sautant les
+        `offset` premiers et au plus `limit`, ainsi que le nombre total.
+
+        La pertinence est la somme, pour chaque terme, de sa fréquence dans
+        le courriel pondérée par sa rareté dans la boîte.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [], 0
+        with self._locked(exclusive=False):
+            if not self.exists():
+                return [], 0
+            self._refresh()
+            postings = []
+            for term in terms:
+                frequencies: dict[int, int] = {}
+                key = term.encode('utf-8')
+                for segment in self._segments:
+                    found = segment.postings(key)
+                    if found is not None:
+                        frequencies.update(zip(*found))
+                frequencies.update(self._delta.get(term, ()))
+                if not frequencies:
+                    return [], 0
+                postings.append(frequencies)
+            postings.sort(key=len)
+            candidates = set(postings[0]).difference(self._deleted)
+            for frequencies in postings[1:]:
+                candidates.intersection_update(frequencies.keys())
+            documents = max(1, len(self._ids) - len(self._deleted))
+            weights = [math.log(1 + documents / len(frequencies)) for frequencies in postings]
+            # Du plus récent au plus ancien: à score égal, nlargest garde le premier vu.
+            scores = {number: weights[0] * frequency
+                      for number, frequency in reversed(postings[0].items())
+                      if number in candidates}
+            for weight, frequencies in zip(weights[1:], postings[1:]):
+                for number in scores:
+                    scores[number] += weight * frequencies[number]
+
+            offset, limit = max(0, offset), max(0, limit)
+            ranked = heapq.nlargest(offset + limit, zip(scores.values(), scores.keys()))
+            return [self._ids[number] for _, number in ranked[offset:]], len(candidates)
+
+    def _id_numbers(self) -> dict[str, int]:
+        if self._numbers is None:
+            self._numbers = {message_id: number for number, message_id in enumerate(self._ids)}
+        return self._numbers
+
+    def _manifest(self) -> dict:
+        with open(self._manifest_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def _write_manifest(self, manifest: dict) -> None:
+        temp_path = self._manifest_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file)
+        os.replace(temp_path, self._manifest_path)
+
+    @staticmethod
+    def _write_lines(path: str, lines: list[str]) -> None:
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write("".join(line + "\n" for line in lines))
+        os.replace(temp_path, path)
+
+    def _appended(self, path: str, reset: bool) -> tuple[list[str], bool]:
+        """
+        Retourne les lignes ajoutées au fichier depuis la dernière lecture,
+        et si le fichier a été remplacé (toutes ses lignes sont alors lues).
+        """
+        try:
+            status = os.stat(path)
+        except FileNotFoundError:
+            self._read.pop(path, None)
+            return [], True
+        inode, position = self._read.get(path, (None, 0))
+        if reset or status.st_ino != inode or status.st_size < position:
+            reset, position = True, 0
+        if status.st_size == position:
+            return [], reset
+        with open(path, 'rb') as file:
+            file.seek(position)
+            data = file.read(status.st_size - position)
+        complete = data.rfind(b"\n") + 1
+        self._read[path] = (status.st_ino, position + complete)
+        return data[:complete].decode('utf-8').splitlines(), reset
+
+    def _refresh(self) -> None:
+        """Met les structures en mémoire à jour avec les fichiers de l'index."""
+        status = os.stat(self._manifest_path)
+        stamp = (status.st_ino, status.st_mtime_ns, status.st_size)
+        changed = stamp != self._manifest_stamp
+        if changed:
+            manifest = self._manifest()
+            opened = {segment.name: segment for segment in self._segments}
+            segments = []
+            for name, level in manifest["segments"]:
+                segment = opened.pop(name, None)
+                if segment is None:
+                    segment = _SearchSegment(os.path.join(self._dir, name), name, level)
+                segments.append(segment)
+            for segment in opened.values():
+                segment.close()
+            self._segments = segments
+            self._next_segment = manifest["next"]
+            generation_changed = manifest["generation"] != self._generation
+            self._generation = manifest["generation"]
+            self._manifest_stamp = stamp
+        else:
+            generation_changed = False
+
+        lines, reset = self._appended(self._docs_path, generation_changed)
+        if reset:
+            self._ids, self._numbers = [], None
+        self._ids.extend(lines)
+        if self._numbers is not None:
+            start = len(self._ids) - len(lines)
+            self._numbers.update((message_id, number)
+                                 for number, message_id in enumerate(lines, start=start))
+
+        lines, reset = self._appended(self._delta_path, changed)
+        if reset:
+            self._delta, self._delta_documents = {}, 0
+        for line in lines:
+            document = json.loads(line)
+            number = document["doc"]
+            for term, frequency in document["terms"].items():
+                self._delta.setdefault(term, {})[number] = frequency
+        self._delta_documents += len(lines)
+
+        lines, reset = self._appended(self._deleted_path, generation_changed)
+        if reset:
+            self._deleted = set()
+        self._deleted.update(int(line) for line in lines)
+
+    def _flush(self) -> None:
+        """Écrit le delta en un segment, fusionne les segments et vide le delta."""
+        encoded = []
+        for term, frequencies in self._delta.items():
+            encoded.append((term.encode('utf-8'),
+                            _little_endian(array.array("I", frequencies.keys())),
+                            bytes(frequencies.values())))
+        encoded.sort()
+        manifest = self._manifest()
+        obsolete = self._add_segment(manifest, iter(encoded), self._delta_documents)
+        self._write_manifest(manifest)
+        self._write_lines(self._delta_path, [])
+        self._remove_segments(obsolete)
+        self._refresh()
+
+    def _add_segment(self, manifest: dict, terms: Iterator[tuple[bytes, bytes, bytes]],
+                     documents: int) -> list[str]:
+        """
+        Ajoute un segment de niveau 0 au manifeste, puis fusionne les
+        SEARCH_MERGE_FACTOR derniers segments tant qu'ils sont de même niveau.
+        Retourne les segments remplacés, à supprimer une fois le manifeste
+        écrit.
+        """
+        obsolete = []
+        name = f"{manifest['next']}.seg"
+        manifest["next"] += 1
+        _write_search_segment(os.path.join(self._dir, name), terms, documents)
+        manifest["segments"].append([name, 0])
+        while len(manifest["segments"]) >= SEARCH_MERGE_FACTOR:
+            tail = manifest["segments"][-SEARCH_MERGE_FACTOR:]
+            level = tail[0][1]
+            if any(segment_level != level for _, segment_level in tail):
+                break
+            sources = [_SearchSegment(os.path.join(self._dir, segment_name),
+                                      segment_name, segment_level)
+                       for segment_name, segment_level in tail]
+            try:
+                name = f"{manifest['next']}.seg"
+                manifest["next"] += 1
+                _write_search_segment(os.path.join(self._dir, name), _merged_terms(sources),
+                                      sum(source.documents for source in sources))
+            finally:
+                for source in sources:
+                    source.close()
+            manifest["segments"][-SEARCH_MERGE_FACTOR:] = [[name, level + 1]]
+            obsolete.extend(segment_name for segment_name, _ in tail)
+        return obsolete
+
+    def _build(self, documents: Iterator[tuple[str, gloutils.EmailContentPayload]]) -> None:
+        """Construit l'index complet, par segments de SEARCH_DELTA_LIMIT courriels."""
+        os.makedirs(self._dir, exist_ok=True)
+        # Les noms de segments ne sont jamais réutilisés: un autre processus
+        # peut encore avoir projeté un ancien segment du même nom.
+        previous = (self._manifest() if self.exists()
+                    else {"generation": -1, "next": 0, "segments": []})
+        for filename in os.listdir(self._dir):
+            if filename.endswith(".seg"):
+                os.remove(os.path.join(self._dir, filename))
+        manifest = {"generation": previous["generation"] + 1, "next": previous["next"],
+                    "segments": []}
+        ids: list[str] = []
+        chunk: dict[str, dict[int, int]] = {}
+        chunk_documents = 0
+        for message_id, email_content in documents:
+            number = len(ids)
+            ids.append(message_id)
+            for term, frequency in _document_terms(email_content).items():
+                chunk.setdefault(term, {})[number] = frequency
+            chunk_documents += 1
+            if chunk_documents >= SEARCH_DELTA_LIMIT:
+                self._add_built_segment(manifest, chunk, chunk_documents)
+                chunk, chunk_documents = {}, 0
+        if chunk_documents:
+            self._add_built_segment(manifest, chunk, chunk_documents)
+        self._write_lines(self._docs_path, ids)
+        self._write_lines(self._delta_path, [])
+        self._write_lines(self._deleted_path, [])
+        self._write_manifest(manifest)
+        self._refresh()
+
+    def _add_built_segment(self, manifest: dict, chunk: dict[str, dict[int, int]],
+                           documents: int) -> None:
+        encoded = sorted((term.encode('utf-8'),
+                          _little_endian(array.array("I", frequencies.keys())),
+                          bytes(frequencies.values()))
+                         for term, frequencies in chunk.items())
+        self._remove_segments(self._add_segment(manifest, iter(encoded), documents))
+
+    def _remove_segments(self, names: list[str]) -> None:
+        for name in names:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self._dir, name))
+
+
+class UserRecord:
+    """
+    Compte connu du registre: dossier, empreinte du mot de passe, boîte et
+    index de recherche.
+    """
+
+    __slots__ = ("username", "user_dir", "password_hash", "password_mtime", "mailbox",
+                 "search")
+
+    def __init__(self, username: str, user_dir: str, password_hash: str,
+                 password_mtime: int, mailbox: MailboxIndex, search: SearchIndex) -> None:
+        self.username = username
+        self.user_dir = user_dir
+        self.password_hash = password_hash
+        self.password_mtime = password_mtime
+        self.mailbox = mailbox
+        self.search = search
+
+
+# Nom d'utilisateur sûr comme nom de dossier: sans séparateur, sans « .. »
+# et sans point initial.
+_USERNAME_PATTERN = re.compile(r"(?!.*\.\.)\w[\w.-]{0,63}")
+
+
+def valid_username(username: str) -> bool:
+    """Indique si le nom d'utilisateur peut désigner un dossier de compte."""
+    return isinstance(username, str) and _USERNAME_PATTERN.fullmatch(username) is not None
+
+
+class UserRegistry:
+    """
+    Registre en mémoire des comptes de `data_dir`.
+
+    Chargé une fois au démarrage, il associe chaque nom d'utilisateur à son
+    dossier, à l'empreinte de son mot de passe et à l'index de sa boîte:
+    la résolution d'un destinataire et l'authentification ne touchent pas
+    le disque. Il reste cohérent avec les comptes créés par ce processus;
+    ceux créés par un autre processus sont chargés au premier accès
+    manqué, ou par `refresh`, appelé périodiquement par `start_polling`.
+
+    Les noms qui ne sont pas `valid_username` ne désignent aucun compte et
+    ne sont jamais joints au chemin de `data_dir`.
+    """
+
+    def __init__(self, data_dir: str,
+                 scan: Callable[[str], Iterator[IndexEntry]] | None = None) -> None:
+        self._data_dir = data_dir
+        self._scan = scan
+        self._users: dict[str, UserRecord] = {}
+        self._lock = threading.Lock()
+        self._polling: threading.Event | None = None
+
+    def load(self) -> None:
+        """Charge tous les comptes présents sur le disque."""
+        self.refresh()
+
+    def get(self, username: str) -> UserRecord | None:
+        """Retourne le compte de l'utilisateur, ou None s'il n'existe pas."""
+        record = self._users.get(username)
+        if record is None:
+            record = self._load(username)
+        return record
+
+    def usernames(self) -> list[str]:
+        """Retourne les noms des utilisateurs connus."""
+        return list(self._users)
+
+    def create(self, username: str, password_hash: str) -> UserRecord | None:
+        """
+        Crée le dossier et le fichier de mot de passe d'un nouveau compte.
+        Retourne None si le compte existe déjà ou si le nom est invalide.
+
+        Le dossier est préparé sous un nom temporaire, qui n'est pas un nom
+        d'utilisateur valide, puis renommé: un arrêt ou une erreur
+        d'écriture ne laisse jamais de compte sans mot de passe.
+        """
+        if not valid_username(username):
+            return None
+        user_dir = os.path.join(self._data_dir, username)
+        temp_dir = os.path.join(self._data_dir,
+                                f".{username}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            os.makedirs(temp_dir)
+            mtime = self._write_password(temp_dir, password_hash)
+            os.rename(temp_dir, user_dir)
+        except OSError as ex:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            if isinstance(ex, FileExistsError) or ex.errno == errno.ENOTEMPTY:
+                return None
+            raise
+        return self._add(username, password_hash, mtime)
+
+    def set_password(self, username: str, password_hash: str) -> None:
+        """Remplace atomiquement l'empreinte du mot de passe d'un compte."""
+        record = self._users[username]
+        record.password_mtime = self._write_password(record.user_dir, password_hash)
+        record.password_hash = password_hash
+
+    def refresh(self) -> None:
+        """
+        Synchronise le registre avec le disque: ajoute les nouveaux comptes,
+        retire ceux qui ont disparu et relit les mots de passe modifiés.
+        """
+        present = set()
+        for username in os.listdir(self._data_dir):
+            record = self._users.get(username)
+            if record is None:
+                record = self._load(username)
+            else:
+                try:
+                    mtime = os.stat(self._password_path(record.user_dir)).st_mtime_ns
+                except OSError:
+                    continue
+                if mtime != record.password_mtime:
+                    self._reload_password(record)
+            if record is not None:
+                present.add(username)
+        with self._lock:
+            for username in set(self._users) - present:
+                del self._users[username]
+
+    def start_polling(self, interval: float) -> None:
+        """Rafraîchit le registre toutes les `interval` secondes."""
+        self._polling = stop = threading.Event()
+
+        def poll() -> None:
+            while not stop.wait(interval):
+                try:
+                    self.refresh()
+                except OSError:
+                    pass
+
+        threading.Thread(target=poll, name="glo-user-registry", daemon=True).start()
+
+    def stop_polling(self) -> None:
+        """Arrête le rafraîchissement périodique."""
+        if self._polling is not None:
+            self._polling.set()
+            self._polling = None
+
+    def _load(self, username: str) -> UserRecord | None:
+        if not valid_username(username):
+            return None
+        user_dir = os.path.join(self._data_dir, username)
+        path = self._password_path(user_dir)
+        try:
+            with open(path, 'r') as file:
+                password_hash = file.read()
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        return self._add(username, password_hash, mtime)
+
+    def _reload_password(self, record: UserRecord) -> None:
+        path = self._password_path(record.user_dir)
+        try:
+            with open(path, 'r') as file:
+                record.password_hash = file.read()
+            record.password_mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+
+    def _add(self, username: str, password_hash: str, mtime: int) -> UserRecord:
+        user_dir = os.path.join(self._data_dir, username)
+        with self._lock:
+            record = self._users.get(username)
+            if record is None:
+                record = UserRecord(username, user_dir, password_hash, mtime,
+                                    MailboxIndex(user_dir, self._scan),
+                                    SearchIndex(user_dir))
+                self._users[username] = record
+            return record
+
+    @staticmethod
+    def _password_path(user_dir: str) -> str:
+        return os.path.join(user_dir, gloutils.PASSWORD_FILENAME)
+
+    @staticmethod
+    def _write_password(user_dir: str, password_hash: str) -> int:
+        path = UserRegistry._password_path(user_dir)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as file:
+            file.write(password_hash)
+        os.replace(temp_path, path)
+        return os.stat(path).st_mtime_ns
@@ -3,14 +3,21 @@ Module fournissant les constantes, énumérations,
 protocoles et gabarits à utiliser pour le TP4.
 """
 import enum
-from typing import TypedDict, Union
+from typing import NotRequired, TypedDict, Union
 import datetime
 
 APP_PORT = 5321
 SERVER_DATA_DIR = "glo_server_data"
 SERVER_LOST_DIR = "LOST"
+SERVER_OUTBOX_DIR = "OUTBOX"
 SERVER_DOMAIN = "glo2000.ca"
 PASSWORD_FILENAME = "pass"  # nosec:B105
+INDEX_FILENAME = "index"
+MAIL_DIRNAME = "mail"
+INBOX_PAGE_SIZE = 20
+INBOX_MAX_PAGE_SIZE = 500
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_SIZE = 64 * 1024 * 1024
 
 CLIENT_AUTH_CHOICE = """Menu de connexion
 1. Créer un compte
@@ -55,6 +62,25 @@ class Headers(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    HELLO = enum.auto()
+
+    EMAIL_STREAM_START = enum.auto()
+    EMAIL_CHUNK = enum.auto()
+    EMAIL_STREAM_END = enum.auto()
+    INBOX_READING_STREAM = enum.auto()
+
+    EMAIL_DELETE = enum.auto()
+
+    AUTH_RESUME = enum.auto()
+
+    EMAIL_SENDING_BATCH = enum.auto()
+
+    METRICS_REQUEST = enum.auto()
+
+    INBOX_SEARCH = enum.auto()
+
+    EMAIL_NOTIFICATION = enum.auto()
+
 
 class ErrorPayload(TypedDict, total=True):
     """Payload pour les messages d'erreurs."""
@@ -68,19 +94,89 @@ class AuthPayload(TypedDict, total=True):
 
 
 class EmailContentPayload(TypedDict, total=True):
-    """Payload pour les transferts de courriels."""
+    """
+    Payload pour les transferts de courriels.
+
+    `destination` est une adresse ou une liste d'adresses; le courriel
+    conservé par le serveur porte les adresses séparées par des virgules.
+    """
     sender: str
-    destination: str
+    destination: Union[str, list[str]]
     subject: str
     date: str
     content: str
 
 
+class EmailChunkPayload(TypedDict, total=True):
+    """
+    Payload pour un morceau du corps d'un courriel transféré en continu.
+
+    Un transfert en continu commence par `EMAIL_STREAM_START` (courriel
+    sans contenu), se poursuit avec des `EMAIL_CHUNK` et se termine par
+    `EMAIL_STREAM_END`. Un envoi au serveur demande d'être connecté et son
+    corps est limité à MAX_UPLOAD_SIZE octets par défaut.
+    """
+    data: str
+
+
+class EmailBatchPayload(TypedDict, total=True):
+    """Payload pour l'envoi de plusieurs courriels en une requête."""
+    emails: list[EmailContentPayload]
+
+
+class DeliveryStatus(TypedDict, total=True):
+    """Résultat de la livraison d'un courriel à un destinataire."""
+    destination: str
+    delivered: bool
+
+
+class DeliveryPayload(TypedDict, total=True):
+    """
+    Payload de réponse à un envoi à plusieurs destinataires ou à
+    `EMAIL_SENDING_BATCH`: un statut par destinataire, dans l'ordre des
+    courriels puis des adresses.
+    """
+    statuses: list[DeliveryStatus]
+
+
 class EmailListPayload(TypedDict, total=True):
     """Payload pour les consulation de courriel."""
     email_list: list[str]
 
 
+class EmailListRequestPayload(TypedDict, total=False):
+    """
+    Payload optionnel pour demander une page de la liste de courriels.
+
+    `offset` est compté à partir du courriel le plus récent.
+    """
+    offset: int
+    limit: int
+
+
+class SearchPayload(TypedDict, total=True):
+    """
+    Payload pour chercher des courriels avec l'entête `INBOX_SEARCH`.
+
+    Les courriels retenus contiennent tous les mots de `query` dans
+    l'expéditeur, le sujet ou le corps, sans égard à la casse et aux
+    accents. La réponse est une page (EmailPagePayload) triée par
+    pertinence; `offset` et `limit` s'y appliquent comme pour
+    EmailListRequestPayload, et le numéro affiché de chaque courriel est
+    celui à donner avec `INBOX_READING_CHOICE`.
+    """
+    query: str
+    offset: NotRequired[int]
+    limit: NotRequired[int]
+
+
+class EmailPagePayload(TypedDict, total=True):
+    """Payload pour une page de la liste de courriels."""
+    email_list: list[str]
+    offset: int
+    total: int
+
+
 class EmailChoicePayload(TypedDict, total=True):
     """Payload pour le choix du courriel à consulter."""
     choice: int
@@ -92,16 +188,74 @@ class StatsPayload(TypedDict, total=True):
     size: int
 
 
+class SessionPayload(TypedDict, total=True):
+    """
+    Payload du jeton de session retourné par AUTH_LOGIN/AUTH_REGISTER,
+    présenté avec l'entête `AUTH_RESUME` pour reprendre la session.
+    """
+    token: str
+
+
+class HelloPayload(TypedDict, total=True):
+    """
+    Payload pour la négociation de l'encodage à la connexion.
+
+    Le client liste les encodages qu'il supporte par ordre de préférence;
+    le serveur répond avec l'encodage retenu. Il en va de même pour les
+    compressions de trames (`compression`, voir glosocket), la réponse
+    étant vide si aucune n'est retenue.
+
+    Avec `notify`, le client demande à être averti des nouveaux courriels
+    de l'utilisateur connecté (`EMAIL_NOTIFICATION`); le serveur le
+    recopie s'il l'accepte.
+    """
+    codecs: list[str]
+    compression: NotRequired[list[str]]
+    notify: NotRequired[bool]
+
+
+class NotificationPayload(TypedDict, total=True):
+    """
+    Payload de `EMAIL_NOTIFICATION`, transmis par le serveur sans requête
+    (donc sans `request_id`) aux connexions qui l'ont demandé avec
+    `HELLO`, à chaque livraison dans la boîte de l'utilisateur connecté.
+
+    `email_list` contient les courriels livrés au format SUBJECT_DISPLAY,
+    numérotés comme dans la liste au moment de la livraison, et `total`
+    le nombre de courriels de la boîte.
+    """
+    email_list: list[str]
+    total: int
+
+
+class MetricsPayload(TypedDict, total=True):
+    """
+    Payload de réponse à `METRICS_REQUEST`: instantané des mesures du
+    serveur (voir glometrics.Metrics.snapshot), réservé aux administrateurs.
+    """
+    metrics: dict
+
+
 class GloMessage(TypedDict, total=False):
     """
     Classe à utiliser pour générer des messages.
 
     Les classes *Payload correspondent à des entêtes spécifiques
     certaines entêtes n'ont pas besoin de payload.
+
+    `request_id` est optionnel: le serveur le recopie dans chaque réponse
+    à la requête, ce qui permet au client d'envoyer plusieurs requêtes
+    sans attendre (pipelining) et d'associer les réponses, qui peuvent
+    arriver dans un autre ordre.
     """
     header: Headers
+    request_id: int
     payload: Union[ErrorPayload, AuthPayload, EmailContentPayload,
-                   EmailListPayload, EmailChoicePayload, StatsPayload]
+                   EmailListPayload, EmailListRequestPayload,
+                   EmailPagePayload, EmailChoicePayload, StatsPayload,
+                   HelloPayload, EmailChunkPayload, SessionPayload,
+                   EmailBatchPayload, DeliveryPayload, MetricsPayload,
+                   SearchPayload, NotificationPayload]
 
 
 def get_current_utc_time() -> str:
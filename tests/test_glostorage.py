@@ -0,0 +1,37 @@
+"""Tests du regroupement des fsync (glostorage._GroupCommitter)."""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import glostorage
+
+
+class GroupCommitterTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "mail.json")
+        with open(self.path, 'wb') as file:
+            file.write(b"{}")
+
+    def test_transient_error_fails_only_its_batch(self) -> None:
+        committer = glostorage._GroupCommitter(0)
+        fsync = glostorage._fsync_path
+        failures = [OSError(5, "Input/output error")]
+
+        def flaky_fsync(path: str, directory: bool = False) -> None:
+            if failures:
+                raise failures.pop()
+            fsync(path, directory)
+
+        with mock.patch.object(glostorage, "_fsync_path", flaky_fsync):
+            with self.assertRaises(OSError):
+                committer.commit([self.path], [])
+            committer.commit([self.path], [])
+            committer.commit([self.path], [os.path.dirname(self.path)])
+
+
+if __name__ == '__main__':
+    unittest.main()